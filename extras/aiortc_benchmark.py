@@ -0,0 +1,153 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+import urllib.request
+
+# The protocol peer lives in the p2p package at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from p2p import DATA_CHANNEL_COUNT, MemoryFile, ProtocolPeer
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+
+class AiortcBenchmark:
+    def __init__(self, base_url='http://localhost:5000', file_sizes=None, pair_counts=(1, 4),
+                 iterations=1, data_channels=DATA_CHANNEL_COUNT, ordered=False):
+        self.base_url = base_url
+        self.file_sizes = file_sizes or [5*1024*1024, 50*1024*1024]
+        self.pair_counts = pair_counts
+        self.iterations = iterations
+        self.data_channels = data_channels
+        self.ordered = ordered
+        self.results = []
+
+    def create_room(self):
+        request = urllib.request.Request(f"{self.base_url}/create-room", method='POST')
+        with urllib.request.urlopen(request) as response:
+            return json.load(response)['room_id']
+
+    async def run_pair(self, file_size, payload):
+        """One sender and one receiver in their own room; returns the transfer's metrics"""
+        room_id = self.create_room()
+        sent_at = {}
+        latencies = []
+
+        def chunk_sent(file_id, index):
+            sent_at[index] = time.perf_counter()
+
+        def chunk_received(file_id, index):
+            if index in sent_at:
+                latencies.append((time.perf_counter() - sent_at[index]) * 1000)
+
+        sender = ProtocolPeer(self.base_url, room_id, self.data_channels, self.ordered, on_chunk_sent=chunk_sent)
+        receiver = ProtocolPeer(self.base_url, room_id, self.data_channels, self.ordered,
+                                on_chunk_received=chunk_received)
+        try:
+            join_started = time.time()
+            await sender.join()
+            file_id = sender.share(MemoryFile(f"bench_{file_size // (1024 * 1024)}MB.bin", payload))
+            await sender.broadcast_file_list()
+            await receiver.join()
+
+            # Whichever side answers, the receiver's connection records the open time
+            while sender.peer_id not in receiver.connections:
+                await asyncio.sleep(0.01)
+            await asyncio.wait_for(receiver.connections[sender.peer_id].connected, 60)
+            connect_time = time.time() - join_started
+            while receiver.connections[sender.peer_id].remote_channel_count < self.data_channels:
+                await asyncio.sleep(0.01)
+
+            download = receiver.request_file(sender.peer_id, file_id)
+            finished = await asyncio.wait_for(download.done, max(120, file_size / (1024 * 1024)))
+            elapsed = finished - download.requested_at
+            return {
+                'file_size': file_size,
+                'time_to_connect': connect_time,
+                'time_to_first_chunk': download.first_chunk_at - download.requested_at,
+                'transfer_time': elapsed,
+                'transfer_rate': file_size / elapsed / (1024 * 1024),
+                'chunk_latency_p50_ms': percentile(latencies, 0.5),
+                'chunk_latency_p95_ms': percentile(latencies, 0.95)
+            }
+        finally:
+            await receiver.leave()
+            await sender.leave()
+
+    async def run_case(self, file_size, pairs):
+        payload = os.urandom(file_size)
+        started = time.time()
+        results = await asyncio.gather(*[self.run_pair(file_size, payload) for _ in range(pairs)],
+                                       return_exceptions=True)
+        elapsed = time.time() - started
+        completed = []
+        for result in results:
+            if isinstance(result, Exception):
+                print(f"Pair failed: {result!r}")
+            else:
+                result['pairs'] = pairs
+                completed.append(result)
+        if completed:
+            print(f"- {len(completed)}/{pairs} pairs, {file_size // (1024 * 1024)} MB: "
+                  f"{statistics.mean(r['transfer_rate'] for r in completed):.2f} MB/s per pair, "
+                  f"{len(completed) * file_size / elapsed / (1024 * 1024):.2f} MB/s total")
+        return completed
+
+    def run(self):
+        for pairs in self.pair_counts:
+            for size in self.file_sizes:
+                for iteration in range(self.iterations):
+                    print(f"\n=== {pairs} concurrent pair(s), {size // (1024 * 1024)} MB, "
+                          f"iteration {iteration + 1}/{self.iterations} ===")
+                    self.results.extend(asyncio.run(self.run_case(size, pairs)))
+        self.summarize_results()
+
+    def summarize_results(self):
+        print("\n=== aiortc Benchmark Results Summary ===")
+        print(f"Data channels: {self.data_channels} ({'ordered' if self.ordered else 'unordered'})")
+        for pairs in self.pair_counts:
+            for size in self.file_sizes:
+                matching = [r for r in self.results if r['pairs'] == pairs and r['file_size'] == size]
+                if not matching:
+                    continue
+                connect = [r['time_to_connect'] for r in matching]
+                print(f"- {pairs} pair(s), {size // (1024 * 1024)} MB: "
+                      f"Throughput: {statistics.mean(r['transfer_rate'] for r in matching):.2f} MB/s, "
+                      f"Connect: p50 {percentile(connect, 0.5):.2f}s / p95 {percentile(connect, 0.95):.2f}s, "
+                      f"First Chunk: {statistics.mean(r['time_to_first_chunk'] for r in matching) * 1000:.0f}ms, "
+                      f"Chunk Latency: p50 {statistics.mean(r['chunk_latency_p50_ms'] for r in matching):.1f}ms"
+                      f" / p95 {max(r['chunk_latency_p95_ms'] for r in matching):.1f}ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Browserless data-channel benchmark using aiortc peers")
+    parser.add_argument("--base-url", type=str, default="http://localhost:5000", help="Base URL of the signaling server")
+    parser.add_argument("--sizes", type=str, default="5,50", help="Comma-separated file sizes in MB")
+    parser.add_argument("--pairs", type=str, default="1,4", help="Comma-separated counts of concurrent sender/receiver pairs")
+    parser.add_argument("--iterations", type=int, default=1, help="Number of iterations per case")
+    parser.add_argument("--data-channels", type=int, default=DATA_CHANNEL_COUNT, help="Striped data channels per peer (0 = control channel only)")
+    parser.add_argument("--ordered", action="store_true", help="Use ordered data channels")
+    args = parser.parse_args()
+
+    benchmark = AiortcBenchmark(
+        base_url=args.base_url,
+        file_sizes=[int(size) * 1024 * 1024 for size in args.sizes.split(',')],
+        pair_counts=[int(count) for count in args.pairs.split(',')],
+        iterations=args.iterations,
+        data_channels=args.data_channels,
+        ordered=args.ordered
+    )
+    try:
+        benchmark.run()
+    except KeyboardInterrupt:
+        print("\nBenchmark interrupted by user.")
+    finally:
+        with open("aiortc_benchmark_results.json", "w") as f:
+            json.dump(benchmark.results, f, indent=4)
@@ -0,0 +1,125 @@
+"""Results store shared by the benchmark scripts: per-metric statistics,
+one JSON file per run with the metadata needed to tell runs apart, named
+baselines, and a median comparison that flags regressions."""
+
+import os
+import json
+import shutil
+import platform
+import statistics
+import subprocess
+from datetime import datetime, timezone
+
+# Layout version of the files in the results store
+RESULTS_SCHEMA = 1
+
+# Whether a bigger value is better, per kind of metric, and the default
+# regression threshold in percent for --compare
+METRIC_KINDS = {
+    'throughput': {'higher_is_better': True, 'threshold': 10},
+    'connection': {'higher_is_better': False, 'threshold': 20},
+    'reconnection': {'higher_is_better': False, 'threshold': 20},
+    'latency': {'higher_is_better': False, 'threshold': 25},
+}
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    return ordered[int(fraction * (len(ordered) - 1))]
+
+def describe(values):
+    """Summary statistics of a sample, with the raw values kept alongside"""
+    return {
+        'count': len(values),
+        'mean': statistics.mean(values),
+        'stddev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'min': min(values),
+        'p50': percentile(values, 0.5),
+        'p95': percentile(values, 0.95),
+        'p99': percentile(values, 0.99),
+        'max': max(values),
+        'samples': list(values)
+    }
+
+def format_stats(stats, unit, digits=2):
+    return (f"p50 {stats['p50']:.{digits}f}{unit} / p95 {stats['p95']:.{digits}f}{unit} / "
+            f"p99 {stats['p99']:.{digits}f}{unit} (mean {stats['mean']:.{digits}f}{unit}, "
+            f"stddev {stats['stddev']:.{digits}f}, n={stats['count']})")
+
+def run_metadata(options):
+    """Where and on what a run happened, so runs can be told apart later"""
+    def git(*command):
+        try:
+            return subprocess.run(['git', *command], capture_output=True, text=True, timeout=10,
+                                  cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+        except (OSError, subprocess.SubprocessError):
+            return None
+
+    cpu = platform.processor() or None
+    try:
+        with open('/proc/cpuinfo') as f:
+            cpu = next((line.split(':', 1)[1].strip() for line in f if line.startswith('model name')), cpu)
+    except OSError:
+        pass
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'git_commit': git('rev-parse', 'HEAD'),
+        'git_dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'cpu': cpu,
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'options': options
+    }
+
+def save_run(results_dir, metrics, raw, options):
+    """Write a run to a new file in the store; returns the run and its path"""
+    metadata = run_metadata(options)
+    run = {'schema': RESULTS_SCHEMA, 'metadata': metadata, 'metrics': metrics, 'raw': raw}
+    os.makedirs(results_dir, exist_ok=True)
+    stamp = metadata['timestamp'].replace(':', '').replace('-', '').replace('+0000', 'Z')
+    path = os.path.join(results_dir, f"run-{stamp}-{(metadata['git_commit'] or 'nogit')[:10]}.json")
+    with open(path, 'w') as f:
+        json.dump(run, f, indent=2, default=str)
+    return run, path
+
+def save_baseline(results_dir, path, name):
+    os.makedirs(os.path.join(results_dir, 'baselines'), exist_ok=True)
+    shutil.copyfile(path, os.path.join(results_dir, 'baselines', f"{name}.json"))
+    print(f"Saved as baseline '{name}'")
+
+def load_run(path_or_name, results_dir):
+    """A stored run or baseline, by path or by baseline name"""
+    path = path_or_name
+    if not os.path.exists(path):
+        path = os.path.join(results_dir, 'baselines', f"{path_or_name}.json")
+    with open(path) as f:
+        run = json.load(f)
+    if run.get('schema') != RESULTS_SCHEMA:
+        raise ValueError(f"{path} has results schema {run.get('schema')}, expected {RESULTS_SCHEMA}")
+    return run
+
+def compare_runs(run, baseline, thresholds):
+    """Print each shared metric's median change; returns the names of metrics that regressed past their threshold"""
+    print(f"\n=== Comparison against baseline ({baseline['metadata'].get('git_commit') or 'unknown commit'}, "
+          f"{baseline['metadata'].get('timestamp')}) ===")
+    regressions = []
+    for name in sorted(run['metrics']):
+        if name not in baseline['metrics']:
+            continue
+        current, previous = run['metrics'][name], baseline['metrics'][name]
+        kind = METRIC_KINDS[current['kind']]
+        if not previous['p50']:
+            continue
+        change = (current['p50'] - previous['p50']) / abs(previous['p50']) * 100
+        worse_by = -change if kind['higher_is_better'] else change
+        regressed = worse_by > thresholds[current['kind']]
+        if regressed:
+            regressions.append(name)
+        print(f"{'REGRESSION' if regressed else 'ok':>10}  {name}: {previous['p50']:.2f} -> {current['p50']:.2f} "
+              f"({change:+.1f}%, threshold {thresholds[current['kind']]:g}% {current['kind']})")
+    skipped = sorted(set(baseline['metrics']) ^ set(run['metrics']))
+    if skipped:
+        print(f"Not in both runs: {', '.join(skipped)}")
+    print(f"{len(regressions)} regression(s)" if regressions else "No regressions")
+    return regressions
@@ -0,0 +1,326 @@
+"""Micro-benchmarks of the signaling server's handlers, called directly
+(no browsers, no sockets) against pre-populated rooms of growing size, to
+show how each one scales with the number of rooms on the server.
+
+    python extras/handler_benchmark.py --sizes 1000,10000,100000,1000000
+"""
+
+import os
+import sys
+import math
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import tracemalloc
+
+from benchmark_store import describe, save_run, save_baseline, load_run, compare_runs, METRIC_KINDS
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Peers per room, weighted: most rooms are a pair or a lone sharer, a few
+# are big enough to get a planned topology (more than TOPOLOGY_THRESHOLD)
+ROOM_SIZES = (1, 2, 3, 4, 6, 8, 20, 50)
+ROOM_SIZE_WEIGHTS = (30, 45, 10, 6, 4, 3, 1.5, 0.5)
+FILES_PER_PEER = 3
+HANDLERS = ('join_room', 'signal', 'heartbeat', 'disconnect', 'cleanup_rooms', 'save_rooms', 'status')
+
+
+def import_server(rooms_file):
+    """Import main.py quietly, with the probe off and rooms.json kept out of the repository"""
+    os.environ.setdefault('LOG_LEVEL', 'WARNING')
+    os.environ['PROBE_INTERVAL'] = '0'
+    os.environ['TELEMETRY_INTERVAL'] = '0'
+    os.chdir(REPO_ROOT)
+    sys.path.insert(0, REPO_ROOT)
+    import main
+    main.ROOMS_FILE = rooms_file
+    return main
+
+
+class StubEmitter:
+    """Stands in for sio.emit/enter_room: counts what would have been sent"""
+
+    def __init__(self):
+        self.emits = 0
+        self.enters = 0
+
+    async def emit(self, event, data=None, to=None, **kwargs):
+        self.emits += 1
+
+    async def enter_room(self, sid, room, **kwargs):
+        self.enters += 1
+
+
+def populate(main, room_count, seed=1):
+    """Fill main.rooms with room_count rooms; returns (room_id, peer_id, sid) of every peer"""
+    rng = random.Random(seed)
+    main.rooms.clear()
+    main.peer_sockets.clear()
+    now = time.time()
+    peers = []
+    for index in range(room_count):
+        room_id = f"{index:08x}"
+        size = rng.choices(ROOM_SIZES, ROOM_SIZE_WEIGHTS)[0]
+        room = {'peers': [], 'created_at': now - rng.uniform(0, 1800), 'peer_data': [], 'file_lists': {}}
+        for slot in range(size):
+            peer_id = f"{index:08x}{slot:02x}"
+            sid = f"sid-{peer_id}"
+            room['peers'].append(peer_id)
+            peer_data = {'peer_id': peer_id, 'socket_id': sid, 'last_seen': now}
+            room['peer_data'].append(peer_data)
+            main.peer_sockets[sid] = (room_id, peer_data)
+            room['file_lists'][peer_id] = {
+                f"{peer_id}-{n}": {'fileId': f"{peer_id}-{n}", 'fileName': f"file{n}.bin", 'size': 1 << 20}
+                for n in range(FILES_PER_PEER)
+            }
+            peers.append((room_id, peer_id, sid))
+        main.rooms[room_id] = room
+    # Planned rooms start with their overlay, as after their last join
+    for room_id, room in main.rooms.items():
+        if main.is_planned(room):
+            main.plan_topology(room)
+    return peers
+
+
+class HandlerBenchmark:
+    def __init__(self, main, sizes, min_time=0.5, min_ops=3, max_ops=20000, alloc_ops=3, seed=1):
+        self.main = main
+        self.sizes = sizes
+        self.min_time = min_time
+        self.min_ops = min_ops
+        self.max_ops = max_ops
+        self.alloc_ops = alloc_ops
+        self.seed = seed
+        self.results = []
+        self.emitter = StubEmitter()
+        main.sio.emit = self.emitter.emit
+        main.sio.enter_room = self.emitter.enter_room
+
+    def operations(self, peers, rng):
+        """handler -> function(i) returning (setup, op, undo) coroutine functions; only op is timed"""
+        main = self.main
+        # Pairs, the common case, for the per-room handlers
+        pair_peers = [peer for peer in peers if len(main.rooms[peer[0]]['peers']) == 2] or peers
+
+        def join_room(i):
+            room_id, _, _ = rng.choice(pair_peers)
+            peer_id, sid = f"bench{i:08x}", f"sid-bench{i:08x}"
+
+            async def op():
+                await main.join_room(sid, {'room_id': room_id, 'peer_id': peer_id})
+
+            async def undo():
+                room = main.rooms[room_id]
+                room['peers'].remove(peer_id)
+                room['peer_data'] = [p for p in room['peer_data'] if p['peer_id'] != peer_id]
+                main.peer_sockets.pop(sid, None)
+            return None, op, undo
+
+        def signal(i):
+            room_id, from_peer, _ = rng.choice(pair_peers)
+            to_peer = next(p for p in main.rooms[room_id]['peers'] if p != from_peer)
+            data = {'room_id': room_id, 'from': from_peer, 'to': to_peer,
+                    'signal': {'type': 'candidate', 'candidate': {'candidate': 'candidate:1 1 udp 2122260223 '
+                                                                  '192.0.2.1 54321 typ host', 'sdpMid': '0'}}}
+
+            async def op():
+                await main.signal(f"sid-{from_peer}", data)
+            return None, op, None
+
+        def heartbeat(i):
+            room_id, peer_id, sid = rng.choice(pair_peers)
+
+            async def op():
+                await main.heartbeat(sid, {'room_id': room_id, 'peer_id': peer_id})
+            return None, op, None
+
+        def disconnect(i):
+            room_id, _, _ = rng.choice(pair_peers)
+            peer_id, sid = f"gone{i:08x}", f"sid-gone{i:08x}"
+
+            async def setup():
+                room = main.rooms[room_id]
+                room['peers'].append(peer_id)
+                peer_data = {'peer_id': peer_id, 'socket_id': sid, 'last_seen': time.time()}
+                room['peer_data'].append(peer_data)
+                main.peer_sockets[sid] = (room_id, peer_data)
+
+            async def op():
+                await main.disconnect(sid)
+
+            async def undo():
+                room = main.rooms[room_id]
+                room['peer_data'] = [p for p in room['peer_data'] if p['peer_id'] != peer_id]
+            return setup, op, undo
+
+        def cleanup_rooms(i):
+            # Nothing is stale, so this measures the scan of the scheduled cleanup
+            return None, main.cleanup_rooms, None
+
+        def save_rooms(i):
+            async def op():
+                main.save_rooms()
+            return None, op, None
+
+        return {
+            'join_room': join_room,
+            'signal': signal,
+            'heartbeat': heartbeat,
+            'disconnect': disconnect,
+            'cleanup_rooms': cleanup_rooms,
+            'save_rooms': save_rooms,
+            'status': lambda i: (None, main.status, None)
+        }
+
+    async def measure(self, make_op):
+        """ns per op, repeating until min_time has passed (at least min_ops, at most max_ops)"""
+        samples = []
+        spent = 0.0
+        while len(samples) < self.max_ops and (len(samples) < self.min_ops or spent < self.min_time):
+            setup, op, undo = make_op(len(samples))
+            if setup:
+                await setup()
+            started = time.perf_counter_ns()
+            await op()
+            elapsed = time.perf_counter_ns() - started
+            if undo:
+                await undo()
+            samples.append(elapsed)
+            spent += elapsed / 1e9
+        return samples
+
+    async def measure_allocations(self, make_op):
+        """Peak bytes allocated during one op and blocks still held after it, averaged over a few ops"""
+        peaks, blocks = [], []
+        for i in range(self.alloc_ops):
+            setup, op, undo = make_op(self.max_ops + i)
+            if setup:
+                await setup()
+            tracemalloc.start()
+            before_bytes, _ = tracemalloc.get_traced_memory()
+            before_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+            await op()
+            _, peak = tracemalloc.get_traced_memory()
+            after_blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+            tracemalloc.stop()
+            if undo:
+                await undo()
+            peaks.append(peak - before_bytes)
+            blocks.append(after_blocks - before_blocks)
+        return sum(peaks) / len(peaks), sum(blocks) / len(blocks)
+
+    async def run_size(self, size, handlers):
+        print(f"\n=== {size:,} rooms ===")
+        started = time.perf_counter()
+        peers = populate(self.main, size, self.seed)
+        print(f"Populated {len(peers):,} peers in {time.perf_counter() - started:.1f}s")
+        rng = random.Random(self.seed)
+        operations = self.operations(peers, rng)
+        for name in handlers:
+            # Topology planning is randomized; start each handler from the same state
+            random.seed(self.seed)
+            emits_before = self.emitter.emits
+            samples = await self.measure(operations[name])
+            alloc_bytes, alloc_blocks = await self.measure_allocations(operations[name])
+            stats = describe(samples)
+            result = {
+                'handler': name,
+                'rooms': size,
+                'peers': len(peers),
+                'ops': len(samples),
+                'ns_per_op_p50': stats['p50'],
+                'ns_per_op_mean': stats['mean'],
+                'ns_per_op_p99': stats['p99'],
+                'alloc_peak_bytes_per_op': alloc_bytes,
+                'alloc_blocks_retained_per_op': alloc_blocks,
+                'emits_per_op': (self.emitter.emits - emits_before) / (len(samples) + self.alloc_ops),
+                'samples': samples
+            }
+            self.results.append(result)
+            print(f"- {name:<14} {stats['p50']:>14,.0f} ns/op p50 ({stats['p99']:,.0f} p99, {len(samples)} ops), "
+                  f"{alloc_bytes / 1024:,.1f} KB peak alloc/op, {alloc_blocks:,.0f} blocks kept/op")
+
+    def run(self, handlers=HANDLERS):
+        for size in self.sizes:
+            asyncio.run(self.run_size(size, handlers))
+        self.main.rooms.clear()
+
+    def scaling(self):
+        """Log-log slope of ns/op against room count for each handler: ~0 is constant, ~1 linear"""
+        curves = {}
+        for name in dict.fromkeys(result['handler'] for result in self.results):
+            points = sorted((r['rooms'], r['ns_per_op_p50']) for r in self.results if r['handler'] == name)
+            if len(points) < 2:
+                continue
+            (smallest, first), (largest, last) = points[0], points[-1]
+            curves[name] = {
+                'points': points,
+                'exponent': math.log(last / first) / math.log(largest / smallest) if first > 0 and last > 0 else None
+            }
+        return curves
+
+    def summarize_results(self):
+        print("\n=== Handler Scaling Summary ===")
+        curves = self.scaling()
+        sizes = sorted({r['rooms'] for r in self.results})
+        print(f"{'handler':<14}" + ''.join(f"{size:>14,}" for size in sizes) + "   growth")
+        for name in dict.fromkeys(result['handler'] for result in self.results):
+            row = {r['rooms']: r['ns_per_op_p50'] for r in self.results if r['handler'] == name}
+            cells = ''.join(f"{row[size] / 1000:>12,.1f}us" if size in row else f"{'-':>14}" for size in sizes)
+            exponent = curves.get(name, {}).get('exponent')
+            growth = f"O(n^{exponent:.2f})" if exponent is not None else ""
+            print(f"{name:<14}{cells}   {growth}")
+
+    def collect_metrics(self):
+        metrics = {}
+        for result in self.results:
+            metrics[f"handler.{result['handler']}.{result['rooms']}_rooms.ns_per_op"] = {
+                'kind': 'latency', **describe(result['samples'])}
+        return metrics
+
+    def save_run(self, results_dir, options):
+        raw = {'handlers': [{k: v for k, v in r.items() if k != 'samples'} for r in self.results],
+               'scaling': self.scaling()}
+        return save_run(results_dir, self.collect_metrics(), raw, options)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Signaling server handler micro-benchmarks")
+    parser.add_argument("--sizes", type=str, default="1000,10000,100000,1000000", help="Comma-separated room counts")
+    parser.add_argument("--handlers", type=str, default=','.join(HANDLERS), help="Comma-separated handlers to run")
+    parser.add_argument("--min-time", type=float, default=0.5, help="Seconds to spend per handler and size")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for room sizes and peer choices")
+    parser.add_argument("--results-dir", type=str, default="benchmark_results", help="Directory of stored runs, one JSON file per run")
+    parser.add_argument("--save-baseline", type=str, metavar="NAME", help="Also save this run as the named baseline")
+    parser.add_argument("--compare", type=str, metavar="BASELINE", help="Compare medians against a baseline (name or path); exit 1 on regressions")
+    parser.add_argument("--max-increase", type=float, default=METRIC_KINDS['latency']['threshold'], help="Percent rise in a handler's ns/op median counted as a regression")
+    args = parser.parse_args()
+
+    handlers = [name for name in args.handlers.split(',') if name]
+    unknown = set(handlers) - set(HANDLERS)
+    if unknown:
+        parser.error(f"unknown handlers: {', '.join(sorted(unknown))}")
+    # Relative paths are taken from where the command was run, not the repository root main.py needs
+    results_dir = os.path.abspath(args.results_dir)
+    baseline = os.path.abspath(args.compare) if args.compare and os.path.exists(args.compare) else args.compare
+
+    with tempfile.TemporaryDirectory() as scratch:
+        server = import_server(os.path.join(scratch, 'rooms.json'))
+        benchmark = HandlerBenchmark(server, [int(size) for size in args.sizes.split(',')],
+                                     min_time=args.min_time, seed=args.seed)
+        try:
+            benchmark.run(handlers)
+        except KeyboardInterrupt:
+            print("\nBenchmark interrupted by user.")
+        benchmark.summarize_results()
+
+    run, path = benchmark.save_run(results_dir, vars(args))
+    print(f"\nResults saved to {path}")
+    if args.save_baseline:
+        save_baseline(results_dir, path, args.save_baseline)
+    if args.compare:
+        thresholds = {kind: args.max_increase for kind in METRIC_KINDS}
+        regressions = compare_runs(run, load_run(baseline, results_dir), thresholds)
+        sys.exit(1 if regressions else 0)
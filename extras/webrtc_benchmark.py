@@ -13,11 +13,22 @@ from webdriver_manager.chrome import ChromeDriverManager
 import threading
 import os
 import concurrent.futures
+import urllib.request
+import asyncio
+import subprocess
+import sys
+import tempfile
+
+from benchmark_store import percentile, describe, format_stats, save_run, save_baseline, load_run, compare_runs, METRIC_KINDS
 
 class WebRTCBenchmark:
     def __init__(self, base_url='http://localhost:5000', num_rooms=2, peers_per_room=3, 
                  file_sizes=None, iterations=3, headless=True, 
-                 test_reconnection=False, test_large_files=False, test_signaling=False):
+                 test_reconnection=False, test_large_files=False, test_signaling=False,
+                 data_channels=None, test_striping=False, test_fanout=False,
+                 compression=None, test_compression=False, test_batch=False,
+                 test_topology=False, test_relay=False, server_pid=None, test_logging=False,
+                 test_profiles=False):
         self.base_url = base_url
         self.num_rooms = num_rooms
         self.peers_per_room = peers_per_room
@@ -35,6 +46,31 @@ class WebRTCBenchmark:
         self.enable_test_reconnection = test_reconnection
         self.test_large_files = test_large_files
         self.test_signaling = test_signaling
+        # Number of striped data channels the room page opens (None = page default)
+        self.data_channels = data_channels
+        self.test_striping = test_striping
+        self.test_fanout = test_fanout
+        self.fanout_results = []
+        # Chunk compression on the room page (None = page default, on)
+        self.compression = compression
+        self.test_compression = test_compression
+        self.compression_results = []
+        self.test_batch = test_batch
+        self.batch_results = []
+        self.test_topology = test_topology
+        self.topology_results = []
+        self.test_relay = test_relay
+        self.relay_results = []
+        self.test_logging = test_logging
+        self.logging_results = []
+        self.test_profiles = test_profiles
+        self.profile_results = []
+        # Server process to sample memory from during the relay test
+        self.server_pid = server_pid
+        # Time-to-datachannel-open samples reported by the room pages
+        self.connection_open_results = []
+        if test_striping and 500*1024*1024 not in self.file_sizes:
+            self.file_sizes.append(500*1024*1024)
         
         # Create test files of different sizes
         self.test_files = self.create_test_files()
@@ -194,6 +230,18 @@ class WebRTCBenchmark:
             driver.quit()
             return None, None
     
+    def room_url(self, room_id):
+        """URL of a room page, with the data channel and compression overrides if set"""
+        url = f"{self.base_url}/join-room/{room_id}"
+        params = []
+        if self.data_channels is not None:
+            params.append(f"channels={self.data_channels}")
+        if self.compression is not None:
+            params.append(f"compression={1 if self.compression else 0}")
+        if params:
+            url += "?" + "&".join(params)
+        return url
+
     def join_room(self, room_id, peer_index):
         """Join an existing room with improved reliability and measuring connection times"""
         # Create unique profile directory and window position for this peer
@@ -211,7 +259,7 @@ class WebRTCBenchmark:
         try:
             # Measure connection times for signaling metrics
             conn_start_time = time.time()
-            driver.get(f"{self.base_url}/join-room/{room_id}")
+            driver.get(self.room_url(room_id))
             page_load_time = time.time()
             
             # Wait for room to load
@@ -340,6 +388,12 @@ class WebRTCBenchmark:
             file_input.send_keys(absolute_file_path)
             print("File selected for upload")
             
+            # Ping the sender over the control channel for the whole transfer
+            self.start_control_pings(receiver)
+            # Track main-thread long tasks on both ends
+            self.start_long_task_observer(sender)
+            self.start_long_task_observer(receiver)
+
             # Measure start time
             start_time = time.time()
             
@@ -437,11 +491,20 @@ class WebRTCBenchmark:
                 # Calculate transfer rate
                 transfer_rate = file_size / transfer_time / (1024 * 1024)  # MB/s
                 
-                return {
+                latencies = self.stop_control_pings(receiver)
+                result = {
                     'file_size': file_size,
                     'transfer_time': transfer_time,
-                    'transfer_rate': transfer_rate
+                    'transfer_rate': transfer_rate,
+                    'data_channels': self.data_channels
                 }
+                result['sender_long_task_ms'] = self.collect_long_task_time(sender)
+                result['receiver_long_task_ms'] = self.collect_long_task_time(receiver)
+                if latencies:
+                    latencies.sort()
+                    result['control_latency_avg_ms'] = statistics.mean(latencies)
+                    result['control_latency_p95_ms'] = latencies[int(0.95 * (len(latencies) - 1))]
+                return result
             except Exception as e:
                 print(f"Error during file transfer on receiver side: {e}")
                 return None
@@ -449,6 +512,77 @@ class WebRTCBenchmark:
             print(f"Error during file transfer on sender side: {e}")
             return None
     
+    def collect_connection_timings(self, peers):
+        """Gather each page's time from connection attempt to data channel open"""
+        for driver, peer_id in peers:
+            try:
+                timings = driver.execute_script("return window.getConnectionTimings ? window.getConnectionTimings() : [];")
+            except Exception as e:
+                print(f"Could not read connection timings from {peer_id}: {e}")
+                continue
+            for timing in timings or []:
+                timing['reporter'] = peer_id
+                self.connection_open_results.append(timing)
+
+    def start_control_pings(self, driver, interval_ms=250):
+        """Send ping messages to every connected peer while a transfer runs"""
+        try:
+            driver.execute_script("""
+                clearInterval(window.benchmarkPingTimer);
+                Object.values(peers).forEach(p => { p.latencySamples = []; });
+                window.benchmarkPingTimer = setInterval(() => {
+                    Object.values(peers).forEach(p => {
+                        if (p.connected) {
+                            p.connection.send(JSON.stringify({ type: 'ping', timestamp: Date.now() }));
+                        }
+                    });
+                }, arguments[0]);
+            """, interval_ms)
+        except Exception as e:
+            print(f"Could not start control pings: {e}")
+
+    def stop_control_pings(self, driver):
+        """Stop the ping timer and return the measured round trips in ms"""
+        try:
+            return driver.execute_script("""
+                clearInterval(window.benchmarkPingTimer);
+                return Object.values(peers).flatMap(p => p.latencySamples || []);
+            """) or []
+        except Exception as e:
+            print(f"Could not collect control latencies: {e}")
+            return []
+
+    def start_long_task_observer(self, driver):
+        """Sum the duration of main-thread tasks over 50 ms from now on"""
+        try:
+            driver.execute_script("""
+                if (window.benchmarkLongTaskObserver) {
+                    window.benchmarkLongTaskObserver.disconnect();
+                }
+                window.benchmarkLongTaskTime = 0;
+                window.benchmarkLongTaskObserver = new PerformanceObserver((list) => {
+                    list.getEntries().forEach(entry => {
+                        window.benchmarkLongTaskTime += entry.duration;
+                    });
+                });
+                window.benchmarkLongTaskObserver.observe({ type: 'longtask' });
+            """)
+        except Exception as e:
+            print(f"Could not observe long tasks: {e}")
+
+    def collect_long_task_time(self, driver):
+        """Stop observing and return total long-task time in ms"""
+        try:
+            return driver.execute_script("""
+                if (window.benchmarkLongTaskObserver) {
+                    window.benchmarkLongTaskObserver.disconnect();
+                }
+                return window.benchmarkLongTaskTime || 0;
+            """)
+        except Exception as e:
+            print(f"Could not collect long task time: {e}")
+            return None
+
     def test_reconnection(self, driver, peer_id, room_id):
         """Test reconnection by simulating network interruption"""
         try:
@@ -593,6 +727,7 @@ class WebRTCBenchmark:
         # Wait for all connections to stabilize
         print(f"All peers joined room {room_id}, waiting for connections to stabilize...")
         time.sleep(3)
+        self.collect_connection_timings(peers)
         
         # Test reconnection if requested
         if self.enable_test_reconnection:
@@ -796,18 +931,627 @@ class WebRTCBenchmark:
         total_time = end_time - start_time
         print(f"\n=== Benchmark Completed in {total_time:.2f}s ===")
         self.summarize_results()
+    def run_striping_benchmark(self, channel_counts=(0, 4)):
+        """Compare a single shared channel against striped data channels"""
+        for count in channel_counts:
+            print(f"\n=== Striping test with {count} data channels ===")
+            self.data_channels = count
+            room_id, creator_driver = self.create_room()
+            if not room_id or not creator_driver:
+                print("Skipping striping test due to room creation failure")
+                continue
+            self.results.extend(self.run_benchmark_for_room(room_id))
+            try:
+                creator_driver.quit()
+            except:
+                pass
+
+    def join_peers(self, room_id, count):
+        """Join a room with several browsers in parallel"""
+        joined = []
+        lock = threading.Lock()
+
+        def join(i):
+            driver, peer_id = self.join_room(room_id, i)
+            if driver:
+                with lock:
+                    joined.append((driver, peer_id))
+
+        threads = [threading.Thread(target=join, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return joined
+
+    def run_fanout_benchmark(self, file_size=50*1024*1024):
+        """One sender serving the same file to every other peer at once"""
+        print(f"\n=== Fan-out test: 1 sender, {self.peers_per_room - 1} receivers ===")
+        if file_size not in self.test_files:
+            self.file_sizes.append(file_size)
+            self.test_files = self.create_test_files()
+
+        room_id, creator_driver = self.create_room()
+        if not room_id:
+            return
+        peers = self.join_peers(room_id, self.peers_per_room)
+        try:
+            if len(peers) < 2:
+                print("Not enough peers joined for the fan-out test")
+                return
+            time.sleep(3)
+            sender, _ = peers[0]
+            receivers = peers[1:]
+
+            sender.find_element(By.ID, "fileInput").send_keys(os.path.abspath(self.test_files[file_size]))
+            rates = {}
+
+            def download(driver, peer_id):
+                try:
+                    button = WebDriverWait(driver, 60).until(
+                        EC.element_to_be_clickable((By.CSS_SELECTOR, "ul.file-list button.download-btn"))
+                    )
+                    start = time.time()
+                    button.click()
+                    WebDriverWait(driver, max(120, file_size / (1024 * 1024) * 10)).until(
+                        lambda d: any("Complete" in e.text for e in d.find_elements(By.CSS_SELECTOR, ".file-status"))
+                    )
+                    rates[peer_id] = file_size / (time.time() - start) / (1024 * 1024)
+                except Exception as e:
+                    print(f"Fan-out download failed for {peer_id}: {e}")
+
+            threads = [threading.Thread(target=download, args=receiver) for receiver in receivers]
+            for thread in threads:
+                thread.start()
+
+            # Sample the sender's upload scheduler while the downloads run
+            scheduler_samples = []
+            while any(thread.is_alive() for thread in threads):
+                try:
+                    scheduler_samples.append(sender.execute_script("return window.getSchedulerStats();"))
+                except Exception:
+                    pass
+                time.sleep(1)
+
+            values = list(rates.values())
+            # Jain's fairness index: 1.0 when every receiver got the same rate
+            fairness = (sum(values) ** 2) / (len(values) * sum(v * v for v in values)) if values else 0
+            peak_rate = max((sample['totalRate'] for sample in scheduler_samples if sample), default=0)
+            self.fanout_results.append({
+                'file_size': file_size,
+                'receivers': len(receivers),
+                'completed': len(values),
+                'receiver_rates': rates,
+                'aggregate_rate': sum(values),
+                'fairness_index': fairness,
+                'peak_scheduler_rate': peak_rate / (1024 * 1024),
+                'backpressure_stalls': scheduler_samples[-1]['backpressureStalls'] if scheduler_samples else 0,
+                'retries': scheduler_samples[-1]['retries'] if scheduler_samples else 0
+            })
+        finally:
+            for driver, _ in peers:
+                try:
+                    driver.quit()
+                except:
+                    pass
+            try:
+                creator_driver.quit()
+            except:
+                pass
+
+    def create_corpus_files(self, size):
+        """A compressible text corpus (log lines) and an incompressible one (random bytes)"""
+        corpora = {}
+        text_path = os.path.join(os.getcwd(), f"corpus_logs_{size // (1024*1024)}MB.log")
+        if not os.path.exists(text_path) or os.path.getsize(text_path) != size:
+            print(f"Creating compressible corpus: {text_path}")
+            levels = ["INFO", "DEBUG", "WARNING", "ERROR"]
+            with open(text_path, 'w') as f:
+                written = 0
+                line_no = 0
+                while written < size:
+                    line = (f"2024-01-01 12:{line_no // 60 % 60:02d}:{line_no % 60:02d},{line_no % 1000:03d} - "
+                            f"{random.choice(levels)} - request {line_no} from peer-{random.randint(1, 50)} "
+                            f"took {random.randint(1, 900)}ms status={random.choice([200, 200, 200, 404, 500])}\n")
+                    line = line[:size - written]
+                    f.write(line)
+                    written += len(line)
+                    line_no += 1
+        corpora['compressible'] = text_path
+
+        binary_path = os.path.join(os.getcwd(), f"corpus_random_{size // (1024*1024)}MB.bin")
+        if not os.path.exists(binary_path) or os.path.getsize(binary_path) != size:
+            print(f"Creating incompressible corpus: {binary_path}")
+            with open(binary_path, 'wb') as f:
+                remaining = size
+                while remaining > 0:
+                    write_size = min(10*1024*1024, remaining)
+                    f.write(os.urandom(write_size))
+                    remaining -= write_size
+        corpora['incompressible'] = binary_path
+        return corpora
+
+    def run_compression_benchmark(self, file_size=50*1024*1024, modes=(False, True)):
+        """Effective throughput of compressible and incompressible corpora, with compression off and on"""
+        corpora = self.create_corpus_files(file_size)
+        previous = self.compression
+        for enabled in modes:
+            self.compression = enabled
+            for corpus, path in corpora.items():
+                print(f"\n=== Compression test: {corpus} corpus, compression {'on' if enabled else 'off'} ===")
+                room_id, creator_driver = self.create_room()
+                if not room_id:
+                    continue
+                peers = self.join_peers(room_id, 2)
+                try:
+                    if len(peers) < 2:
+                        print("Not enough peers joined for the compression test")
+                        continue
+                    time.sleep(3)
+                    sender, receiver = peers[0][0], peers[1][0]
+                    result = self.perform_file_transfer(sender, receiver, path, file_size)
+                    if not result:
+                        continue
+                    stats = sender.execute_script("return window.getSchedulerStats();") or {}
+                    bytes_sent = stats.get('bytesSent') or 0
+                    result.update({
+                        'corpus': corpus,
+                        'compression': enabled,
+                        # Payload bytes on the wire per byte of file
+                        'wire_ratio': stats.get('wireBytesSent', 0) / bytes_sent if bytes_sent else None,
+                        'compressed_chunks': stats.get('compressedChunks', 0),
+                        'chunks_sent': stats.get('chunksSent', 0)
+                    })
+                    self.compression_results.append(result)
+                finally:
+                    for driver, _ in peers:
+                        try:
+                            driver.quit()
+                        except:
+                            pass
+                    try:
+                        creator_driver.quit()
+                    except:
+                        pass
+        self.compression = previous
+
+    def create_small_files(self, count, size):
+        """A directory of many small files for the batch transfer test"""
+        directory = os.path.join(os.getcwd(), f"batch_{count}x{size // 1024}KB")
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for i in range(count):
+            path = os.path.join(directory, f"file_{i:05d}.txt")
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                with open(path, 'w') as f:
+                    f.write(''.join(random.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(size)))
+            paths.append(path)
+        return directory, paths
+
+    def run_batch_benchmark(self, count=10000, size=4*1024):
+        """Files/sec for many small files, shared as a folder and fetched with Download all"""
+        directory, paths = self.create_small_files(count, size)
+        for mode in ('folder', 'batch'):
+            print(f"\n=== Batch test: {count} x {size // 1024} KB files as a {mode} ===")
+            room_id, creator_driver = self.create_room()
+            if not room_id:
+                continue
+            peers = self.join_peers(room_id, 2)
+            try:
+                if len(peers) < 2:
+                    print("Not enough peers joined for the batch test")
+                    continue
+                time.sleep(3)
+                sender, receiver = peers[0][0], peers[1][0]
+                timeout = max(300, count / 10)
+
+                if mode == 'folder':
+                    sender.find_element(By.ID, "folderInput").send_keys(directory)
+                    button = WebDriverWait(receiver, timeout).until(
+                        EC.element_to_be_clickable((By.CSS_SELECTOR, "ul.file-list button.download-btn"))
+                    )
+                    start = time.time()
+                    button.click()
+                    WebDriverWait(receiver, timeout).until(
+                        lambda d: any("Complete" in e.text for e in d.find_elements(By.CSS_SELECTOR, ".file-status"))
+                    )
+                else:
+                    sender.find_element(By.ID, "fileInput").send_keys("\n".join(paths))
+                    WebDriverWait(receiver, timeout).until(
+                        lambda d: d.execute_script(
+                            "return Object.values(peers).reduce((n, p) => n + (p.files || []).length, 0);") >= count
+                    )
+                    start = time.time()
+                    receiver.find_element(By.ID, "downloadAllBtn").click()
+                    WebDriverWait(receiver, timeout).until(
+                        lambda d: d.execute_script(
+                            "return Object.values(files).filter(f => f.completeBlob).length;") >= count
+                    )
+                elapsed = time.time() - start
+                self.batch_results.append({
+                    'mode': mode,
+                    'file_count': count,
+                    'file_size': size,
+                    'transfer_time': elapsed,
+                    'files_per_second': count / elapsed,
+                    'transfer_rate': count * size / elapsed / (1024 * 1024)
+                })
+            except Exception as e:
+                print(f"Batch test ({mode}) failed: {e}")
+            finally:
+                for driver, _ in peers:
+                    try:
+                        driver.quit()
+                    except:
+                        pass
+                try:
+                    creator_driver.quit()
+                except:
+                    pass
+
+    def page_cpu_seconds(self, driver):
+        """Main-thread busy time of a page so far, from the DevTools performance metrics"""
+        metrics = driver.execute_cdp_cmd('Performance.getMetrics', {})['metrics']
+        return next((m['value'] for m in metrics if m['name'] == 'TaskDuration'), 0.0)
+
+    def run_topology_benchmark(self, room_sizes=(10, 50, 200), settle=20):
+        """Connection count, join time and per-client CPU as rooms grow past the topology threshold"""
+        for size in room_sizes:
+            print(f"\n=== Topology test: {size} peers ===")
+            room_id, creator_driver = self.create_room()
+            if not room_id:
+                continue
+            start = time.time()
+            peers = self.join_peers(room_id, size)
+            try:
+                if len(peers) < size:
+                    print(f"Only {len(peers)} of {size} peers joined")
+                for driver, _ in peers:
+                    driver.execute_cdp_cmd('Performance.enable', {})
+
+                # Joined once every page holds a connection to each peer it was told to connect to
+                ready_script = ("const s = window.getTopologyStats && window.getTopologyStats();"
+                                "return !!s && s.roomSize > 0 && s.connections >= s.neighbours;")
+                for driver, _ in peers:
+                    WebDriverWait(driver, max(60, size)).until(lambda d: d.execute_script(ready_script))
+                join_time = time.time() - start
+
+                cpu_before = [self.page_cpu_seconds(driver) for driver, _ in peers]
+                time.sleep(settle)
+                cpu_after = [self.page_cpu_seconds(driver) for driver, _ in peers]
+                cpu = [(after - before) / settle * 100 for before, after in zip(cpu_before, cpu_after)]
+
+                stats = [driver.execute_script("return window.getTopologyStats();") for driver, _ in peers]
+                connections = [stat['connections'] for stat in stats]
+                with urllib.request.urlopen(f"{self.base_url}/status") as response:
+                    status = json.load(response)
+                self.topology_results.append({
+                    'room_size': size,
+                    'joined': len(peers),
+                    'planned': any(stat['planned'] for stat in stats),
+                    'join_time': join_time,
+                    'connections_avg': statistics.mean(connections),
+                    'connections_max': max(connections),
+                    'server_peer_connections': status.get('peer_connections_count'),
+                    'cpu_percent_avg': statistics.mean(cpu),
+                    'cpu_percent_p95': percentile(cpu, 0.95)
+                })
+                self.collect_connection_timings(peers)
+            except Exception as e:
+                print(f"Topology test ({size} peers) failed: {e}")
+            finally:
+                for driver, _ in peers:
+                    try:
+                        driver.quit()
+                    except:
+                        pass
+                try:
+                    creator_driver.quit()
+                except:
+                    pass
+
+    def server_rss_mb(self):
+        """Resident memory of the server process, from /proc (None if unknown)"""
+        if not self.server_pid:
+            return None
+        try:
+            with open(f"/proc/{self.server_pid}/status") as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except OSError:
+            return None
+        return None
+
+    async def relay_stream(self, room_id, stream_bytes, frame_size, window):
+        """One sender pushing stream_bytes through the relay to one receiver; returns MB/s"""
+        import socketio
+
+        async def join(client):
+            registered = asyncio.get_running_loop().create_future()
+            client.on('registered', lambda data: registered.done() or registered.set_result(data))
+            await client.connect(self.base_url, namespaces=['/', '/relay'])
+            await client.emit('join_room', {'room_id': room_id, 'peer_id': None})
+            data = await asyncio.wait_for(registered, 30)
+            peer_id = data['peer_id']
+            reply = await client.call('relay_join', {'room_id': room_id, 'peer_id': peer_id,
+                                                     'token': data['relay_token']}, namespace='/relay')
+            if not reply.get('ok'):
+                raise RuntimeError(f"relay_join failed: {reply}")
+            return peer_id
+
+        sender, receiver = socketio.AsyncClient(), socketio.AsyncClient()
+        received = {'bytes': 0}
+        done = asyncio.get_running_loop().create_future()
+
+        def on_frame(from_peer, frame):
+            received['bytes'] += len(frame)
+            if received['bytes'] >= stream_bytes and not done.done():
+                done.set_result(time.time())
+            return True
+
+        receiver.on('relay_frame', on_frame, namespace='/relay')
+        try:
+            await join(sender)
+            receiver_id = await join(receiver)
+            frame = os.urandom(frame_size)
+            credit = asyncio.Semaphore(max(1, window // frame_size))
+            failures = []
+
+            def acked(reply):
+                credit.release()
+                if not reply.get('ok'):
+                    failures.append(reply.get('reason'))
+
+            start = time.time()
+            for _ in range(0, stream_bytes, frame_size):
+                await credit.acquire()
+                if failures:
+                    raise RuntimeError(f"relay refused frame: {failures[0]}")
+                await sender.emit('relay_frame', (receiver_id, frame), namespace='/relay', callback=acked)
+            finished = await asyncio.wait_for(done, 300)
+            return stream_bytes / (finished - start) / (1024 * 1024)
+        finally:
+            await sender.disconnect()
+            await receiver.disconnect()
+
+    async def relay_load(self, streams, stream_bytes, frame_size, window):
+        room_id = json.load(urllib.request.urlopen(urllib.request.Request(f"{self.base_url}/create-room", method='POST')))['room_id']
+        peak_rss = [self.server_rss_mb()]
+
+        async def sample_rss():
+            while True:
+                peak_rss.append(self.server_rss_mb())
+                await asyncio.sleep(0.5)
+
+        sampler = asyncio.create_task(sample_rss())
+        start = time.time()
+        try:
+            rates = await asyncio.gather(
+                *[self.relay_stream(room_id, stream_bytes, frame_size, window) for _ in range(streams)],
+                return_exceptions=True)
+        finally:
+            sampler.cancel()
+        elapsed = time.time() - start
+        ok = [rate for rate in rates if not isinstance(rate, Exception)]
+        for error in (rate for rate in rates if isinstance(rate, Exception)):
+            print(f"Relay stream failed: {error}")
+        rss = [value for value in peak_rss if value is not None]
+        return {
+            'streams': streams,
+            'completed': len(ok),
+            'stream_mb': stream_bytes / (1024 * 1024),
+            'per_stream_rate_avg': statistics.mean(ok) if ok else 0,
+            'aggregate_rate': len(ok) * stream_bytes / elapsed / (1024 * 1024),
+            'rss_start_mb': rss[0] if rss else None,
+            'rss_peak_mb': max(rss) if rss else None
+        }
+
+    def run_relay_benchmark(self, stream_counts=(1, 10, 50), stream_bytes=20*1024*1024,
+                            frame_size=16*1024, window=1024*1024):
+        """Concurrent relay streams without browsers: throughput and server memory"""
+        for streams in stream_counts:
+            print(f"\n=== Relay test: {streams} concurrent streams of {stream_bytes // (1024 * 1024)} MB ===")
+            try:
+                self.relay_results.append(asyncio.run(self.relay_load(streams, stream_bytes, frame_size, window)))
+            except Exception as e:
+                print(f"Relay test ({streams} streams) failed: {e}")
+
+    def start_server(self, env, port, launcher=False):
+        """A server of our own from the repository root, with its log written to a file.
+        launcher runs `python main.py`, which picks uvicorn's loop and parser from SERVER_PROFILE"""
+        log = tempfile.NamedTemporaryFile(prefix='p2p-server-', suffix='.log', delete=False)
+        command = ([sys.executable, 'main.py'] if launcher else
+                   [sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(port), '--log-level', 'warning'])
+        process = subprocess.Popen(
+            command, cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            env={**os.environ, 'HOST': '127.0.0.1', 'PORT': str(port), **env}, stdout=log, stderr=subprocess.STDOUT)
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            try:
+                urllib.request.urlopen(f"http://localhost:{port}/status", timeout=1)
+                return process, log.name
+            except OSError:
+                time.sleep(0.2)
+        process.terminate()
+        raise RuntimeError(f"Server with {env} did not start; see {log.name}")
+
+    async def signal_stream(self, base_url, room_id, count, latencies):
+        """One client relaying count candidate signals to another through the server"""
+        import socketio
+
+        async def join(client, peer_id):
+            registered = asyncio.get_running_loop().create_future()
+            client.on('registered', lambda data: registered.done() or registered.set_result(data['peer_id']))
+            await client.connect(base_url)
+            await client.emit('join_room', {'room_id': room_id, 'peer_id': peer_id})
+            return await asyncio.wait_for(registered, 30)
+
+        sender, receiver = socketio.AsyncClient(), socketio.AsyncClient()
+        received = {'count': 0}
+        done = asyncio.get_running_loop().create_future()
+
+        def on_signal(data):
+            latencies.append((time.perf_counter() - data['signal']['sent']) * 1000)
+            received['count'] += 1
+            if received['count'] == count and not done.done():
+                done.set_result(time.perf_counter())
+
+        receiver.on('signal', on_signal)
+        try:
+            sender_id = await join(sender, None)
+            receiver_id = await join(receiver, None)
+            for i in range(count):
+                await sender.emit('signal', {'room_id': room_id, 'from': sender_id, 'to': receiver_id, 'signal': {
+                    'type': 'candidate',
+                    'candidate': {'candidate': f"candidate:{i} 1 udp 2122260223 192.168.1.{i % 250} {50000 + i % 10000} typ host",
+                                  'sdpMid': '0', 'sdpMLineIndex': 0},
+                    'sent': time.perf_counter()
+                }})
+            await asyncio.wait_for(done, 300)
+        finally:
+            await sender.disconnect()
+            await receiver.disconnect()
+
+    async def signal_load(self, base_url, pairs, count):
+        room_id = json.load(urllib.request.urlopen(urllib.request.Request(f"{base_url}/create-room", method='POST')))['room_id']
+        latencies = []
+        start = time.perf_counter()
+        await asyncio.gather(*[self.signal_stream(base_url, room_id, count, latencies) for _ in range(pairs)])
+        return pairs * count / (time.perf_counter() - start), latencies
+
+    def run_logging_benchmark(self, pairs=4, signals=5000, port=5099, configs=None):
+        """Signal relay throughput on servers started with logging off, synchronous and queued"""
+        configs = configs or [
+            ('off', {'LOG_LEVEL': 'WARNING'}),
+            ('sync', {'LOG_MODE': 'sync'}),
+            ('queue', {'LOG_MODE': 'queue'}),
+            ('queue, json', {'LOG_MODE': 'queue', 'LOG_FORMAT': 'json'}),
+            ('queue, json, signal sampled 1%', {'LOG_MODE': 'queue', 'LOG_FORMAT': 'json', 'LOG_SAMPLE': 'signal=0.01'})
+        ]
+        for label, env in configs:
+            print(f"\n=== Logging test: {label}, {pairs} pairs x {signals} signals ===")
+            process, log_path = self.start_server(env, port)
+            base_url = f"http://localhost:{port}"
+            try:
+                rate, latencies = asyncio.run(self.signal_load(base_url, pairs, signals))
+                status = json.load(urllib.request.urlopen(f"{base_url}/status"))
+                self.logging_results.append({
+                    'logging': label,
+                    'signals': pairs * signals,
+                    'signals_per_second': rate,
+                    'latency_p50_ms': percentile(latencies, 0.5),
+                    'latency_p95_ms': percentile(latencies, 0.95),
+                    'log_records_dropped': status.get('log_records_dropped', 0),
+                    'log_bytes': os.path.getsize(log_path)
+                })
+            except Exception as e:
+                print(f"Logging test ({label}) failed: {e}")
+            finally:
+                process.terminate()
+                process.wait(10)
+                os.remove(log_path)
+
+    def run_profile_benchmark(self, pairs=4, signals=5000, port=5099, profiles=('standard', 'performance')):
+        """Signal relay events/sec and latency for each SERVER_PROFILE, logging quieted so it doesn't dominate"""
+        for profile in profiles:
+            print(f"\n=== Server profile test: {profile}, {pairs} pairs x {signals} signals ===")
+            process, log_path = self.start_server({'SERVER_PROFILE': profile, 'LOG_LEVEL': 'WARNING'}, port, launcher=True)
+            try:
+                rate, latencies = asyncio.run(self.signal_load(f"http://localhost:{port}", pairs, signals))
+                self.profile_results.append({
+                    'profile': profile,
+                    'events': pairs * signals,
+                    'events_per_second': rate,
+                    'latency_p50_ms': percentile(latencies, 0.5),
+                    'latency_p99_ms': percentile(latencies, 0.99)
+                })
+            except Exception as e:
+                print(f"Server profile test ({profile}) failed: {e}")
+            finally:
+                process.terminate()
+                process.wait(10)
+                os.remove(log_path)
+
+    def collect_metrics(self):
+        """Summary statistics per named metric, tagged with the kind of regression threshold that applies"""
+        metrics = {}
+
+        def add(name, kind, values):
+            values = [value for value in values if value is not None]
+            if values:
+                metrics[name] = {'kind': kind, **describe(values)}
+
+        add('connection.page_load_s', 'connection', [r['page_load_latency'] for r in self.connection_results])
+        add('connection.signaling_s', 'connection', [r['signaling_latency'] for r in self.connection_results])
+        add('connection.connection_time_s', 'connection', [r['connection_time'] for r in self.connection_results])
+        add('connection.data_channel_open_ms', 'connection', [r['setupMs'] for r in self.connection_open_results])
+        for size in self.file_sizes:
+            add(f"transfer.{size // 1024}KB.rate_mbps", 'throughput',
+                [r['transfer_rate'] for r in self.results if r['file_size'] == size])
+        add('reconnection.time_ms', 'reconnection',
+            [r['reconnection_time_ms'] for r in self.reconnection_results if r['reconnection_success']])
+        add('signaling.create_room_s', 'latency',
+            [r['signaling_latency'] for r in self.signaling_results if r['operation'] == 'create_room'])
+        add('fanout.aggregate_mbps', 'throughput', [r['aggregate_rate'] for r in self.fanout_results])
+        for corpus in ('compressible', 'incompressible'):
+            for enabled in (False, True):
+                add(f"compression.{corpus}.{'on' if enabled else 'off'}.rate_mbps", 'throughput',
+                    [r['transfer_rate'] for r in self.compression_results
+                     if r['corpus'] == corpus and r['compression'] == enabled])
+        for mode in sorted({r['mode'] for r in self.batch_results}):
+            add(f"batch.{mode}.files_per_second", 'throughput',
+                [r['files_per_second'] for r in self.batch_results if r['mode'] == mode])
+        for size in sorted({r['room_size'] for r in self.topology_results}):
+            add(f"topology.{size}_peers.join_time_s", 'connection',
+                [r['join_time'] for r in self.topology_results if r['room_size'] == size])
+        for streams in sorted({r['streams'] for r in self.relay_results}):
+            add(f"relay.{streams}_streams.aggregate_mbps", 'throughput',
+                [r['aggregate_rate'] for r in self.relay_results if r['streams'] == streams])
+        for label in sorted({r['logging'] for r in self.logging_results}):
+            matching = [r for r in self.logging_results if r['logging'] == label]
+            add(f"logging.{label}.signals_per_second", 'throughput', [r['signals_per_second'] for r in matching])
+            add(f"logging.{label}.latency_p95_ms", 'latency', [r['latency_p95_ms'] for r in matching])
+        for profile in sorted({r['profile'] for r in self.profile_results}):
+            matching = [r for r in self.profile_results if r['profile'] == profile]
+            add(f"profile.{profile}.events_per_second", 'throughput', [r['events_per_second'] for r in matching])
+            add(f"profile.{profile}.latency_p99_ms", 'latency', [r['latency_p99_ms'] for r in matching])
+        return metrics
+
+    def save_run(self, results_dir, options):
+        """Write this run (metadata, per-metric statistics and every raw result) to a new file in the store"""
+        return save_run(results_dir, self.collect_metrics(), {
+            'transfers': self.results,
+            'connections': self.connection_results,
+            'connection_open': self.connection_open_results,
+            'reconnections': self.reconnection_results,
+            'signaling': self.signaling_results,
+            'fanout': self.fanout_results,
+            'compression': self.compression_results,
+            'batch': self.batch_results,
+            'topology': self.topology_results,
+            'relay': self.relay_results,
+            'logging': self.logging_results,
+            'profiles': self.profile_results
+        }, options)
+
     def summarize_results(self):
         """Summarize and display benchmark results"""
         print("\n=== Benchmark Results Summary ===")
         # Connection Metrics
-        if self.connection_results:
+        if self.connection_results or self.connection_open_results:
             print("\n--- Connection Metrics ---")
-            avg_page_load_latency = statistics.mean([r['page_load_latency'] for r in self.connection_results])
-            avg_signaling_latency = statistics.mean([r['signaling_latency'] for r in self.connection_results])
-            avg_connection_time = statistics.mean([r['connection_time'] for r in self.connection_results])
-            print(f"- Avg Page Load Latency: {avg_page_load_latency:.2f}s")
-            print(f"- Avg Signaling Latency: {avg_signaling_latency:.2f}s")
-            print(f"- Avg Connection Time: {avg_connection_time:.2f}s")
+        if self.connection_results:
+            print(f"- Page Load Latency: {format_stats(describe([r['page_load_latency'] for r in self.connection_results]), 's')}")
+            print(f"- Signaling Latency: {format_stats(describe([r['signaling_latency'] for r in self.connection_results]), 's')}")
+            print(f"- Connection Time: {format_stats(describe([r['connection_time'] for r in self.connection_results]), 's')}")
+        if self.connection_open_results:
+            setup = [r['setupMs'] for r in self.connection_open_results]
+            since_load = [r['sincePageLoadMs'] for r in self.connection_open_results]
+            retried = sum(1 for r in self.connection_open_results if r.get('attempts', 1) > 1)
+            print(f"- Time to Data Channel Open: p50 {percentile(setup, 0.5):.0f}ms, p95 {percentile(setup, 0.95):.0f}ms "
+                  f"({len(setup)} connections, {retried} needed a retry)")
+            print(f"- Page Load to Data Channel Open: p50 {percentile(since_load, 0.5):.0f}ms, p95 {percentile(since_load, 0.95):.0f}ms")
         # File Transfer Metrics
         if self.results:
             print("\n--- File Transfer Metrics ---")
@@ -815,16 +1559,91 @@ class WebRTCBenchmark:
                 size_label = f"{size/1024/1024:.2f} MB" if size >= 1024*1024 else f"{size/1024:.2f} KB"
                 size_results = [r for r in self.results if r['file_size'] == size]
                 if size_results:
-                    avg_transfer_rate = statistics.mean([r['transfer_rate'] for r in size_results])
-                    success_count = len(size_results)
-                    print(f"- File Size: {size_label}, Avg Transfer Rate: {avg_transfer_rate:.2f} MB/s, Successes: {success_count}")
+                    rates = describe([r['transfer_rate'] for r in size_results])
+                    print(f"- File Size: {size_label}, Transfer Rate: {format_stats(rates, ' MB/s')}")
+                    long_task_results = [r for r in size_results if r.get('sender_long_task_ms') is not None and r.get('receiver_long_task_ms') is not None]
+                    if long_task_results:
+                        sender_long_tasks = statistics.mean([r['sender_long_task_ms'] for r in long_task_results])
+                        receiver_long_tasks = statistics.mean([r['receiver_long_task_ms'] for r in long_task_results])
+                        print(f"    Main-thread long tasks: sender {sender_long_tasks:.0f}ms, receiver {receiver_long_tasks:.0f}ms")
+                for count in sorted({r.get('data_channels') for r in size_results if r.get('data_channels') is not None}):
+                    channel_results = [r for r in size_results if r.get('data_channels') == count]
+                    rate = statistics.mean([r['transfer_rate'] for r in channel_results])
+                    latency_results = [r for r in channel_results if 'control_latency_avg_ms' in r]
+                    latency = ""
+                    if latency_results:
+                        avg_latency = statistics.mean([r['control_latency_avg_ms'] for r in latency_results])
+                        p95_latency = max(r['control_latency_p95_ms'] for r in latency_results)
+                        latency = f", Control Latency: {avg_latency:.1f}ms avg / {p95_latency:.1f}ms p95"
+                    print(f"    {count} data channels: {rate:.2f} MB/s{latency}")
+        # Fan-out / upload scheduler metrics
+        if self.fanout_results:
+            print("\n--- Fan-out Metrics ---")
+            for result in self.fanout_results:
+                print(f"- {result['completed']}/{result['receivers']} receivers, Aggregate: {result['aggregate_rate']:.2f} MB/s, "
+                      f"Fairness: {result['fairness_index']:.3f}, Peak scheduler rate: {result['peak_scheduler_rate']:.2f} MB/s, "
+                      f"Backpressure stalls: {result['backpressure_stalls']}, Retries: {result['retries']}")
+        # Compression metrics
+        if self.compression_results:
+            print("\n--- Compression Metrics ---")
+            for corpus in ('compressible', 'incompressible'):
+                for enabled in (False, True):
+                    matching = [r for r in self.compression_results
+                                if r['corpus'] == corpus and r['compression'] == enabled]
+                    if not matching:
+                        continue
+                    rate = statistics.mean([r['transfer_rate'] for r in matching])
+                    ratios = [r['wire_ratio'] for r in matching if r['wire_ratio'] is not None]
+                    ratio = f", Wire/File: {statistics.mean(ratios):.2f}" if ratios else ""
+                    compressed = sum(r['compressed_chunks'] for r in matching)
+                    total = sum(r['chunks_sent'] for r in matching)
+                    print(f"- {corpus.capitalize()} corpus, compression {'on' if enabled else 'off'}: "
+                          f"Effective Throughput: {rate:.2f} MB/s{ratio}, Compressed chunks: {compressed}/{total}")
+        # Batch transfer metrics
+        if self.batch_results:
+            print("\n--- Batch Transfer Metrics ---")
+            for result in self.batch_results:
+                print(f"- {result['file_count']} x {result['file_size'] // 1024} KB as a {result['mode']}: "
+                      f"{result['files_per_second']:.0f} files/s, {result['transfer_rate']:.2f} MB/s, "
+                      f"{result['transfer_time']:.2f}s")
+        # Topology metrics
+        if self.topology_results:
+            print("\n--- Topology Metrics ---")
+            for result in self.topology_results:
+                print(f"- {result['room_size']} peers ({'planned' if result['planned'] else 'full mesh'}): "
+                      f"Join Time: {result['join_time']:.2f}s, Connections/Client: {result['connections_avg']:.1f} "
+                      f"(max {result['connections_max']}), Room Connections: {result['server_peer_connections']}, "
+                      f"Idle CPU/Client: {result['cpu_percent_avg']:.1f}% (p95 {result['cpu_percent_p95']:.1f}%)")
+        # Relay metrics
+        if self.relay_results:
+            print("\n--- Relay Metrics ---")
+            for result in self.relay_results:
+                rss = (f", Server RSS: {result['rss_start_mb']:.0f} -> {result['rss_peak_mb']:.0f} MB peak"
+                       if result['rss_peak_mb'] is not None else "")
+                print(f"- {result['streams']} streams ({result['completed']} completed): "
+                      f"{result['per_stream_rate_avg']:.2f} MB/s per stream, "
+                      f"{result['aggregate_rate']:.2f} MB/s total{rss}")
+        # Logging metrics
+        if self.logging_results:
+            print("\n--- Logging Metrics ---")
+            for result in self.logging_results:
+                print(f"- Logging {result['logging']}: {result['signals_per_second']:.0f} signals/s, "
+                      f"Relay Latency: p50 {result['latency_p50_ms']:.1f}ms / p95 {result['latency_p95_ms']:.1f}ms, "
+                      f"Log: {result['log_bytes'] / 1024:.0f} KB, Dropped: {result['log_records_dropped']}")
+        # Server profile metrics
+        if self.profile_results:
+            print("\n--- Server Profile Metrics ---")
+            for result in self.profile_results:
+                print(f"- {result['profile'].capitalize()} profile: {result['events_per_second']:.0f} events/s, "
+                      f"Relay Latency: p50 {result['latency_p50_ms']:.1f}ms / p99 {result['latency_p99_ms']:.1f}ms")
         # Reconnection Metrics
         if self.reconnection_results:
             print("\n--- Reconnection Metrics ---")
             success_reconnections = [r for r in self.reconnection_results if r['reconnection_success']]
-            avg_reconnection_time = statistics.mean([r['reconnection_time_ms'] for r in success_reconnections]) if success_reconnections else 0
             success_rate = (len(success_reconnections) / len(self.reconnection_results)) * 100 if self.reconnection_results else 0
-            print(f"- Avg Reconnection Time: {avg_reconnection_time:.2f}ms")
+            if success_reconnections:
+                times = describe([r['reconnection_time_ms'] for r in success_reconnections])
+                print(f"- Reconnection Time: {format_stats(times, 'ms', 0)}")
             print(f"- Reconnection Success Rate: {success_rate:.2f}%")
         # Signaling Metrics
         if self.signaling_results:
@@ -845,7 +1664,39 @@ if __name__ == "__main__":
     parser.add_argument("--test-reconnection", action="store_true", help="Test reconnection logic")
     parser.add_argument("--test-large-files", action="store_true", help="Include large file transfer tests (up to 2GB)")
     parser.add_argument("--test-signaling", action="store_true", help="Test signaling server latency")
+    parser.add_argument("--data-channels", type=int, default=None, help="Striped data channels per peer (0 = single shared channel)")
+    parser.add_argument("--test-striping", action="store_true", help="Compare 500 MB transfers over one channel and striped channels")
+    parser.add_argument("--test-fanout", action="store_true", help="One sender serving a file to every other peer at once")
+    parser.add_argument("--no-compression", action="store_true", help="Disable chunk compression on the room pages")
+    parser.add_argument("--test-compression", action="store_true", help="Compare compressible and incompressible corpora with compression off and on")
+    parser.add_argument("--test-batch", action="store_true", help="Files/sec for 10k x 4 KB files sent as a folder and as a batch")
+    parser.add_argument("--test-topology", action="store_true", help="Connections, join time and CPU per client in 10, 50 and 200 peer rooms")
+    parser.add_argument("--test-relay", action="store_true", help="Concurrent streams through the server relay, without browsers")
+    parser.add_argument("--server-pid", type=int, default=None, help="Server process ID, to report its memory during the relay test")
+    parser.add_argument("--test-logging", action="store_true", help="Signal relay throughput on local servers with logging off, synchronous and queued")
+    parser.add_argument("--test-profiles", action="store_true", help="Events/sec and p99 relay latency on local servers in the standard and performance profiles")
+    parser.add_argument("--results-dir", type=str, default="benchmark_results", help="Directory of stored runs, one JSON file per run")
+    parser.add_argument("--save-baseline", type=str, metavar="NAME", help="Also save this run as the named baseline")
+    parser.add_argument("--compare", type=str, metavar="BASELINE", help="Compare medians against a baseline (name or path); exit 1 on regressions")
+    parser.add_argument("--run", type=str, metavar="PATH", help="With --compare: compare this stored run instead of running benchmarks")
+    parser.add_argument("--max-throughput-drop", type=float, default=METRIC_KINDS['throughput']['threshold'], help="Percent drop in a throughput median counted as a regression")
+    parser.add_argument("--max-connection-increase", type=float, default=METRIC_KINDS['connection']['threshold'], help="Percent rise in a connection time median counted as a regression")
+    parser.add_argument("--max-reconnection-increase", type=float, default=METRIC_KINDS['reconnection']['threshold'], help="Percent rise in the reconnection time median counted as a regression")
+    parser.add_argument("--max-latency-increase", type=float, default=METRIC_KINDS['latency']['threshold'], help="Percent rise in other latency medians counted as a regression")
     args = parser.parse_args()
+    thresholds = {
+        'throughput': args.max_throughput_drop,
+        'connection': args.max_connection_increase,
+        'reconnection': args.max_reconnection_increase,
+        'latency': args.max_latency_increase
+    }
+
+    # Compare two stored runs without running anything
+    if args.run:
+        if not args.compare:
+            parser.error("--run needs --compare")
+        regressions = compare_runs(load_run(args.run, args.results_dir), load_run(args.compare, args.results_dir), thresholds)
+        sys.exit(1 if regressions else 0)
 
     # Initialize the benchmark suite
     benchmark = WebRTCBenchmark(
@@ -856,13 +1707,43 @@ if __name__ == "__main__":
         headless=args.headless,
         test_reconnection=args.test_reconnection,
         test_large_files=args.test_large_files,
-        test_signaling=args.test_signaling
+        test_signaling=args.test_signaling,
+        data_channels=args.data_channels,
+        test_striping=args.test_striping,
+        test_fanout=args.test_fanout,
+        compression=False if args.no_compression else None,
+        test_compression=args.test_compression,
+        test_batch=args.test_batch,
+        test_topology=args.test_topology,
+        test_relay=args.test_relay,
+        server_pid=args.server_pid,
+        test_logging=args.test_logging,
+        test_profiles=args.test_profiles
     )
 
     # Run the full benchmark suite
     try:
         print("\n=== Starting WebRTC Benchmark Suite ===")
-        benchmark.run_benchmark()
+        if args.test_striping or args.test_fanout or args.test_compression or args.test_batch or args.test_topology or args.test_relay or args.test_logging or args.test_profiles:
+            if args.test_striping:
+                benchmark.run_striping_benchmark()
+            if args.test_fanout:
+                benchmark.run_fanout_benchmark()
+            if args.test_compression:
+                benchmark.run_compression_benchmark()
+            if args.test_batch:
+                benchmark.run_batch_benchmark()
+            if args.test_topology:
+                benchmark.run_topology_benchmark()
+            if args.test_relay:
+                benchmark.run_relay_benchmark()
+            if args.test_logging:
+                benchmark.run_logging_benchmark()
+            if args.test_profiles:
+                benchmark.run_profile_benchmark()
+            benchmark.summarize_results()
+        else:
+            benchmark.run_benchmark()
     except KeyboardInterrupt:
         print("\nBenchmark interrupted by user.")
     finally:
@@ -871,5 +1752,11 @@ if __name__ == "__main__":
         for result in benchmark.results:
             print(f"Result: {result}")
         print("\n=== Benchmark Completed ===")
-        with open("benchmark_results.json", "w") as f:
-            json.dump(benchmark.results, f, indent=4)
+        run, path = benchmark.save_run(args.results_dir, vars(args))
+        print(f"Results saved to {path}")
+        if args.save_baseline:
+            save_baseline(args.results_dir, path, args.save_baseline)
+
+    if args.compare:
+        regressions = compare_runs(run, load_run(args.compare, args.results_dir), thresholds)
+        sys.exit(1 if regressions else 0)
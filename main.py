@@ -1,65 +1,447 @@
-from fastapi import FastAPI, Request
+from fastapi import FastAPI, Request, Response, HTTPException
 from fastapi.responses import HTMLResponse
 from fastapi.templating import Jinja2Templates
-from fastapi.staticfiles import StaticFiles
-from socketio import AsyncServer, ASGIApp
+from socketio import AsyncServer, ASGIApp, AsyncClient
 import os
 import uuid
 import json
 import logging
+import logging.handlers
+import queue
 import time
 import asyncio
 import random
 import threading
-import requests
+import secrets
+import aiohttp
+import re
+import html
+import gzip
+import hashlib
+import mimetypes
+import sys
+import hmac
+import copy
+import functools
+import collections
+import bisect
+import math
 
-app = FastAPI()
-sio = AsyncServer(async_mode='asgi', cors_allowed_origins="*")
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# SERVER_PROFILE=performance swaps in faster implementations where they are
+# installed: orjson for Socket.IO packets, rooms.json and JSON responses,
+# and uvloop and httptools when the server is started with `python main.py`.
+# Anything missing falls back to the standard library.
+SERVER_PROFILE = os.environ.get('SERVER_PROFILE', 'standard')
+
+class OrjsonCodec:
+    """The dumps/loads module interface Socket.IO and persistence use, backed by orjson"""
+
+    @staticmethod
+    def dumps(obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    @staticmethod
+    def loads(data, **kwargs):
+        return orjson.loads(data)
+
+class OrjsonResponse(Response):
+    media_type = 'application/json'
+
+    def render(self, content):
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+fast_json = OrjsonCodec if SERVER_PROFILE == 'performance' and orjson else None
+json_codec = fast_json or json
+
+app = FastAPI(default_response_class=OrjsonResponse) if fast_json else FastAPI()
+# Peer liveness comes from Engine.IO's own ping/pong: a client that stops
+# answering pings is dropped after PING_INTERVAL + PING_TIMEOUT seconds and
+# its `disconnect` handler takes it out of its room. The app-level heartbeat
+# is optional; with HEARTBEAT_INTERVAL > 0 clients are told to send one that
+# often. Peers without a connected socket, like those restored from
+# ROOMS_FILE after a restart, expire PEER_TIMEOUT seconds after last seen.
+PING_INTERVAL = int(os.environ.get('PING_INTERVAL', 25))
+PING_TIMEOUT = int(os.environ.get('PING_TIMEOUT', 20))
+HEARTBEAT_INTERVAL = int(os.environ.get('HEARTBEAT_INTERVAL', 0))
+PEER_TIMEOUT = int(os.environ.get('PEER_TIMEOUT', 30))
+
+# None keeps engine.io's own json wrapper
+sio = AsyncServer(async_mode='asgi', cors_allowed_origins="*", json=fast_json,
+                  ping_interval=PING_INTERVAL, ping_timeout=PING_TIMEOUT)
 socket_app = ASGIApp(sio)
 
-# Mount static files and templates
-app.mount("/static", StaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[logging.StreamHandler()]
-)
+# Logging. LOG_MODE=queue takes formatting and writing off the event loop:
+# records go onto a bounded queue drained by a background thread and are
+# dropped, and counted, when it is full. LOG_FORMAT=json writes one object
+# per line including the structured fields passed in `extra`. Records
+# tagged with an event can be sampled (LOG_SAMPLE="signal=0.01,connect=0.1")
+# and rate limited (LOG_RATE_LIMIT records per event per second) in either
+# mode; warnings and errors are rate limited but never sampled.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_MODE = os.environ.get('LOG_MODE', 'sync')
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_FLUSH_INTERVAL = 0.05
+LOG_RATE_LIMIT = int(os.environ.get('LOG_RATE_LIMIT', 0))
+
+# "event:reason" -> records dropped
+log_dropped = collections.Counter()
+
+def parse_sample_rates(value):
+    rates = {}
+    for item in filter(None, (part.strip() for part in value.split(','))):
+        event, _, rate = item.partition('=')
+        try:
+            rates[event.strip()] = min(max(float(rate), 0.0), 1.0)
+        except ValueError:
+            print(f"Ignoring invalid LOG_SAMPLE entry: {item}", file=sys.stderr)
+    return rates
+
+class JsonFormatter(logging.Formatter):
+    STANDARD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.STANDARD_FIELDS)
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class EventSampler(logging.Filter):
+    """Sample and rate limit records carrying an `event` field"""
+
+    def __init__(self, rates, limit):
+        super().__init__()
+        self.rates = rates
+        self.limit = limit
+        # Event -> [second, records let through in it]
+        self.windows = {}
+
+    def filter(self, record):
+        event = getattr(record, 'event', None)
+        if event is None:
+            return True
+        rate = self.rates.get(event, 1.0)
+        if rate < 1.0 and record.levelno < logging.WARNING:
+            if random.random() >= rate:
+                log_dropped[f"{event}:sampled"] += 1
+                return False
+            # Lets a reader scale counts back up
+            record.sample_rate = rate
+        if self.limit:
+            second = int(time.monotonic())
+            window = self.windows.get(event)
+            if window is None or window[0] != second:
+                window = self.windows[event] = [second, 0]
+            if window[1] >= self.limit:
+                log_dropped[f"{event}:rate_limited"] += 1
+                return False
+            window[1] += 1
+        return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Appends to a deque the listener polls, so logging a record never wakes a
+    thread or blocks the event loop; past LOG_QUEUE_SIZE records are dropped"""
+
+    def enqueue(self, record):
+        if len(self.queue) >= LOG_QUEUE_SIZE:
+            log_dropped['queue:full'] += 1
+        else:
+            self.queue.append(record)
+
+class PollingQueueListener(logging.handlers.QueueListener):
+    """Drains the deque every LOG_FLUSH_INTERVAL rather than being signalled per record"""
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.popleft()
+            except IndexError:
+                if not block:
+                    raise queue.Empty
+                time.sleep(LOG_FLUSH_INTERVAL)
+
+    def enqueue_sentinel(self):
+        self.queue.append(self._sentinel)
+
+def setup_logging():
+    """Configure the root logger; returns the QueueListener to stop at shutdown, if any"""
+    output = logging.StreamHandler()
+    output.setFormatter(JsonFormatter() if LOG_FORMAT == 'json'
+                        else logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    listener = None
+    handler = output
+    if LOG_MODE == 'queue':
+        handler = DroppingQueueHandler(collections.deque())
+        # prepare() bakes the message into the record; the listener's formatter adds the rest
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        listener = PollingQueueListener(handler.queue, output)
+        listener.start()
+    handler.addFilter(EventSampler(parse_sample_rates(os.environ.get('LOG_SAMPLE', '')), LOG_RATE_LIMIT))
+    logging.basicConfig(level=LOG_LEVEL, handlers=[handler])
+    return listener
+
+def stop_logging():
+    if log_listener:
+        log_listener.stop()
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
 # Dictionary to store active rooms
 rooms = {}
+# Connected members: socket ID -> (room ID, that peer's entry in peer_data)
+peer_sockets = {}
 ROOMS_FILE = 'rooms.json'
 
-def keep_alive():
-    """
-    Pings the status endpoint every 14 minutes to keep the service alive.
-    Runs in a separate thread to avoid blocking the main event loop.
-    """
-    logger.info("Keep-alive thread function started")
-    url = "https://p2p-80my.onrender.com/status"
-    while True:
+# ICE servers handed to clients. ICE_SERVERS may hold a JSON list in
+# RTCIceServer form, e.g. to add a TURN server, without touching the client.
+DEFAULT_ICE_SERVERS = [
+    {"urls": ["stun:stun.l.google.com:19302", "stun:global.stun.twilio.com:3478"]}
+]
+
+def load_ice_config():
+    ice_servers = DEFAULT_ICE_SERVERS
+    if os.environ.get('ICE_SERVERS'):
         try:
-            logger.info("Sending keep-alive ping...")
-            response = requests.get(url, timeout=10)
-            logger.info(f"Keep-alive ping to {url}: status {response.status_code}")
-        except requests.RequestException as e:
-            logger.error(f"Keep-alive ping failed: {str(e)}")
-        
-        # Log before sleeping
-        logger.info(f"Keep-alive thread sleeping for 14 minutes")
-        # Sleep for 14 minutes (14 * 60 seconds)
-        time.sleep(14*60)
+            ice_servers = json.loads(os.environ['ICE_SERVERS'])
+        except json.JSONDecodeError:
+            logger.warning("Invalid JSON in ICE_SERVERS, using the default STUN servers")
+    config = {
+        'iceServers': ice_servers,
+        # Candidates gathered ahead of time, while the room page loads
+        'iceCandidatePoolSize': int(os.environ.get('ICE_CANDIDATE_POOL_SIZE', 4))
+    }
+    if os.environ.get('ICE_TRANSPORT_POLICY'):
+        config['iceTransportPolicy'] = os.environ['ICE_TRANSPORT_POLICY']
+    return config
+
+ICE_CONFIG = load_ice_config()
+
+# Admin-only profiling, off unless ADMIN_TOKEN is set. A sampling thread
+# reads the event loop thread's stack at a fixed interval for a bounded
+# window, and Socket.IO handlers (plus save_rooms/cleanup_rooms) record
+# cumulative wall time and the CPU time of their own steps. With profiling
+# off the decorator hands functions back untouched, so it costs nothing.
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+PROFILE_MAX_SECONDS = 60
+PROFILE_DEFAULT_INTERVAL = 0.005
+PROFILE_MIN_INTERVAL = 0.001
+
+# Name -> {'calls', 'errors', 'wall', 'cpu', 'max_wall'}
+handler_stats = {}
+profile_running = False
+
+class _TimedSteps:
+    """Drives a coroutine, adding up the thread CPU time spent in each of
+    its steps, so time other tasks use while it awaits isn't counted"""
+
+    def __init__(self, coro, stats):
+        self.coro = coro
+        self.stats = stats
+
+    def __await__(self):
+        value, error = None, None
+        while True:
+            started = time.thread_time()
+            try:
+                if error is not None:
+                    yielded = self.coro.throw(error)
+                else:
+                    yielded = self.coro.send(value)
+            except StopIteration as e:
+                return e.value
+            finally:
+                self.stats['cpu'] += time.thread_time() - started
+            try:
+                value, error = (yield yielded), None
+            except BaseException as e:
+                value, error = None, e
+
+def instrumented(fn):
+    """Record calls, wall time and CPU time of fn under its name when profiling is on"""
+    if not ADMIN_TOKEN:
+        return fn
+    stats = handler_stats.setdefault(fn.__name__, {'calls': 0, 'errors': 0, 'wall': 0.0, 'cpu': 0.0, 'max_wall': 0.0})
+
+    def finish(started, failed):
+        elapsed = time.perf_counter() - started
+        stats['calls'] += 1
+        stats['errors'] += failed
+        stats['wall'] += elapsed
+        stats['max_wall'] = max(stats['max_wall'], elapsed)
+
+    if asyncio.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            # Signature errors surface here, before anything is counted (Socket.IO
+            # retries connect/disconnect handlers with fewer arguments)
+            coro = fn(*args, **kwargs)
+            started, failed = time.perf_counter(), True
+            try:
+                result = await _TimedSteps(coro, stats)
+                failed = False
+                return result
+            finally:
+                finish(started, failed)
+    else:
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started, cpu_started, failed = time.perf_counter(), time.thread_time(), True
+            try:
+                result = fn(*args, **kwargs)
+                failed = False
+                return result
+            finally:
+                stats['cpu'] += time.thread_time() - cpu_started
+                finish(started, failed)
+    return wrapper
+
+def handler_report(before=None):
+    """Per-handler totals, or the change since a previous report"""
+    report = {}
+    for name, stats in handler_stats.items():
+        previous = (before or {}).get(name, {})
+        calls = stats['calls'] - previous.get('calls', 0)
+        if not calls:
+            continue
+        wall = stats['wall'] - previous.get('wall', 0)
+        cpu = stats['cpu'] - previous.get('cpu', 0)
+        report[name] = {
+            'calls': calls,
+            'errors': stats['errors'] - previous.get('errors', 0),
+            'wall_seconds': round(wall, 6),
+            'cpu_seconds': round(cpu, 6),
+            'avg_wall_ms': round(wall / calls * 1000, 3),
+            'avg_cpu_ms': round(cpu / calls * 1000, 3),
+            'max_wall_ms': round(stats['max_wall'] * 1000, 3)
+        }
+    return report
+
+def frame_label(code):
+    path = os.path.relpath(code.co_filename) if code.co_filename.startswith(os.getcwd()) else code.co_filename
+    return f"{code.co_name} ({path.replace(';', ':')}:{code.co_firstlineno})"
+
+def sample_stacks(thread_id, interval, stop, samples):
+    """Sampling thread: count the target thread's stacks (root first) until stopped"""
+    labels = {}
+    while not stop.wait(interval):
+        frame = sys._current_frames().get(thread_id)
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            label = labels.get(code)
+            if label is None:
+                label = labels[code] = frame_label(code)
+            stack.append(label)
+            frame = frame.f_back
+        if stack:
+            samples[tuple(reversed(stack))] += 1
+
+def collapsed_profile(samples):
+    """Brendan Gregg's collapsed format, for flamegraph.pl, speedscope and friends"""
+    return "\n".join(f"{';'.join(stack)} {count}" for stack, count in samples.most_common()) + "\n"
+
+def speedscope_profile(samples, interval, handlers):
+    frames, index = [], {}
+    profile_samples, weights = [], []
+    for stack, count in samples.items():
+        ids = []
+        for label in stack:
+            if label not in index:
+                index[label] = len(frames)
+                frames.append({'name': label})
+            ids.append(index[label])
+        profile_samples.append(ids)
+        weights.append(count * interval)
+    return {
+        '$schema': 'https://www.speedscope.app/file-format-schema.json',
+        'exporter': 'p2p signaling server',
+        'name': 'Event loop thread',
+        'activeProfileIndex': 0,
+        'shared': {'frames': frames},
+        'profiles': [{
+            'type': 'sampled',
+            'name': 'Event loop thread',
+            'unit': 'seconds',
+            'startValue': 0,
+            'endValue': sum(weights),
+            'samples': profile_samples,
+            'weights': weights
+        }],
+        # Not part of the speedscope format; the viewer ignores it
+        'handlers': handlers
+    }
+
+def require_admin(request):
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=404)
+    supplied = request.headers.get('authorization', '').removeprefix('Bearer ').strip()
+    if not hmac.compare_digest(supplied.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Admin token required")
+
+@app.get("/admin/profile")
+async def admin_profile(request: Request, seconds: float = 10, interval: float = PROFILE_DEFAULT_INTERVAL,
+                        format: str = 'speedscope'):
+    """Sample the event loop thread for a while; returns a speedscope or collapsed-stack profile"""
+    global profile_running
+    require_admin(request)
+    if format not in ('speedscope', 'collapsed'):
+        raise HTTPException(status_code=400, detail="format must be speedscope or collapsed")
+    if profile_running:
+        raise HTTPException(status_code=409, detail="A profile is already running")
+    seconds = min(max(seconds, 0.1), PROFILE_MAX_SECONDS)
+    interval = max(interval, PROFILE_MIN_INTERVAL)
+
+    profile_running = True
+    samples = collections.Counter()
+    stop = threading.Event()
+    before = copy.deepcopy(handler_stats)
+    sampler = threading.Thread(target=sample_stacks, args=(threading.get_ident(), interval, stop, samples),
+                               name='profile-sampler', daemon=True)
+    logger.info(f"Profiling the event loop for {seconds}s every {interval * 1000:g}ms")
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        stop.set()
+        await asyncio.to_thread(sampler.join)
+        profile_running = False
+
+    handlers = handler_report(before)
+    if format == 'collapsed':
+        return Response(collapsed_profile(samples), media_type='text/plain')
+    return speedscope_profile(samples, interval, handlers)
+
+@app.get("/admin/handlers")
+async def admin_handlers(request: Request):
+    """Cumulative per-handler wall and CPU time since the server started"""
+    require_admin(request)
+    return handler_report()
 
-        
 def load_rooms():
     global rooms
     if os.path.exists(ROOMS_FILE):
         try:
             with open(ROOMS_FILE, 'r') as f:
-                rooms.update(json.load(f))
+                rooms.update(json_codec.loads(f.read()))
                 for room_id in list(rooms.keys()):
                     if 'peers' not in rooms[room_id]:
                         rooms[room_id]['peers'] = []
@@ -71,32 +453,282 @@ def load_rooms():
             rooms = {}
             logger.warning(f"Invalid JSON in {ROOMS_FILE}, starting with empty rooms")
 
+@instrumented
 def save_rooms():
     rooms_to_save = {}
     for room_id, room_data in rooms.items():
+        if room_data.get('probe'):
+            continue
         rooms_to_save[room_id] = {
             'peers': room_data.get('peers', []),
             'created_at': room_data.get('created_at', time.time()),
             'peer_data': room_data.get('peer_data', [])
         }
     with open(ROOMS_FILE, 'w') as f:
-        json.dump(rooms_to_save, f)
+        f.write(json_codec.dumps(rooms_to_save))
     logger.debug(f"Saved {len(rooms)} rooms to {ROOMS_FILE}")
 
 load_rooms()
 
+# Rooms with more peers than this get a planned overlay instead of a full mesh
+TOPOLOGY_THRESHOLD = int(os.environ.get('TOPOLOGY_THRESHOLD', 8))
+# Target neighbours per peer in a planned room
+TOPOLOGY_DEGREE = int(os.environ.get('TOPOLOGY_DEGREE', 4))
+# Entries per file_list message sent to a joining peer
+FILE_LIST_PAGE = 1000
+
+def is_planned(room):
+    return len(room.get('peers', [])) > TOPOLOGY_THRESHOLD
+
+def _link(graph, a, b):
+    graph[a].add(b)
+    graph[b].add(a)
+
+def _components(graph):
+    seen = set()
+    components = []
+    for start in graph:
+        if start in seen:
+            continue
+        component = [start]
+        seen.add(start)
+        for peer_id in component:
+            for neighbour in graph[peer_id]:
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    component.append(neighbour)
+        components.append(component)
+    return components
+
+def plan_topology(room):
+    """
+    Maintain a connected neighbour graph of bounded degree for a large room:
+    a random ring when the room first crosses the threshold, then random
+    links up to TOPOLOGY_DEGREE. Existing links are kept, so a join or leave
+    only changes the neighbour sets of a few peers, which are returned.
+    """
+    peers = room.get('peers', [])
+    old = room.get('neighbours', {})
+    if not is_planned(room):
+        room.pop('neighbours', None)
+        return set()
+
+    members = set(peers)
+    graph = {peer_id: set() for peer_id in peers}
+    for peer_id in peers:
+        for neighbour in old.get(peer_id, ()):
+            if neighbour in members and neighbour != peer_id:
+                _link(graph, peer_id, neighbour)
+
+    if not old:
+        order = list(peers)
+        random.shuffle(order)
+        for i, peer_id in enumerate(order):
+            _link(graph, peer_id, order[(i + 1) % len(order)])
+
+    # Joins and leaves can split the graph; bridge the pieces through their least-connected peers
+    components = _components(graph)
+    for previous, component in zip(components, components[1:]):
+        _link(graph, min(previous, key=lambda p: len(graph[p])), min(component, key=lambda p: len(graph[p])))
+
+    # Pair up peers below the target degree
+    lacking = [peer_id for peer_id in peers if len(graph[peer_id]) < TOPOLOGY_DEGREE]
+    random.shuffle(lacking)
+    for peer_id in lacking:
+        candidates = [other for other in lacking
+                      if other != peer_id and other not in graph[peer_id] and len(graph[other]) < TOPOLOGY_DEGREE]
+        while len(graph[peer_id]) < TOPOLOGY_DEGREE and candidates:
+            other = candidates.pop(random.randrange(len(candidates)))
+            _link(graph, peer_id, other)
+
+    # A newcomer with nobody spare to pair with splits existing links, which
+    # keeps everyone else's degree and the graph connected
+    for peer_id in peers:
+        while len(graph[peer_id]) < TOPOLOGY_DEGREE - 1:
+            splittable = [(a, b) for a in peers if a != peer_id and a not in graph[peer_id]
+                          for b in graph[a] if b != peer_id and b not in graph[peer_id]]
+            if not splittable:
+                break
+            a, b = random.choice(splittable)
+            graph[a].discard(b)
+            graph[b].discard(a)
+            _link(graph, peer_id, a)
+            _link(graph, peer_id, b)
+
+    room['neighbours'] = {peer_id: sorted(graph[peer_id]) for peer_id in peers}
+    return {peer_id for peer_id in peers if set(room['neighbours'][peer_id]) != set(old.get(peer_id, ()))}
+
+def visible_peers(room, peer_id):
+    """Peers a client should connect to: the whole room, or its neighbours in a planned room"""
+    if 'neighbours' not in room:
+        return room['peers']
+    return [peer_id] + room['neighbours'].get(peer_id, [])
+
+def room_view(room, peer_id):
+    return {
+        'peers': visible_peers(room, peer_id),
+        'planned': 'neighbours' in room,
+        'room_size': len(room['peers'])
+    }
+
+@instrumented
+async def publish_topology(room_id):
+    """Re-plan a room after a join or leave and tell the peers whose connections change"""
+    room = rooms[room_id]
+    was_planned = 'neighbours' in room
+    changed = plan_topology(room)
+    if 'neighbours' not in room:
+        await sio.emit('room_peers', {'peers': room['peers']}, to=room_id)
+        return False
+
+    sockets = {data.get('peer_id'): data.get('socket_id') for data in room.get('peer_data', [])}
+    targets = changed if was_planned else room['peers']
+    for peer_id in targets:
+        if sockets.get(peer_id):
+            await sio.emit('room_peers', room_view(room, peer_id), to=sockets[peer_id])
+    return True
+
+async def send_file_lists(room_id, sid):
+    """Hand a joining peer every cached file list instead of having the room re-broadcast"""
+    for from_peer, listings in rooms[room_id].get('file_lists', {}).items():
+        entries = list(listings.values())
+        for offset in range(0, len(entries), FILE_LIST_PAGE):
+            await sio.emit('file_list', {
+                'room_id': room_id,
+                'from': from_peer,
+                'files': entries[offset:offset + FILE_LIST_PAGE]
+            }, to=sid)
+
+# Static assets are read once at startup and served from memory, with gzip
+# and brotli variants, under content-hashed URLs that are cached for a year.
+# The room page's import map sends the modules' relative imports to the
+# hashed URLs, so the whole import chain is cacheable; the plain URLs still
+# work and revalidate with an ETag.
+STATIC_DIR = 'static'
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+MIN_COMPRESS_SIZE = 1024
+MODULE_IMPORT = re.compile(r"""(?:import|export)\s[^;]*?from\s*["']\./([\w.-]+\.js)["']""")
+
+mimetypes.add_type('text/javascript', '.js')
+
+# URL path -> {'variants', 'digest', 'content_type', 'cache'}
+assets = {}
+# File name -> content-hashed URL
+asset_urls = {}
+
+def build_assets(directory=STATIC_DIR):
+    assets.clear()
+    asset_urls.clear()
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not os.path.isfile(path):
+            continue
+        with open(path, 'rb') as f:
+            body = f.read()
+        digest = hashlib.sha256(body).hexdigest()
+        content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        if content_type.startswith('text/'):
+            content_type += '; charset=utf-8'
+
+        variants = {'identity': body}
+        if content_type.startswith(COMPRESSIBLE_TYPES) and len(body) >= MIN_COMPRESS_SIZE:
+            variants['gzip'] = gzip.compress(body, compresslevel=9, mtime=0)
+            if brotli is not None:
+                variants['br'] = brotli.compress(body, quality=11)
+            variants = {encoding: data for encoding, data in variants.items()
+                        if encoding == 'identity' or len(data) < len(body)}
+
+        stem, extension = os.path.splitext(name)
+        hashed_url = f"/static/{stem}.{digest[:12]}{extension}"
+        asset = {'variants': variants, 'digest': digest[:32], 'content_type': content_type}
+        assets[hashed_url] = {**asset, 'cache': IMMUTABLE_CACHE}
+        assets[f"/static/{name}"] = {**asset, 'cache': 'no-cache'}
+        asset_urls[name] = hashed_url
+    logger.info(f"Prepared {len(asset_urls)} static assets{'' if brotli else ' (brotli not installed, gzip only)'}")
+
+def asset_url(name):
+    return asset_urls.get(name, f"/static/{name}")
+
+def import_map():
+    return {'imports': {f"/static/{name}": url for name, url in asset_urls.items() if name.endswith('.js')}}
+
+def module_graph(entry):
+    """Every module statically imported from entry, in breadth-first order"""
+    order = [entry]
+    for name in order:
+        asset = assets.get(f"/static/{name}")
+        if asset is None:
+            continue
+        source = asset['variants']['identity'].decode('utf-8', errors='replace')
+        for dependency in MODULE_IMPORT.findall(source):
+            if dependency not in order:
+                order.append(dependency)
+    return order
+
+def preferred_encoding(accept_encoding, variants):
+    accepted = {}
+    for part in accept_encoding.split(','):
+        token, _, params = part.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip().lower()] = quality
+    for encoding in ('br', 'gzip'):
+        if encoding in variants and accepted.get(encoding, accepted.get('*', 0)) > 0:
+            return encoding
+    return 'identity'
+
+@app.get("/static/{name}")
+async def static_asset(request: Request, name: str):
+    asset = assets.get(f"/static/{name}")
+    if asset is None:
+        return Response(status_code=404)
+    encoding = preferred_encoding(request.headers.get('accept-encoding', ''), asset['variants'])
+    etag = f'"{asset["digest"]}"' if encoding == 'identity' else f'"{asset["digest"]}-{encoding}"'
+    headers = {'Cache-Control': asset['cache'], 'ETag': etag, 'Vary': 'Accept-Encoding'}
+    if_none_match = request.headers.get('if-none-match', '')
+    if if_none_match == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+        return Response(status_code=304, headers=headers)
+    if encoding != 'identity':
+        headers['Content-Encoding'] = encoding
+    return Response(asset['variants'][encoding], media_type=asset['content_type'], headers=headers)
+
+# Pages rendered once; the room page is kept split around the room ID slot
+ROOM_ID_SLOT = '__ROOM_ID__'
+pages = {}
+
+def build_pages():
+    common = {'asset_url': asset_url}
+    pages['index'] = templates.get_template('index.html').render(**common)
+    room = templates.get_template('room.html').render(
+        room_id=ROOM_ID_SLOT,
+        ice_config=ICE_CONFIG,
+        relay_enabled=RELAY_ENABLED,
+        telemetry_interval=TELEMETRY_INTERVAL,
+        import_map=import_map(),
+        module_preloads=[asset_url(name) for name in module_graph('index.js')],
+        **common
+    )
+    pages['room'] = room.split(ROOM_ID_SLOT)
+
 @app.get("/", response_class=HTMLResponse)
 async def index(request: Request):
     """Render the main page"""
-    return templates.TemplateResponse("index.html", {"request": request})
+    return HTMLResponse(pages['index'], headers={'Cache-Control': 'no-cache'})
 
 @app.post("/create-room")
-async def create_room():
+async def create_room(request: Request):
     room_id = str(uuid.uuid4())[:8]
     rooms[room_id] = {
         'peers': [],
         'created_at': time.time()
     }
+    if hmac.compare_digest(request.headers.get('x-probe-token', ''), PROBE_TOKEN):
+        rooms[room_id]['probe'] = True
     save_rooms()
     logger.info(f"Created room: {room_id}")
     return {"room_id": room_id}
@@ -112,52 +744,92 @@ async def join_room(request: Request, room_id: str):
         status_code=404
     )
     try:
-        logger.info(f"Rendering room.html for room: {room_id}")
-        return templates.TemplateResponse("room.html", {"request": request, "room_id": room_id})
+        return HTMLResponse(html.escape(room_id).join(pages['room']), headers={'Cache-Control': 'no-cache'})
     except Exception as e:
         logger.error(f"Error rendering room.html: {str(e)}")
         return templates.TemplateResponse("error.html", {"request": request, "message": "An error occurred while loading the room."}), 500
 
 
+@app.get("/ice-config")
+async def ice_config():
+    """ICE configuration for clients that don't load the room page"""
+    return ICE_CONFIG
+
 @app.get("/status")
 async def status():
     """Return health status and active rooms count"""
-    room_count = len(rooms)
-    peer_count = sum(len(room_data.get("peers", [])) for room_data in rooms.values())
+    # The synthetic probe's rooms aren't anyone's
+    user_rooms = [room_data for room_data in rooms.values() if not room_data.get('probe')]
+    room_count = len(user_rooms)
+    peer_count = sum(len(room_data.get("peers", [])) for room_data in user_rooms)
     now = time.time()
-    room_ages = [now - room_data.get("created_at", now) for room_data in rooms.values()]
+    room_ages = [now - room_data.get("created_at", now) for room_data in user_rooms]
     avg_room_age = sum(room_ages) / len(room_ages) if room_ages else 0
+    planned_rooms = [room_data for room_data in user_rooms if 'neighbours' in room_data]
+    # Links in planned rooms, a full mesh everywhere else
+    peer_connections = sum(
+        sum(len(n) for n in room_data['neighbours'].values()) // 2 if 'neighbours' in room_data
+        else len(room_data.get("peers", [])) * (len(room_data.get("peers", [])) - 1) // 2
+        for room_data in user_rooms
+    )
+    probe = probe_report()
     
     return {
-        "status": "healthy",
+        "status": "degraded" if probe['degraded_reasons'] else "healthy",
         "active_rooms_count": room_count,
         "total_peers_count": peer_count,
-        "avg_room_age_seconds": round(avg_room_age, 2)
+        "connected_peers_count": len(peer_sockets),
+        "avg_room_age_seconds": round(avg_room_age, 2),
+        "planned_rooms_count": len(planned_rooms),
+        "peer_connections_count": peer_connections,
+        "relay_pairs_count": len(relay_pairs),
+        "relay_inflight_bytes": relay_inflight,
+        "log_records_dropped": sum(log_dropped.values()),
+        "probe": probe
     }
 
 @sio.event
+@instrumented
 async def connect(sid, environ):
-    logger.info(f"Client connected: {sid}")
+    logger.info("Client connected: %s", sid, extra={'event': 'connect', 'sid': sid})
 
 @sio.event
+@instrumented
 async def disconnect(sid):
-    logger.info(f"Client disconnected: {sid}")
-    for room_id in rooms:
-        for peer_data in rooms[room_id].get('peer_data', []):
-            if peer_data.get('socket_id') == sid:
-                peer_id = peer_data.get('peer_id')
-                if peer_id in rooms[room_id]['peers']:
-                    rooms[room_id]['peers'].remove(peer_id)
-                await sio.emit('peer_disconnected', {'peer_id': peer_id}, to=room_id)
-                save_rooms()
-                break
+    logger.info("Client disconnected: %s", sid, extra={'event': 'disconnect', 'sid': sid})
+    telemetry_last_report.pop(sid, None)
+    member = peer_sockets.pop(sid, None)
+    if member is None:
+        return
+    room_id, peer_data = member
+    room = rooms.get(room_id)
+    # A peer that rejoined on a new socket (a page refresh) stays
+    if room is None or peer_data.get('socket_id') != sid:
+        return
+    peer_id = peer_data.get('peer_id')
+    if peer_data in room.get('peer_data', []):
+        room['peer_data'].remove(peer_data)
+    if peer_id in room['peers']:
+        room['peers'].remove(peer_id)
+    room.get('file_lists', {}).pop(peer_id, None)
+    await sio.emit('peer_disconnected', {'peer_id': peer_id}, to=room_id)
+    # Rooms can come and go while this awaits
+    if 'neighbours' in room and room_id in rooms:
+        await publish_topology(room_id)
+    save_rooms()
+
+def peer_alive(peer_data, now):
+    """Connected peers are alive: Engine.IO disconnects those that stop answering pings"""
+    return peer_data.get('socket_id') in peer_sockets or now - peer_data.get('last_seen', 0) <= PEER_TIMEOUT
 
 @sio.event
+@instrumented
 async def join_room(sid, data):
     room_id = data.get('room_id')
     peer_id = data.get('peer_id')
     
-    logger.info(f"Socket {sid} joining room {room_id} as peer {peer_id}")
+    logger.info("Socket %s joining room %s as peer %s", sid, room_id, peer_id,
+                extra={'event': 'join_room', 'sid': sid, 'room': room_id, 'peer': peer_id})
     
     if room_id not in rooms:
         await sio.emit('error', {'message': 'Room not found'}, to=sid)
@@ -174,35 +846,44 @@ async def join_room(sid, data):
     if 'peer_data' not in rooms[room_id]:
         rooms[room_id]['peer_data'] = []
     
-    peer_found = False
+    member = None
     for peer_data in rooms[room_id]['peer_data']:
         if peer_data.get('peer_id') == peer_id:
             peer_data['socket_id'] = sid
             peer_data['last_seen'] = time.time()
-            peer_found = True
+            member = peer_data
             break
     
-    if not peer_found:
-        rooms[room_id]['peer_data'].append({
+    if member is None:
+        member = {
             'peer_id': peer_id,
             'socket_id': sid,
             'last_seen': time.time()
-        })
+        }
+        rooms[room_id]['peer_data'].append(member)
+    peer_sockets[sid] = (room_id, member)
     
     save_rooms()
     
-    await sio.emit('room_peers', {'peers': rooms[room_id]['peers']}, to=room_id)
-    await sio.emit('peer_joined', {'peer_id': peer_id}, to=room_id)
-    await sio.emit('registered', {'peer_id': peer_id, 'peers': rooms[room_id]['peers']}, to=sid)
+    # Large rooms get a neighbour set each instead of the full peer list
+    if await publish_topology(room_id):
+        await send_file_lists(room_id, sid)
+    else:
+        await sio.emit('peer_joined', {'peer_id': peer_id}, to=room_id)
+    await sio.emit('registered', {'peer_id': peer_id, 'heartbeat_interval': HEARTBEAT_INTERVAL,
+                                  'relay_token': relay_token(sid),
+                                  **room_view(rooms[room_id], peer_id)}, to=sid)
 
 @sio.event
+@instrumented
 async def signal(sid, data):
     room_id = data.get('room_id')
     to_peer_id = data.get('to')
     from_peer_id = data.get('from')
     signal_data = data.get('signal')
     
-    logger.info(f"Signal from {from_peer_id} to {to_peer_id} in room {room_id}")
+    logger.info("Signal from %s to %s in room %s", from_peer_id, to_peer_id, room_id,
+                extra={'event': 'signal', 'room': room_id, 'peer': from_peer_id, 'target': to_peer_id})
     
     if room_id not in rooms:
         await sio.emit('error', {'message': 'Room not found'}, to=sid)
@@ -220,40 +901,518 @@ async def signal(sid, data):
             'signal': signal_data
         }, to=target_socket_id)
     else:
-        logger.warning(f"Target peer {to_peer_id} not found in room {room_id}")
+        logger.warning("Target peer %s not found in room %s", to_peer_id, room_id,
+                       extra={'event': 'signal_target_missing', 'room': room_id, 'target': to_peer_id})
 
 @sio.event
+@instrumented
 async def file_list(sid, data):
     room_id = data.get('room_id')
+    from_peer = data.get('from')
+    if room_id in rooms and from_peer:
+        # Cached so peers joining a planned room get every list without a re-broadcast
+        listings = rooms[room_id].setdefault('file_lists', {}).setdefault(from_peer, {})
+        for entry in data.get('files') or []:
+            if isinstance(entry, dict) and entry.get('fileId'):
+                listings[entry['fileId']] = entry
     await sio.emit('file_list', data, to=room_id)
 
 @sio.event
+@instrumented
 async def heartbeat(sid, data):
+    """Optional app-level heartbeat, sent by clients when HEARTBEAT_INTERVAL is set"""
     room_id = data.get('room_id')
     peer_id = data.get('peer_id')
     
     if room_id in rooms and peer_id:
-        peer_found = False
-        for peer_data in rooms[room_id].get('peer_data', []):
-            if peer_data.get('peer_id') == peer_id:
-                peer_data['last_seen'] = time.time()
-                peer_found = True
-                break
-        
-        if not peer_found and peer_id in rooms[room_id]['peers']:
-            if 'peer_data' not in rooms[room_id]:
-                rooms[room_id]['peer_data'] = []
-            rooms[room_id]['peer_data'].append({
-                'peer_id': peer_id,
-                'socket_id': sid,
-                'last_seen': time.time()
-            })
+        member = peer_sockets.get(sid)
+        if not (member and member[0] == room_id and member[1].get('peer_id') == peer_id):
+            # Not joined on this socket (e.g. joined before a restart): adopt it
+            peer_list = rooms[room_id].setdefault('peer_data', [])
+            peer_data = next((p for p in peer_list if p.get('peer_id') == peer_id), None)
+            if peer_data is None and peer_id in rooms[room_id]['peers']:
+                peer_data = {'peer_id': peer_id}
+                peer_list.append(peer_data)
+            member = None
+            if peer_data is not None:
+                peer_data['socket_id'] = sid
+                member = peer_sockets[sid] = (room_id, peer_data)
+        if member:
+            member[1]['last_seen'] = time.time()
         
-        if random.random() < 0.01:
-            await cleanup_rooms()
-        
-        await sio.emit('active_peers', {'peers': rooms[room_id]['peers']}, to=sid)
+        await sio.emit('active_peers', {'peers': visible_peers(rooms[room_id], peer_id)}, to=sid)
+
+# Relay for peers whose direct connection can't get through NAT. Frames are
+# opaque to the server: each one is forwarded as the bytes object Socket.IO
+# decoded, never copied or parsed. Every direction of a pair has a window of
+# unacknowledged bytes and a byte quota, and the relay as a whole caps the
+# bytes it holds, so a fast sender can't fill server memory.
+RELAY_NAMESPACE = '/relay'
+RELAY_ENABLED = os.environ.get('RELAY_ENABLED', '1') != '0'
+# Bytes forwarded to a receiver but not yet acknowledged, per direction of a pair
+RELAY_WINDOW = int(os.environ.get('RELAY_WINDOW', 1024 * 1024))
+# Total bytes one direction of a pair may relay
+RELAY_PAIR_QUOTA = int(os.environ.get('RELAY_PAIR_QUOTA', 2 * 1024 * 1024 * 1024))
+# Bytes held across all pairs
+RELAY_MAX_INFLIGHT = int(os.environ.get('RELAY_MAX_INFLIGHT', 64 * 1024 * 1024))
+RELAY_MAX_FRAME = 1024 * 1024
+RELAY_WAIT_TIMEOUT = 30
+# Signs the tokens that tie a relay socket to the socket that joined as the peer
+RELAY_SECRET = secrets.token_bytes(32)
+
+# (room_id, peer_id) -> relay socket, and back
+relay_sockets = {}
+relay_members = {}
+# (room_id, from_peer, to_peer) -> window state for that direction
+relay_pairs = {}
+relay_inflight = 0
+
+def relay_token(sid):
+    """Token a peer's relay socket presents to act for the main socket `sid`"""
+    mac = hmac.new(RELAY_SECRET, sid.encode(), hashlib.sha256).hexdigest()
+    return f"{sid}.{mac}"
+
+def relay_token_owner(token):
+    """(room_id, peer_id) the token's socket is joined as, or None"""
+    if not isinstance(token, str) or '.' not in token:
+        return None
+    sid = token.rsplit('.', 1)[0]
+    if not hmac.compare_digest(token, relay_token(sid)):
+        return None
+    member = peer_sockets.get(sid)
+    if member is None or member[1].get('socket_id') != sid:
+        return None
+    return member[0], member[1].get('peer_id')
+
+def relay_pair(key):
+    if key not in relay_pairs:
+        relay_pairs[key] = {
+            'inflight': 0,
+            'relayed': 0,
+            'closed': False,
+            'space': asyncio.Event(),
+            # Handlers run concurrently; frames of a pair are forwarded in arrival order
+            'order': asyncio.Lock()
+        }
+    return relay_pairs[key]
 
+def release_relay_bytes(pair, size):
+    global relay_inflight
+    # Bytes of a dropped pair were released when it was dropped
+    if pair['closed']:
+        return
+    pair['inflight'] -= size
+    relay_inflight -= size
+    pair['space'].set()
+    # Space freed under the global cap can unblock any pair
+    if relay_inflight + RELAY_MAX_FRAME > RELAY_MAX_INFLIGHT:
+        return
+    for other in relay_pairs.values():
+        other['space'].set()
+
+async def wait_for_relay_window(pair, size):
+    deadline = time.monotonic() + RELAY_WAIT_TIMEOUT
+    while pair['inflight'] + size > RELAY_WINDOW or relay_inflight + size > RELAY_MAX_INFLIGHT:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        pair['space'].clear()
+        try:
+            await asyncio.wait_for(pair['space'].wait(), remaining)
+        except asyncio.TimeoutError:
+            return False
+    return True
+
+def drop_relay_member(sid):
+    """Forget a relay socket and the window state of every pair it was part of"""
+    global relay_inflight
+    member = relay_members.pop(sid, None)
+    if member is None:
+        return None
+    if relay_sockets.get(member) == sid:
+        del relay_sockets[member]
+    room_id, peer_id = member
+    for key in [key for key in relay_pairs if key[0] == room_id and peer_id in key[1:]]:
+        pair = relay_pairs.pop(key)
+        pair['closed'] = True
+        relay_inflight -= pair['inflight']
+        # Wake a sender blocked on this pair so it sees the peer is gone
+        pair['space'].set()
+    return member
+
+@sio.on('connect', namespace=RELAY_NAMESPACE)
+async def relay_connect(sid, environ):
+    if not RELAY_ENABLED:
+        return False
+    logger.info("Relay client connected: %s", sid, extra={'event': 'relay_connect', 'sid': sid})
+
+@sio.on('disconnect', namespace=RELAY_NAMESPACE)
+async def relay_disconnect(sid):
+    member = drop_relay_member(sid)
+    if member:
+        logger.info("Relay client for peer %s in room %s disconnected", member[1], member[0],
+                    extra={'event': 'relay_disconnect', 'room': member[0], 'peer': member[1]})
+
+@sio.on('relay_join', namespace=RELAY_NAMESPACE)
+@instrumented
+async def relay_join(sid, data):
+    room_id = data.get('room_id')
+    peer_id = data.get('peer_id')
+    # Only the socket that joined the room as this peer may take its relayed traffic
+    if room_id not in rooms or relay_token_owner(data.get('token')) != (room_id, peer_id):
+        return {'ok': False, 'reason': 'not in room'}
+    drop_relay_member(sid)
+    relay_sockets[(room_id, peer_id)] = sid
+    relay_members[sid] = (room_id, peer_id)
+    return {'ok': True}
+
+async def relay_notice(sid, event, to_peer):
+    member = relay_members.get(sid)
+    target_sid = relay_sockets.get((member[0], to_peer)) if member else None
+    if not target_sid:
+        return {'ok': False, 'reason': 'unreachable'}
+    await sio.emit(event, {'from': member[1]}, to=target_sid, namespace=RELAY_NAMESPACE)
+    return {'ok': True}
+
+@sio.on('relay_open', namespace=RELAY_NAMESPACE)
+@instrumented
+async def relay_open(sid, data):
+    member = relay_members.get(sid)
+    if member:
+        logger.info(f"Relaying between {member[1]} and {data.get('to')} in room {member[0]}")
+    return await relay_notice(sid, 'relay_open', data.get('to'))
+
+@sio.on('relay_close', namespace=RELAY_NAMESPACE)
+@instrumented
+async def relay_close(sid, data):
+    return await relay_notice(sid, 'relay_close', data.get('to'))
+
+@sio.on('relay_frame', namespace=RELAY_NAMESPACE)
+@instrumented
+async def relay_frame(sid, to_peer, frame):
+    global relay_inflight
+    member = relay_members.get(sid)
+    if member is None:
+        return {'ok': False, 'reason': 'not joined'}
+    if not isinstance(frame, bytes) or len(frame) > RELAY_MAX_FRAME:
+        return {'ok': False, 'reason': 'bad frame'}
+
+    room_id, from_peer = member
+    key = (room_id, from_peer, to_peer)
+    if (room_id, to_peer) not in relay_sockets:
+        return {'ok': False, 'reason': 'unreachable'}
+    pair = relay_pair(key)
+    size = len(frame)
+    async with pair['order']:
+        # Checked under the lock, so concurrent frames can't overshoot the quota together
+        if pair['relayed'] + size > RELAY_PAIR_QUOTA:
+            return {'ok': False, 'reason': 'quota'}
+        if not await wait_for_relay_window(pair, size):
+            return {'ok': False, 'reason': 'timeout'}
+
+        target_sid = relay_sockets.get((room_id, to_peer))
+        if not target_sid or pair['closed']:
+            return {'ok': False, 'reason': 'unreachable'}
+        pair['inflight'] += size
+        pair['relayed'] += size
+        relay_inflight += size
+        await sio.emit('relay_frame', (from_peer, frame), to=target_sid, namespace=RELAY_NAMESPACE,
+                       callback=lambda *_: release_relay_bytes(pair, size))
+    return {'ok': True}
+
+# Client telemetry. Browsers sample getStats() on their peer connections
+# (round-trip time, candidate pair type, available outgoing bitrate, data
+# rates), ping their peers and time finished transfers, and send the samples
+# in one batch every TELEMETRY_INTERVAL seconds. Samples are folded into
+# fixed-bucket histograms per room and globally and then dropped. /metrics
+# serves the global histograms; per-room ones are admin-only, since room IDs
+# are what let people in.
+TELEMETRY_INTERVAL = int(os.environ.get('TELEMETRY_INTERVAL', 60))
+TELEMETRY_MAX_SAMPLES = 500        # per report; the rest of a batch is ignored
+TELEMETRY_MIN_GAP = 5              # seconds; reports arriving faster from one socket are dropped
+# Upper bounds of each histogram's buckets; an overflow bucket follows
+TELEMETRY_HISTOGRAMS = {
+    'rtt_ms': (5, 10, 20, 50, 100, 200, 500, 1000, 2000),
+    'app_rtt_ms': (5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000),
+    'outgoing_bitrate_bps': (1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9),
+    'send_rate_bps': (1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9),
+    'receive_rate_bps': (1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9),
+    'download_throughput_bps': (1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9),
+    'upload_throughput_bps': (1e5, 5e5, 1e6, 5e6, 1e7, 5e7, 1e8, 5e8, 1e9),
+}
+# Local candidate type of the selected pair; 'server-relay' is our own Socket.IO relay
+CANDIDATE_TYPES = ('host', 'srflx', 'prflx', 'relay', 'server-relay')
+
+def new_aggregate():
+    return {
+        'reports': 0,
+        'candidate_types': collections.Counter(),
+        'histograms': {name: {'buckets': [0] * (len(bounds) + 1), 'count': 0, 'sum': 0.0}
+                       for name, bounds in TELEMETRY_HISTOGRAMS.items()}
+    }
+
+telemetry_global = new_aggregate()
+# room ID -> aggregate, dropped with the room
+telemetry_rooms = {}
+# sid -> time of its last accepted report
+telemetry_last_report = {}
+
+def observe(aggregates, name, value):
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value) or value < 0:
+        return
+    index = bisect.bisect_left(TELEMETRY_HISTOGRAMS[name], value)
+    for aggregate in aggregates:
+        histogram = aggregate['histograms'][name]
+        histogram['buckets'][index] += 1
+        histogram['count'] += 1
+        histogram['sum'] += value
+
+def histogram_quantile(histogram, bounds, fraction):
+    """Upper bound of the bucket holding the given quantile (None past the last bound)"""
+    if not histogram['count']:
+        return 0
+    rank = fraction * histogram['count']
+    seen = 0
+    for bound, count in zip(bounds + (None,), histogram['buckets']):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+def aggregate_report(aggregate):
+    histograms = {}
+    for name, histogram in aggregate['histograms'].items():
+        bounds = TELEMETRY_HISTOGRAMS[name]
+        histograms[name] = {
+            'count': histogram['count'],
+            'mean': round(histogram['sum'] / histogram['count'], 1) if histogram['count'] else 0,
+            **{f"p{int(q * 100)}": histogram_quantile(histogram, bounds, q) for q in (0.5, 0.95, 0.99)},
+            'buckets': dict(zip([f"{bound:g}" for bound in bounds] + ['+Inf'], histogram['buckets']))
+        }
+    pairs = sum(aggregate['candidate_types'].values())
+    return {
+        'reports': aggregate['reports'],
+        'candidate_types': dict(aggregate['candidate_types']),
+        'relayed_share': round((aggregate['candidate_types']['relay'] + aggregate['candidate_types']['server-relay'])
+                               / pairs, 3) if pairs else 0,
+        'histograms': histograms
+    }
+
+def prometheus_metrics(aggregate):
+    """The global aggregate in Prometheus text exposition format"""
+    lines = ['# TYPE p2p_telemetry_reports_total counter', f"p2p_telemetry_reports_total {aggregate['reports']}",
+             '# TYPE p2p_candidate_pairs_total counter']
+    for candidate_type in CANDIDATE_TYPES:
+        lines.append(f'p2p_candidate_pairs_total{{type="{candidate_type}"}} {aggregate["candidate_types"][candidate_type]}')
+    for name, histogram in aggregate['histograms'].items():
+        metric = f"p2p_{name}"
+        lines.append(f"# TYPE {metric} histogram")
+        cumulative = 0
+        labels = [f"{bound:g}" for bound in TELEMETRY_HISTOGRAMS[name]] + ['+Inf']
+        for label, count in zip(labels, histogram['buckets']):
+            cumulative += count
+            lines.append(f'{metric}_bucket{{le="{label}"}} {cumulative}')
+        lines.append(f"{metric}_sum {histogram['sum']:g}")
+        lines.append(f"{metric}_count {histogram['count']}")
+    return '\n'.join(lines) + '\n'
+
+@sio.event
+@instrumented
+async def telemetry(sid, data):
+    if not TELEMETRY_INTERVAL or not isinstance(data, dict):
+        return
+    room_id = data.get('room_id')
+    room = rooms.get(room_id)
+    if room is None or room.get('probe'):
+        return
+    now = time.time()
+    if now - telemetry_last_report.get(sid, 0) < TELEMETRY_MIN_GAP:
+        logger.debug("Dropped early telemetry from %s", sid, extra={'event': 'telemetry', 'sid': sid})
+        return
+    telemetry_last_report[sid] = now
+
+    aggregates = (telemetry_global, telemetry_rooms.setdefault(room_id, new_aggregate()))
+    for aggregate in aggregates:
+        aggregate['reports'] += 1
+    samples = data.get('samples')
+    for sample in (samples if isinstance(samples, list) else [])[:TELEMETRY_MAX_SAMPLES]:
+        if not isinstance(sample, dict):
+            continue
+        for name in ('rtt_ms', 'app_rtt_ms', 'outgoing_bitrate_bps', 'send_rate_bps', 'receive_rate_bps'):
+            if name in sample:
+                observe(aggregates, name, sample[name])
+        if sample.get('candidate_type') in CANDIDATE_TYPES:
+            for aggregate in aggregates:
+                aggregate['candidate_types'][sample['candidate_type']] += 1
+    transfers = data.get('transfers')
+    for transfer in (transfers if isinstance(transfers, list) else [])[:TELEMETRY_MAX_SAMPLES]:
+        if not isinstance(transfer, dict) or transfer.get('direction') not in ('download', 'upload'):
+            continue
+        size, seconds = transfer.get('bytes'), transfer.get('seconds')
+        if isinstance(size, (int, float)) and isinstance(seconds, (int, float)) and seconds > 0:
+            observe(aggregates, f"{transfer['direction']}_throughput_bps", size * 8 / seconds)
+
+@app.get("/metrics")
+async def metrics(format: str = 'json'):
+    """Histograms of client-reported connection and transfer metrics, across all rooms"""
+    if format == 'prometheus':
+        return Response(prometheus_metrics(telemetry_global), media_type='text/plain; version=0.0.4')
+    if format != 'json':
+        raise HTTPException(status_code=400, detail="format must be json or prometheus")
+    return aggregate_report(telemetry_global)
+
+@app.get("/admin/telemetry")
+async def admin_telemetry(request: Request):
+    """The same histograms per room, for rooms that still exist"""
+    require_admin(request)
+    return {room_id: aggregate_report(aggregate) for room_id, aggregate in telemetry_rooms.items()}
+
+# Synthetic end-to-end probe. Every PROBE_INTERVAL seconds two in-process
+# Socket.IO clients take the path real peers do: create a room over HTTP,
+# join it, relay a signal there and back, and disconnect. The stage
+# latencies of recent probes are reported in /status, which turns
+# "degraded" when the last probe failed, no probe has finished lately, or
+# the p95 crosses PROBE_P95_THRESHOLD. Probe rooms are marked by a token
+# only this process knows and are left out of room counts and rooms.json.
+# The probe connects to PROBE_URL, or else to the address the server is
+# bound to: HOST/PORT when started with `python main.py`, otherwise the
+# local address of the first request served. Until then no probe runs.
+PROBE_INTERVAL = float(os.environ.get('PROBE_INTERVAL', 60))
+PROBE_URL = os.environ.get('PROBE_URL')
+PROBE_TIMEOUT = 10
+PROBE_P95_THRESHOLD = float(os.environ.get('PROBE_P95_THRESHOLD', 2.0))
+PROBE_MIN_SAMPLES = 5
+PROBE_STAGES = ('create_room', 'join', 'signal_round_trip', 'disconnect')
+PROBE_TOKEN = secrets.token_hex(16)
+
+# Most recent probes: {'at', 'ok', 'error', <stage>: seconds, 'total': seconds}
+probe_samples = collections.deque(maxlen=60)
+probe_target = PROBE_URL
+
+def local_url(host, port):
+    if host in ('', '0.0.0.0', '::'):
+        host = '127.0.0.1'
+    return f"http://[{host}]:{port}" if ':' in host else f"http://{host}:{port}"
+
+class ProbeTargetMiddleware:
+    """Records the local address a request arrived on as the probe's target"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        global probe_target
+        if probe_target is None and scope['type'] in ('http', 'websocket') and scope.get('server'):
+            probe_target = local_url(*scope['server'][:2])
+            logger.info(f"Synthetic probe target: {probe_target}")
+        await self.app(scope, receive, send)
+
+if PROBE_INTERVAL > 0:
+    app.add_middleware(ProbeTargetMiddleware)
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of a list of numbers"""
+    ordered = sorted(values)
+    return ordered[int(fraction * (len(ordered) - 1))] if ordered else 0
+
+async def join_as_probe(client, room_id):
+    registered = asyncio.get_running_loop().create_future()
+    client.on('registered', lambda data: registered.done() or registered.set_result(data['peer_id']))
+    await client.connect(probe_target, transports=['websocket'])
+    await client.emit('join_room', {'room_id': room_id, 'peer_id': None})
+    return await registered
+
+async def run_probe():
+    """One create/join/signal/disconnect cycle; returns seconds per stage"""
+    timings = {}
+    started = last = time.perf_counter()
+
+    def mark(stage):
+        nonlocal last
+        now = time.perf_counter()
+        timings[stage] = now - last
+        last = now
+
+    caller, callee = AsyncClient(reconnection=False), AsyncClient(reconnection=False)
+    room_id = None
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.post(f"{probe_target}/create-room", headers={'X-Probe-Token': PROBE_TOKEN}) as response:
+                response.raise_for_status()
+                room_id = (await response.json())['room_id']
+        mark('create_room')
+
+        caller_id = await join_as_probe(caller, room_id)
+        callee_id = await join_as_probe(callee, room_id)
+        mark('join')
+
+        echoed = asyncio.get_running_loop().create_future()
+
+        async def echo(data):
+            await callee.emit('signal', {'room_id': room_id, 'from': callee_id, 'to': data['from'],
+                                         'signal': data['signal']})
+
+        callee.on('signal', echo)
+        caller.on('signal', lambda data: echoed.done() or echoed.set_result(data['signal']))
+        await caller.emit('signal', {'room_id': room_id, 'from': caller_id, 'to': callee_id,
+                                     'signal': {'type': 'probe'}})
+        await echoed
+        mark('signal_round_trip')
+
+        await caller.disconnect()
+        await callee.disconnect()
+        # Done once the server has let both go; cleanup_rooms removes the empty room
+        while rooms.get(room_id, {}).get('peers'):
+            await asyncio.sleep(0.005)
+        mark('disconnect')
+    finally:
+        for client in (caller, callee):
+            if client.connected:
+                await client.disconnect()
+    timings['total'] = time.perf_counter() - started
+    return timings
+
+async def probe_loop():
+    # Give uvicorn a moment to start listening
+    await asyncio.sleep(min(PROBE_INTERVAL, 5))
+    while True:
+        if probe_target is None:
+            # Nothing has reached the server yet, so its address isn't known
+            await asyncio.sleep(min(PROBE_INTERVAL, 5))
+            continue
+        sample = {'at': time.time(), 'ok': False}
+        try:
+            sample.update(await asyncio.wait_for(run_probe(), PROBE_TIMEOUT))
+            sample['ok'] = True
+        except Exception as e:
+            sample['error'] = f"{type(e).__name__}: {e}"
+            logger.warning(f"Synthetic probe failed: {sample['error']}")
+        probe_samples.append(sample)
+        await asyncio.sleep(PROBE_INTERVAL)
+
+def probe_report():
+    """Latency percentiles (ms) of recent probes and the reasons, if any, to report degraded"""
+    if PROBE_INTERVAL <= 0:
+        return {'enabled': False, 'degraded_reasons': []}
+    recent = list(probe_samples)
+    passed = [sample for sample in recent if sample['ok']]
+    report = {'enabled': True, 'target': probe_target, 'probes': len(recent), 'failures': len(recent) - len(passed)}
+    for stage in PROBE_STAGES + ('total',):
+        values = [sample[stage] * 1000 for sample in passed]
+        report[f"{stage}_ms"] = {f"p{int(q * 100)}": round(percentile(values, q), 1) for q in (0.5, 0.95, 0.99)}
+
+    reasons = []
+    if recent and not recent[-1]['ok']:
+        reasons.append(f"last probe failed: {recent[-1]['error']}")
+        report['last_error'] = recent[-1]['error']
+    if recent and time.time() - recent[-1]['at'] > 3 * PROBE_INTERVAL + PROBE_TIMEOUT:
+        reasons.append("no probe has finished recently")
+    if len(passed) >= PROBE_MIN_SAMPLES and report['total_ms']['p95'] > PROBE_P95_THRESHOLD * 1000:
+        reasons.append(f"p95 probe latency above {PROBE_P95_THRESHOLD}s")
+    report['degraded_reasons'] = reasons
+    return report
+
+@instrumented
 async def cleanup_rooms():
     """Remove inactive peers and empty rooms"""
     now = time.time()
@@ -266,7 +1425,7 @@ async def cleanup_rooms():
             
         disconnected_peers = []
         for peer_data in list(rooms[room_id].get('peer_data', [])):
-            if now - peer_data.get('last_seen', 0) > 30:
+            if not peer_alive(peer_data, now):
                 peer_id = peer_data.get('peer_id')
                 if peer_id and peer_id in rooms[room_id]['peers']:
                     rooms[room_id]['peers'].remove(peer_id)
@@ -275,11 +1434,15 @@ async def cleanup_rooms():
                 rooms[room_id]['peer_data'].remove(peer_data)
         
         for peer_id in disconnected_peers:
+            rooms[room_id].get('file_lists', {}).pop(peer_id, None)
             await sio.emit('peer_disconnected', {'peer_id': peer_id}, to=room_id)
         
         if not rooms[room_id]['peers'] or (now - rooms[room_id].get('created_at', 0) > 3600):
             del rooms[room_id]
+            telemetry_rooms.pop(room_id, None)
             rooms_removed += 1
+        elif disconnected_peers and 'neighbours' in rooms[room_id]:
+            await publish_topology(room_id)
     
     if peers_removed > 0 or rooms_removed > 0:
         logger.info(f"Cleanup: removed {peers_removed} inactive peers and {rooms_removed} empty/old rooms")
@@ -304,6 +1467,8 @@ async def lifespan(app):
     logger.info("Starting server with automatic room/peer cleanup")
     load_rooms()
     asyncio.create_task(schedule_cleanup())
+    if PROBE_INTERVAL > 0:
+        asyncio.create_task(probe_loop())
     yield
     # Shutdown
     logger.info("Server stopping - clearing all rooms")
@@ -311,14 +1476,15 @@ async def lifespan(app):
     with open(ROOMS_FILE, 'w') as f:
         json.dump({}, f)
     logger.info("Server stopped. All rooms cleared.")
+    stop_logging()
 
 @app.on_event("startup")
 async def startup_event():
     logger.info("Starting server with automatic room/peer cleanup (startup event)")
     load_rooms()
     asyncio.create_task(schedule_cleanup())
-    keep_alive_thread = threading.Thread(target=keep_alive, daemon=True)
-    keep_alive_thread.start()
+    if PROBE_INTERVAL > 0:
+        asyncio.create_task(probe_loop())
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -327,8 +1493,36 @@ async def shutdown_event():
     with open(ROOMS_FILE, 'w') as f:
         json.dump({}, f)
     logger.info("Server stopped. All rooms cleared.")
+    stop_logging()
 
 
 app.lifespan = lifespan
 
-app.mount("/", socket_app)
\ No newline at end of file
+build_assets()
+build_pages()
+
+app.mount("/", socket_app)
+
+def server_options():
+    """uvicorn loop and HTTP parser for SERVER_PROFILE, falling back when not installed"""
+    if SERVER_PROFILE != 'performance':
+        return {'loop': 'asyncio', 'http': 'h11'}
+    options = {}
+    for option, module, fallback in (('loop', 'uvloop', 'asyncio'), ('http', 'httptools', 'h11')):
+        try:
+            __import__(module)
+            options[option] = module
+        except ImportError:
+            logger.warning(f"{module} is not installed, using {fallback}")
+            options[option] = fallback
+    return options
+
+if __name__ == "__main__":
+    import uvicorn
+    host, port = os.environ.get('HOST', '0.0.0.0'), int(os.environ.get('PORT', 5000))
+    if probe_target is None:
+        probe_target = local_url(host, port)
+    options = server_options()
+    logger.info(f"Starting the {SERVER_PROFILE} profile: {options['loop']} loop, {options['http']} HTTP, "
+                f"{'orjson' if fast_json else 'stdlib json'}")
+    uvicorn.run(app, host=host, port=port, **options)
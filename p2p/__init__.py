@@ -0,0 +1,16 @@
+"""Command-line room member for scripted bulk transfers: Socket.IO signaling
+and aiortc data channels speaking the same protocol as the browser client.
+
+    python -m p2p send --room ROOM files...
+    python -m p2p recv --room ROOM --out downloads/
+"""
+
+from .protocol import CHUNK_SIZE, DATA_CHANNEL_COUNT, encode_frame, decode_frame
+from .storage import MappedFile, MemoryFile, PackedFiles, DiskSink
+from .peer import Download, PeerConnection, ProtocolPeer
+
+__all__ = [
+    'CHUNK_SIZE', 'DATA_CHANNEL_COUNT', 'encode_frame', 'decode_frame',
+    'MappedFile', 'MemoryFile', 'PackedFiles', 'DiskSink',
+    'Download', 'PeerConnection', 'ProtocolPeer',
+]
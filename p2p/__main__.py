@@ -0,0 +1,148 @@
+import os
+import sys
+import time
+import json
+import fnmatch
+import asyncio
+import argparse
+from collections import Counter
+
+from .protocol import DATA_CHANNEL_COUNT
+from .storage import DiskSink, unique_path
+from .peer import ProtocolPeer
+
+def megabytes(size):
+    return size / (1024 * 1024)
+
+def load_ice_servers(value):
+    """--ice-servers takes the same JSON list as the browser's ICE_CONFIG.iceServers"""
+    return json.loads(value) if value else None
+
+async def send(args):
+    completions = Counter()
+    finished = asyncio.Event()
+
+    def downloaded(file_id, downloader_id):
+        if file_id not in shared:
+            return
+        completions[file_id] += 1
+        print(f"{shared[file_id]} downloaded by {downloader_id} ({completions[file_id]})", flush=True)
+        if args.downloads and all(completions[file_id] >= args.downloads for file_id in shared):
+            finished.set()
+
+    peer = ProtocolPeer(args.server, args.room, args.data_channels, ice_servers=load_ice_servers(args.ice_servers),
+                        on_downloaded=downloaded)
+    await peer.join()
+    shared = {}
+    for path in args.files:
+        if not os.path.isfile(path):
+            print(f"Skipping {path}: not a file", file=sys.stderr)
+            continue
+        shared[peer.share_file(path)] = os.path.basename(path)
+    if not shared:
+        await peer.leave()
+        return 1
+
+    await peer.broadcast_file_list()
+    total = sum(entry['source'].size for entry in peer.shared.values())
+    print(f"Sharing {len(shared)} file(s), {megabytes(total):.1f} MB, in room {args.room} as peer {peer.peer_id}",
+          flush=True)
+    try:
+        await finished.wait()
+    finally:
+        await peer.leave()
+    return 0
+
+async def recv(args):
+    os.makedirs(args.out, exist_ok=True)
+    peer = ProtocolPeer(args.server, args.room, args.data_channels, ice_servers=load_ice_servers(args.ice_servers))
+    await peer.join()
+    print(f"Joined room {args.room} as peer {peer.peer_id}", flush=True)
+
+    def wanted():
+        chosen = {}
+        for owner, listing in peer.listings.items():
+            if args.from_peer and owner != args.from_peer:
+                continue
+            for file_id, entry in listing.items():
+                name = entry.get('fileName', file_id)
+                if args.names and not any(fnmatch.fnmatch(name, pattern) or pattern == file_id
+                                          for pattern in args.names):
+                    continue
+                chosen.setdefault(file_id, (owner, entry))
+        return chosen
+
+    # Listings trickle in from the server and from each connection; wait for them to settle
+    deadline = time.time() + args.wait
+    while time.time() < deadline:
+        before = len(wanted())
+        peer.listings_changed.clear()
+        try:
+            await asyncio.wait_for(peer.listings_changed.wait(), 1 if before else deadline - time.time())
+        except asyncio.TimeoutError:
+            if before:
+                break
+    files = wanted()
+    if not files:
+        print("No matching files are shared in this room", file=sys.stderr)
+        await peer.leave()
+        return 1
+
+    limit = asyncio.Semaphore(args.concurrency)
+    results = []
+
+    async def fetch(file_id, owner, entry):
+        async with limit:
+            name = entry.get('fileName', file_id)
+            path = unique_path(args.out, name)
+            try:
+                download = await peer.download_file(owner, file_id, DiskSink(path), args.timeout)
+            except (ConnectionError, asyncio.TimeoutError) as e:
+                print(f"Failed: {name} from {owner}: {e or 'timed out'}", file=sys.stderr, flush=True)
+                return
+            results.append(download)
+            print(f"{path}: {megabytes(download.bytes):.1f} MB in {download.elapsed:.2f}s "
+                  f"({megabytes(download.bytes) / max(download.elapsed, 1e-6):.2f} MB/s)", flush=True)
+
+    print(f"Downloading {len(files)} file(s), {args.concurrency} at a time", flush=True)
+    started = time.time()
+    try:
+        await asyncio.gather(*[fetch(file_id, owner, entry) for file_id, (owner, entry) in files.items()])
+    finally:
+        await peer.leave()
+    elapsed = time.time() - started
+    received = sum(download.bytes for download in results)
+    print(f"Received {len(results)}/{len(files)} file(s), {megabytes(received):.1f} MB in {elapsed:.2f}s "
+          f"({megabytes(received) / max(elapsed, 1e-6):.2f} MB/s)")
+    return 0 if len(results) == len(files) else 1
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m p2p', description="Send or receive files in a room without a browser")
+    parser.add_argument("--server", type=str, default="http://localhost:5000", help="Base URL of the signaling server")
+    parser.add_argument("--room", type=str, required=True, help="Room ID to join")
+    parser.add_argument("--data-channels", type=int, default=DATA_CHANNEL_COUNT, help="Striped data channels per peer")
+    parser.add_argument("--ice-servers", type=str, help="JSON list of ICE servers, e.g. '[{\"urls\": \"stun:...\"}]'")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    send_parser = commands.add_parser('send', help="Share files until they have been downloaded")
+    send_parser.add_argument("files", nargs='+', help="Files to share")
+    send_parser.add_argument("--downloads", type=int, default=0,
+                             help="Exit once every file has been downloaded this many times (0 = serve until interrupted)")
+
+    recv_parser = commands.add_parser('recv', help="Download files shared in the room")
+    recv_parser.add_argument("names", nargs='*', help="File names or glob patterns to fetch (default: everything)")
+    recv_parser.add_argument("--out", type=str, default=".", help="Directory to write files into")
+    recv_parser.add_argument("--from", dest='from_peer', type=str, help="Only fetch files from this peer ID")
+    recv_parser.add_argument("--concurrency", type=int, default=4, help="Files transferred at once")
+    recv_parser.add_argument("--wait", type=float, default=15, help="Seconds to wait for file lists to arrive")
+    recv_parser.add_argument("--timeout", type=float, default=None, help="Give up on a file after this many seconds")
+
+    args = parser.parse_args()
+    try:
+        return asyncio.run(send(args) if args.command == 'send' else recv(args))
+    except KeyboardInterrupt:
+        return 130
+
+
+if __name__ == "__main__":
+    sys.exit(main())
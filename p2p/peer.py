@@ -0,0 +1,519 @@
+import json
+import time
+import zlib
+import secrets
+import asyncio
+from collections import defaultdict
+
+import socketio
+from aiortc import RTCPeerConnection, RTCSessionDescription, RTCConfiguration, RTCIceServer
+from aiortc.sdp import candidate_from_sdp
+
+from .protocol import (CHUNK_SIZE, DATA_CHANNEL_COUNT, CHANNEL_ID_BASE, BUFFER_HIGH_WATER, BUFFER_LOW_WATER,
+                       OFFER_WAIT, HEARTBEAT_INTERVAL, FILE_LIST_PAGE, COMPRESSION_FORMAT,
+                       encode_frame, decode_frame, total_chunks, make_file_id)
+from .storage import MappedFile, PackedFiles
+
+
+class Download:
+    def __init__(self, file_id, file_name, total_chunks, sink=None, peer_id=None):
+        self.file_id = file_id
+        self.peer_id = peer_id
+        self.file_name = file_name
+        self.total_chunks = total_chunks
+        self.sink = sink
+        self.received = set()
+        self.bytes = 0
+        self.requested_at = time.time()
+        self.first_chunk_at = None
+        self.last_progress = -1
+        self.done = asyncio.get_running_loop().create_future()
+
+    def store(self, index, payload):
+        if self.sink:
+            self.sink.write(index * CHUNK_SIZE, payload)
+        self.received.add(index)
+        self.bytes += len(payload)
+        return len(self.received) == self.total_chunks
+
+    def finish(self, now):
+        if self.sink:
+            self.sink.finish()
+        if not self.done.done():
+            self.done.set_result(now)
+
+    def abort(self, reason):
+        if self.sink and not self.done.done():
+            self.sink.abort()
+        if not self.done.done():
+            self.done.set_exception(ConnectionError(reason))
+
+    @property
+    def elapsed(self):
+        return self.done.result() - self.requested_at
+
+
+class PeerConnection:
+    """One aiortc connection to another room member, with the SimplePeer
+    control channel and the striped negotiated data channels"""
+
+    def __init__(self, owner, remote_id, initiator):
+        self.owner = owner
+        self.remote_id = remote_id
+        self.initiator = initiator
+        self.pc = RTCPeerConnection(RTCConfiguration(iceServers=owner.ice_servers))
+        self.control = None
+        self.data_channels = []
+        self.remote_channel_count = 0
+        self.open_channel_count = 0
+        self.announced = False
+        self.next_channel = 0
+        self.drained = asyncio.Event()
+        self.files = {}
+        self.uploads = {}
+        self.batch_requests = {}
+        self.started_at = time.time()
+        self.connected_at = None
+        self.connected = asyncio.get_running_loop().create_future()
+
+        @self.pc.on('datachannel')
+        def on_datachannel(channel):
+            if self.control is None:
+                self.attach_control(channel)
+
+        @self.pc.on('connectionstatechange')
+        async def on_state():
+            if self.pc.connectionState in ('failed', 'closed'):
+                await self.owner.drop_connection(self.remote_id, self)
+
+    def attach_control(self, channel):
+        self.control = channel
+
+        @channel.on('open')
+        def on_open():
+            self.on_connected()
+
+        @channel.on('message')
+        def on_message(message):
+            self.owner.handle_message(self, message)
+
+        if channel.readyState == 'open':
+            self.on_connected()
+
+    def open_data_channels(self):
+        for i in range(self.owner.data_channel_count):
+            channel = self.pc.createDataChannel(f"p2p-data-{i}", negotiated=True, id=CHANNEL_ID_BASE + i,
+                                                ordered=self.owner.ordered)
+            channel.bufferedAmountLowThreshold = BUFFER_LOW_WATER
+
+            @channel.on('open')
+            def on_open():
+                self.open_channel_count += 1
+                self.announce_channels()
+
+            channel.on('message', lambda message: self.owner.handle_message(self, message))
+            channel.on('bufferedamountlow', self.drained.set)
+            self.data_channels.append(channel)
+
+    def announce_channels(self):
+        """channels-ready goes over the control channel once it and every striped channel are open"""
+        ready = self.data_channels and self.open_channel_count == len(self.data_channels)
+        if ready and not self.announced and self.control is not None and self.control.readyState == 'open':
+            self.announced = True
+            self.send_control({'type': 'channels-ready', 'count': self.open_channel_count})
+
+    def on_connected(self):
+        if self.connected.done():
+            return
+        self.connected_at = time.time()
+        self.connected.set_result(self.connected_at - self.started_at)
+        self.send_control({'type': 'file-list', 'files': self.owner.advertised_files()})
+        self.announce_channels()
+
+    def send_control(self, message):
+        if self.control is not None and self.control.readyState == 'open':
+            self.control.send(json.dumps(message))
+
+    def usable_channels(self):
+        return [channel for channel in self.data_channels[:self.remote_channel_count]
+                if channel.readyState == 'open']
+
+    async def send_frame(self, frame):
+        """Send on the next striped channel with room, or the control channel without them"""
+        while True:
+            channels = self.usable_channels() or ([self.control] if self.control else [])
+            for _ in range(len(channels)):
+                channel = channels[self.next_channel % len(channels)]
+                self.next_channel = (self.next_channel + 1) % len(channels)
+                if channel.bufferedAmount < BUFFER_HIGH_WATER:
+                    channel.send(frame)
+                    return
+            if not channels or self.pc.connectionState in ('failed', 'closed'):
+                raise ConnectionError(f"No open channel to {self.remote_id}")
+            self.drained.clear()
+            try:
+                await asyncio.wait_for(self.drained.wait(), 0.05)
+            except asyncio.TimeoutError:
+                pass
+
+    def flushed(self):
+        """Whether everything sent has been acknowledged; aiortc only exposes this through SCTP internals"""
+        sctp = self.pc.sctp
+        if sctp is None:
+            return True
+        return not (sctp._data_channel_queue or sctp._outbound_queue or sctp._sent_queue)
+
+    async def close(self):
+        for task in self.uploads.values():
+            task.cancel()
+        # Let the last control messages (e.g. the final download-progress) go out first
+        deadline = time.time() + 1
+        while self.control is not None and self.control.readyState == 'open' and time.time() < deadline:
+            if self.flushed():
+                break
+            await asyncio.sleep(0.02)
+        await self.pc.close()
+
+
+class ProtocolPeer:
+    """A room member without a browser: Socket.IO signaling against the real
+    server and aiortc connections speaking the browser's data-channel protocol"""
+
+    def __init__(self, base_url, room_id, data_channel_count=DATA_CHANNEL_COUNT, ordered=False,
+                 ice_servers=None, on_chunk_sent=None, on_chunk_received=None, on_downloaded=None):
+        self.base_url = base_url
+        self.room_id = room_id
+        self.data_channel_count = data_channel_count
+        self.ordered = ordered
+        self.ice_servers = [RTCIceServer(**server) for server in (ice_servers or [])]
+        self.on_chunk_sent = on_chunk_sent
+        self.on_chunk_received = on_chunk_received
+        self.on_downloaded = on_downloaded
+        self.sio = socketio.AsyncClient()
+        self.peer_id = None
+        self.registered = None
+        self.listings_changed = asyncio.Event()
+        self.connections = {}
+        self.offer_timers = {}
+        self.signal_locks = defaultdict(asyncio.Lock)
+        self.listings = {}
+        self.shared = {}
+        self.batches = {}
+        self.downloads = {}
+        self.heartbeat_task = None
+        self.heartbeat_interval = HEARTBEAT_INTERVAL
+
+        self.sio.on('registered', self.on_registered)
+        self.sio.on('room_peers', self.on_room_peers)
+        self.sio.on('peer_joined', lambda data: self.connect_to(data['peer_id']))
+        self.sio.on('peer_disconnected', self.on_peer_disconnected)
+        self.sio.on('signal', self.on_signal)
+        self.sio.on('file_list', self.on_file_list)
+
+    async def join(self):
+        self.registered = asyncio.get_running_loop().create_future()
+        await self.sio.connect(self.base_url)
+        await self.sio.emit('join_room', {'room_id': self.room_id, 'peer_id': self.peer_id})
+        await asyncio.wait_for(self.registered, 30)
+        if self.heartbeat_interval:
+            self.heartbeat_task = asyncio.create_task(self.heartbeat())
+        return self.peer_id
+
+    async def leave(self):
+        if self.heartbeat_task:
+            self.heartbeat_task.cancel()
+        for connection in list(self.connections.values()):
+            await connection.close()
+        self.connections.clear()
+        for download in self.downloads.values():
+            download.abort("Left the room")
+        for entry in self.shared.values():
+            entry['source'].close()
+        await self.sio.disconnect()
+
+    async def heartbeat(self):
+        while True:
+            await self.sio.emit('heartbeat', {'room_id': self.room_id, 'peer_id': self.peer_id})
+            await asyncio.sleep(self.heartbeat_interval)
+
+    # Signaling
+
+    def on_registered(self, data):
+        self.peer_id = data['peer_id']
+        # Liveness comes from Engine.IO pings unless the server asks for heartbeats
+        self.heartbeat_interval = data.get('heartbeat_interval', HEARTBEAT_INTERVAL)
+        if not self.registered.done():
+            self.registered.set_result(self.peer_id)
+        for peer_id in data.get('peers', []):
+            self.connect_to(peer_id)
+
+    def on_room_peers(self, data):
+        if self.peer_id:
+            for peer_id in data.get('peers', []):
+                self.connect_to(peer_id)
+
+    async def on_peer_disconnected(self, data):
+        self.listings.pop(data['peer_id'], None)
+        connection = self.connections.get(data['peer_id'])
+        if connection:
+            await self.drop_connection(data['peer_id'], connection)
+
+    def on_file_list(self, data):
+        if data.get('from') and data['from'] != self.peer_id:
+            self.add_listing(data['from'], data.get('files'))
+
+    def add_listing(self, peer_id, files):
+        listing = self.listings.setdefault(peer_id, {})
+        for entry in files or []:
+            listing[entry['fileId']] = entry
+        self.listings_changed.set()
+
+    async def send_signal(self, to, signal):
+        await self.sio.emit('signal', {'room_id': self.room_id, 'from': self.peer_id, 'to': to, 'signal': signal})
+
+    def connect_to(self, peer_id, immediate=False):
+        """The lower ID of a pair makes the offer; the other side nudges it if none comes"""
+        if not self.peer_id or peer_id == self.peer_id or peer_id in self.connections:
+            return
+        if self.peer_id < peer_id:
+            asyncio.ensure_future(self.make_offer(peer_id))
+        elif peer_id not in self.offer_timers:
+            # Peers outside a large room's neighbour set won't offer on their own
+            self.offer_timers[peer_id] = asyncio.get_running_loop().call_later(
+                0 if immediate else OFFER_WAIT, lambda: asyncio.ensure_future(self.request_offer(peer_id)))
+
+    async def open_on_demand(self, peer_id, timeout=15):
+        """Connect to a peer for a transfer, returning the open connection"""
+        self.connect_to(peer_id, immediate=True)
+        deadline = time.time() + timeout
+        while peer_id not in self.connections:
+            if time.time() > deadline:
+                raise ConnectionError(f"Peer {peer_id} did not connect")
+            await asyncio.sleep(0.05)
+        connection = self.connections[peer_id]
+        await asyncio.wait_for(connection.connected, max(deadline - time.time(), 0.1))
+        return connection
+
+    async def request_offer(self, peer_id):
+        self.offer_timers.pop(peer_id, None)
+        if peer_id not in self.connections:
+            await self.send_signal(peer_id, {'type': 'connect-request'})
+
+    async def make_offer(self, peer_id):
+        connection = PeerConnection(self, peer_id, initiator=True)
+        self.connections[peer_id] = connection
+        connection.attach_control(connection.pc.createDataChannel(secrets.token_hex(20)))
+        connection.open_data_channels()
+        # aiortc gathers every candidate before the description is set, so nothing trickles
+        await connection.pc.setLocalDescription(await connection.pc.createOffer())
+        await self.send_signal(peer_id, {'type': 'offer', 'sdp': connection.pc.localDescription.sdp})
+
+    async def on_signal(self, data):
+        peer_id = data.get('from')
+        # Candidates trickled by browsers must not overtake the description they belong to
+        async with self.signal_locks[peer_id]:
+            await self.handle_signal(peer_id, data.get('signal') or {})
+
+    async def handle_signal(self, peer_id, signal):
+        if signal.get('type') == 'connect-request':
+            existing = self.connections.get(peer_id)
+            if existing is None or existing.connected.done():
+                if existing:
+                    await self.drop_connection(peer_id, existing)
+                await self.make_offer(peer_id)
+            return
+
+        if signal.get('type') == 'offer':
+            timer = self.offer_timers.pop(peer_id, None)
+            if timer:
+                timer.cancel()
+            existing = self.connections.pop(peer_id, None)
+            if existing:
+                await existing.close()
+            connection = PeerConnection(self, peer_id, initiator=False)
+            self.connections[peer_id] = connection
+            connection.open_data_channels()
+            await connection.pc.setRemoteDescription(RTCSessionDescription(sdp=signal['sdp'], type='offer'))
+            await connection.pc.setLocalDescription(await connection.pc.createAnswer())
+            await self.send_signal(peer_id, {'type': 'answer', 'sdp': connection.pc.localDescription.sdp})
+            return
+
+        connection = self.connections.get(peer_id)
+        if connection is None:
+            return
+        if signal.get('type') == 'answer':
+            await connection.pc.setRemoteDescription(RTCSessionDescription(sdp=signal['sdp'], type='answer'))
+        elif signal.get('candidate'):
+            # Trickled by browser peers
+            candidate = signal['candidate']
+            if candidate.get('candidate'):
+                ice = candidate_from_sdp(candidate['candidate'].split(':', 1)[1])
+                ice.sdpMid = candidate.get('sdpMid')
+                ice.sdpMLineIndex = candidate.get('sdpMLineIndex')
+                await connection.pc.addIceCandidate(ice)
+
+    async def drop_connection(self, peer_id, connection):
+        if self.connections.get(peer_id) is connection:
+            del self.connections[peer_id]
+            for download in self.downloads.values():
+                if download.peer_id == peer_id:
+                    download.abort(f"Lost the connection to {peer_id}")
+        await connection.close()
+
+    # Files
+
+    def share(self, source):
+        """Offer a MappedFile/MemoryFile to the room; returns its file ID"""
+        file_id = make_file_id(self.peer_id, source.name)
+        self.shared[file_id] = {'fileName': source.name, 'source': source}
+        return file_id
+
+    def share_file(self, path):
+        return self.share(MappedFile(path))
+
+    def advertised_files(self):
+        return [{'fileId': file_id, 'fileName': entry['fileName'], 'size': entry['source'].size, 'contentId': None}
+                for file_id, entry in self.shared.items()]
+
+    async def broadcast_file_list(self):
+        files = self.advertised_files()
+        for offset in range(0, max(len(files), 1), FILE_LIST_PAGE):
+            await self.sio.emit('file_list', {
+                'room_id': self.room_id,
+                'from': self.peer_id,
+                'files': files[offset:offset + FILE_LIST_PAGE]
+            })
+        for connection in self.connections.values():
+            connection.send_control({'type': 'file-list', 'files': files})
+
+    def listing_for(self, peer_id, file_id):
+        connection = self.connections.get(peer_id)
+        return (connection and connection.files.get(file_id)) or self.listings.get(peer_id, {}).get(file_id, {})
+
+    def request_file(self, peer_id, file_id, sink=None):
+        connection = self.connections[peer_id]
+        listing = self.listing_for(peer_id, file_id)
+        download = Download(file_id, listing.get('fileName', file_id), total_chunks(listing.get('size', 0)),
+                            sink, peer_id)
+        self.downloads[file_id] = download
+        connection.send_control({'type': 'file-request', 'fileId': file_id, 'compression': COMPRESSION_FORMAT})
+        return download
+
+    async def download_file(self, peer_id, file_id, sink=None, timeout=None):
+        """Connect if need be, fetch one file and wait for it; returns the Download"""
+        connection = await self.open_on_demand(peer_id)
+        while connection.remote_channel_count == 0 and self.data_channel_count:
+            # Until channels-ready arrives everything would squeeze through the control channel
+            if time.time() - connection.connected_at > 5:
+                break
+            await asyncio.sleep(0.01)
+        download = self.request_file(peer_id, file_id, sink)
+        try:
+            await asyncio.wait_for(asyncio.shield(download.done), timeout)
+        except asyncio.TimeoutError:
+            connection.send_control({'type': 'file-cancel', 'fileId': file_id})
+            download.abort("Timed out")
+            raise
+        finally:
+            self.downloads.pop(file_id, None)
+        return download
+
+    def handle_message(self, connection, message):
+        try:
+            header, payload = decode_frame(message)
+        except ValueError:
+            return
+        kind = header.get('type')
+        if kind == 'file-list':
+            for entry in header.get('files') or []:
+                connection.files[entry['fileId']] = entry
+            self.add_listing(connection.remote_id, header.get('files'))
+        elif kind == 'file-request':
+            self.start_upload(connection, header['fileId'], header.get('chunks'), header.get('as'))
+        elif kind == 'batch-request':
+            self.handle_batch_request(connection, header['batchId'], header.get('files') or [],
+                                      not header.get('more'))
+        elif kind == 'file-cancel':
+            task = connection.uploads.pop(header['fileId'], None)
+            if task and not header.get('chunks'):
+                task.cancel()
+        elif kind == 'file-data':
+            self.store_chunk(connection, header, payload)
+        elif kind == 'manifest-request':
+            # Nothing we share carries a content ID, so there is no manifest to give
+            connection.send_control({'type': 'manifest', 'fileId': header.get('fileId'), 'unavailable': True})
+        elif kind == 'channels-ready':
+            connection.remote_channel_count = header.get('count', 0)
+        elif kind == 'ping':
+            connection.send_control({'type': 'pong', 'timestamp': header.get('timestamp')})
+        elif kind == 'bye':
+            asyncio.ensure_future(self.drop_connection(connection.remote_id, connection))
+        elif kind == 'download-progress' and header.get('completed') and self.on_downloaded:
+            for file_id in self.batches.pop(header['fileId'], [header['fileId']]):
+                self.on_downloaded(file_id, header.get('downloaderId'))
+
+    def handle_batch_request(self, connection, batch_id, file_ids, complete):
+        """Batches come in pages of IDs; the last one is answered with a packed stream"""
+        requested = connection.batch_requests.pop(batch_id, []) + file_ids
+        if not complete:
+            connection.batch_requests[batch_id] = requested
+            return
+        available = [file_id for file_id in requested if file_id in self.shared]
+        self.batches[batch_id] = available
+        packed = PackedFiles([(file_id, self.shared[file_id]['source']) for file_id in available])
+        self.start_upload(connection, batch_id, None, None, {'fileName': packed.name, 'source': packed})
+
+    def start_upload(self, connection, file_id, chunks, alias, entry=None):
+        entry = entry or self.shared.get(file_id)
+        if entry is None:
+            return
+        count = total_chunks(entry['source'].size)
+        indices = chunks if chunks is not None else range(count)
+        connection.uploads[file_id] = asyncio.ensure_future(
+            self.upload(connection, file_id, entry, indices, count, alias))
+
+    async def upload(self, connection, file_id, entry, indices, count, alias):
+        source = entry['source']
+        header = {'type': 'file-data', 'fileId': alias or file_id, 'fileName': entry['fileName'],
+                  'totalChunks': count}
+        try:
+            for index in indices:
+                frame = encode_frame({**header, 'chunkIndex': index},
+                                     source.read(index * CHUNK_SIZE, (index + 1) * CHUNK_SIZE))
+                await connection.send_frame(frame)
+                if self.on_chunk_sent:
+                    self.on_chunk_sent(alias or file_id, index)
+        except ConnectionError:
+            pass
+        finally:
+            if connection.uploads.get(file_id) is asyncio.current_task():
+                del connection.uploads[file_id]
+
+    def store_chunk(self, connection, header, payload):
+        download = self.downloads.get(header['fileId'])
+        index = header['chunkIndex']
+        if download is None or index in download.received or download.done.done():
+            return
+        if header.get('compressed') == COMPRESSION_FORMAT:
+            payload = zlib.decompress(payload, -15)
+        now = time.time()
+        download.first_chunk_at = download.first_chunk_at or now
+        download.total_chunks = header.get('totalChunks', download.total_chunks)
+        completed = download.store(index, payload)
+        if self.on_chunk_received:
+            self.on_chunk_received(header['fileId'], index)
+
+        progress = len(download.received) * 100 // download.total_chunks
+        if progress % 10 == 0 and progress != download.last_progress:
+            download.last_progress = progress
+            connection.send_control({
+                'type': 'download-progress',
+                'fileId': download.file_id,
+                'fileName': download.file_name,
+                'progress': progress,
+                'downloaderId': self.peer_id,
+                'completed': completed,
+                'error': None
+            })
+        if completed:
+            download.finish(now)
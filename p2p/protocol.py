@@ -0,0 +1,40 @@
+import re
+import json
+import time
+import struct
+
+# Must match the browser client (file_transfer.js, channels.js, peer.js, batch.js)
+CHUNK_SIZE = 16384
+DATA_CHANNEL_COUNT = 4
+CHANNEL_ID_BASE = 100
+BUFFER_HIGH_WATER = 1024 * 1024
+BUFFER_LOW_WATER = 256 * 1024
+OFFER_WAIT = 3
+HEARTBEAT_INTERVAL = 5      # for servers that don't announce heartbeat_interval
+FILE_LIST_PAGE = 1000
+COMPRESSION_FORMAT = 'deflate-raw'
+BATCH_HEADER = struct.Struct('>HII')   # path length, size high word, size low word
+
+def encode_frame(header, payload):
+    """[JSON header, separator (0x00), binary data], as the browser's transfer worker builds it"""
+    return json.dumps(header, separators=(',', ':')).encode() + b'\x00' + payload
+
+def decode_frame(data):
+    if isinstance(data, str):
+        data = data.encode()
+    separator = data.find(b'\x00')
+    header = data if separator == -1 else data[:separator]
+    payload = b'' if separator == -1 else memoryview(data)[separator + 1:]
+    return json.loads(header), payload
+
+def total_chunks(size):
+    return max(1, -(-size // CHUNK_SIZE))
+
+def make_file_id(peer_id, file_name):
+    """Same shape as the browser's IDs: owner, timestamp and name, with anything unusual replaced"""
+    return re.sub(r'[^a-zA-Z0-9._-]', '_', f"{peer_id}-{int(time.time() * 1000)}-{file_name}")
+
+def batch_entry_header(path, size):
+    """Per-file header of a packed batch (packFiles in batch.js)"""
+    encoded = path.encode()
+    return BATCH_HEADER.pack(len(encoded), size >> 32, size & 0xFFFFFFFF) + encoded
@@ -0,0 +1,105 @@
+import os
+import mmap
+import bisect
+
+from .protocol import batch_entry_header
+
+
+class MappedFile:
+    """A shared file read straight from the page cache; chunks are sliced out
+    of the mapping as they are sent, so nothing is loaded up front"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # Zero-length files can't be mapped
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b''
+        if self.size and hasattr(mmap, 'MADV_SEQUENTIAL'):
+            self.data.madvise(mmap.MADV_SEQUENTIAL)
+
+    def read(self, start, end):
+        return self.data[start:end]
+
+    def close(self):
+        if self.size:
+            self.data.close()
+
+
+class MemoryFile:
+    """Shared bytes that never touched the disk (benchmarks, generated data)"""
+
+    def __init__(self, name, data):
+        self.name = name
+        self.size = len(data)
+        self.data = memoryview(data)
+
+    def read(self, start, end):
+        return self.data[start:end].tobytes()
+
+    def close(self):
+        pass
+
+
+class PackedFiles:
+    """Several shared files served as one batch stream, in the browser's
+    packFiles layout, without building the stream in memory"""
+
+    def __init__(self, entries):
+        self.name = f"{len(entries)} files"
+        self.segments = []
+        self.offsets = []
+        self.size = 0
+        for path, source in entries:
+            for segment in (MemoryFile(path, batch_entry_header(path, source.size)), source):
+                self.offsets.append(self.size)
+                self.segments.append(segment)
+                self.size += segment.size
+
+    def read(self, start, end):
+        parts = []
+        index = bisect.bisect_right(self.offsets, start) - 1
+        while start < end and index < len(self.segments):
+            segment, offset = self.segments[index], self.offsets[index]
+            part = segment.read(start - offset, min(end, offset + segment.size) - offset)
+            parts.append(part)
+            start += len(part)
+            index += 1
+        return b''.join(parts)
+
+    def close(self):
+        pass
+
+
+class DiskSink:
+    """Chunks written where they belong in the output file as they arrive,
+    in whatever order; the file only takes its name once complete"""
+
+    def __init__(self, path):
+        self.path = path
+        self.partial = path + '.part'
+        self.file = open(self.partial, 'wb')
+
+    def write(self, offset, payload):
+        self.file.seek(offset)
+        self.file.write(payload)
+
+    def finish(self):
+        self.file.close()
+        os.replace(self.partial, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.partial)
+
+
+def unique_path(directory, file_name):
+    """A path in directory for file_name that doesn't clobber an existing file"""
+    base, extension = os.path.splitext(os.path.basename(file_name) or 'download')
+    path = os.path.join(directory, base + extension)
+    copy = 1
+    while os.path.exists(path) or os.path.exists(path + '.part'):
+        path = os.path.join(directory, f"{base} ({copy}){extension}")
+        copy += 1
+    return path
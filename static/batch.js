@@ -0,0 +1,187 @@
+// Many files sent back to back as a single transfer. Each file is preceded by
+// a compact header, so the stream unpacks in order without an index:
+//   [u16 path length][u32 size high][u32 size low][path, UTF-8][file bytes]
+// Packing only concatenates Blobs, so nothing is read or copied up front.
+
+const HEADER_BYTES = 10;
+const UNPACK_WINDOW = 1024 * 1024;     // bytes read at a time while walking headers
+
+export function packFiles(entries) {
+    const encoder = new TextEncoder();
+    const parts = [];
+    entries.forEach(({ path, blob }) => {
+        const pathBytes = encoder.encode(path);
+        const header = new Uint8Array(HEADER_BYTES + pathBytes.byteLength);
+        const view = new DataView(header.buffer);
+        view.setUint16(0, pathBytes.byteLength);
+        view.setUint32(2, Math.floor(blob.size / 2 ** 32));
+        view.setUint32(6, blob.size % 2 ** 32);
+        header.set(pathBytes, HEADER_BYTES);
+        parts.push(header, blob);
+    });
+    return new Blob(parts, { type: 'application/octet-stream' });
+}
+
+// Split a packed Blob back into [{ path, blob }]; file contents stay lazy slices
+export async function unpackFiles(packed) {
+    const decoder = new TextDecoder();
+    let bufferStart = 0;
+    let buffer = new Uint8Array(0);
+
+    const readAt = async (offset, length) => {
+        if (offset < bufferStart || offset + length > bufferStart + buffer.byteLength) {
+            bufferStart = offset;
+            buffer = new Uint8Array(await packed.slice(offset, offset + Math.max(length, UNPACK_WINDOW)).arrayBuffer());
+        }
+        return buffer.subarray(offset - bufferStart, offset - bufferStart + length);
+    };
+
+    const entries = [];
+    let offset = 0;
+    while (offset < packed.size) {
+        const header = await readAt(offset, HEADER_BYTES);
+        if (header.byteLength < HEADER_BYTES) {
+            throw new Error("Truncated file header in batch");
+        }
+        const view = new DataView(header.buffer, header.byteOffset, HEADER_BYTES);
+        const pathLength = view.getUint16(0);
+        const size = view.getUint32(2) * 2 ** 32 + view.getUint32(6);
+        const path = decoder.decode(await readAt(offset + HEADER_BYTES, pathLength));
+
+        const start = offset + HEADER_BYTES + pathLength;
+        if (start + size > packed.size) {
+            throw new Error(`Truncated file ${path} in batch`);
+        }
+        entries.push({ path, blob: packed.slice(start, start + size) });
+        offset = start + size;
+    }
+    return entries;
+}
+
+function writeField(header, offset, length, value) {
+    const bytes = new TextEncoder().encode(value);
+    header.set(bytes.subarray(0, length), offset);
+}
+
+function octal(value, length) {
+    return value.toString(8).padStart(length - 1, '0');
+}
+
+// Split a path into ustar's 155-byte prefix and 100-byte name
+function splitTarPath(path) {
+    const bytes = new TextEncoder().encode(path);
+    if (bytes.byteLength <= 100) return ['', path];
+    for (let cut = path.indexOf('/'); cut !== -1; cut = path.indexOf('/', cut + 1)) {
+        const prefix = path.slice(0, cut);
+        const name = path.slice(cut + 1);
+        if (new TextEncoder().encode(prefix).byteLength <= 155 &&
+            new TextEncoder().encode(name).byteLength <= 100) {
+            return [prefix, name];
+        }
+    }
+    console.warn(`Path too long for tar, truncating: ${path}`);
+    return ['', path.slice(-100)];
+}
+
+function tarHeader(path, size, mtime) {
+    const header = new Uint8Array(512);
+    const [prefix, name] = splitTarPath(path);
+    writeField(header, 0, 100, name);
+    writeField(header, 100, 8, '0000644');
+    writeField(header, 108, 8, '0000000');
+    writeField(header, 116, 8, '0000000');
+    writeField(header, 124, 12, octal(size, 12));
+    writeField(header, 136, 12, octal(mtime, 12));
+    writeField(header, 148, 8, '        ');   // checksum counts as spaces
+    writeField(header, 156, 1, '0');
+    writeField(header, 257, 6, 'ustar');
+    writeField(header, 263, 2, '00');
+    writeField(header, 345, 155, prefix);
+
+    const checksum = header.reduce((sum, byte) => sum + byte, 0);
+    writeField(header, 148, 8, octal(checksum, 7) + '\0');
+    return header;
+}
+
+// A tar archive of the entries, as a Blob that streams the file contents when saved
+export function buildTar(entries) {
+    const mtime = Math.floor(Date.now() / 1000);
+    const parts = [];
+    entries.forEach(({ path, blob }) => {
+        parts.push(tarHeader(path, blob.size, mtime), blob);
+        const padding = (512 - blob.size % 512) % 512;
+        if (padding) {
+            parts.push(new Uint8Array(padding));
+        }
+    });
+    parts.push(new Uint8Array(1024)); // end-of-archive marker
+    return new Blob(parts, { type: 'application/x-tar' });
+}
+
+export function canSaveToDirectory() {
+    return typeof window.showDirectoryPicker === 'function';
+}
+
+// Write the entries into a directory the user picks, streaming each file
+export async function saveToDirectory(entries) {
+    const root = await window.showDirectoryPicker({ mode: 'readwrite' });
+    const directories = new Map([['', root]]);
+
+    for (const { path, blob } of entries) {
+        const parts = path.split('/').filter(part => part && part !== '.' && part !== '..');
+        const name = parts.pop();
+        if (!name) continue;
+
+        let directory = root;
+        let key = '';
+        for (const part of parts) {
+            key += '/' + part;
+            if (!directories.has(key)) {
+                directories.set(key, await directory.getDirectoryHandle(part, { create: true }));
+            }
+            directory = directories.get(key);
+        }
+        const handle = await directory.getFileHandle(name, { create: true });
+        await blob.stream().pipeTo(await handle.createWritable());
+    }
+}
+
+// Dropped folders as { folderName: [{ path, blob }] }, plus any loose files.
+// Entries have to be taken from the DataTransfer before the drop handler yields.
+export async function readDroppedItems(dataTransfer) {
+    const entries = Array.from(dataTransfer.items || [])
+        .map(item => item.webkitGetAsEntry ? item.webkitGetAsEntry() : null);
+    const looseFiles = [];
+    const folders = {};
+
+    if (entries.length === 0 || entries.some(entry => !entry)) {
+        return { looseFiles: Array.from(dataTransfer.files), folders };
+    }
+
+    for (const entry of entries) {
+        if (entry.isFile) {
+            looseFiles.push(await new Promise((resolve, reject) => entry.file(resolve, reject)));
+        } else if (entry.isDirectory) {
+            folders[entry.name] = [];
+            await walkDirectory(entry, '', folders[entry.name]);
+        }
+    }
+    return { looseFiles, folders };
+}
+
+async function walkDirectory(directory, prefix, out) {
+    const reader = directory.createReader();
+    // readEntries returns at most ~100 entries per call
+    for (;;) {
+        const batch = await new Promise((resolve, reject) => reader.readEntries(resolve, reject));
+        if (batch.length === 0) break;
+        for (const entry of batch) {
+            const path = prefix + entry.name;
+            if (entry.isFile) {
+                out.push({ path, blob: await new Promise((resolve, reject) => entry.file(resolve, reject)) });
+            } else if (entry.isDirectory) {
+                await walkDirectory(entry, path + '/', out);
+            }
+        }
+    }
+}
@@ -0,0 +1,134 @@
+// Dedicated data channels for file chunks, striped alongside the SimplePeer
+// channel, which is left for control messages (file-list, ping, progress...)
+
+const params = new URLSearchParams(window.location.search);
+
+// ?channels=0 turns striping off, e.g. for benchmarking against a single channel
+export const DATA_CHANNEL_COUNT = params.has('channels') ? parseInt(params.get('channels'), 10) || 0 : 4;
+export const DATA_CHANNEL_ORDERED = params.get('ordered') === '1';
+
+const CHANNEL_ID_BASE = 100;                 // clear of the ids SimplePeer gets assigned
+const BUFFER_HIGH_WATER = 1024 * 1024;       // stop queueing on a channel above this
+const BUFFER_LOW_WATER = 256 * 1024;         // resume once a channel drains below this
+
+// Both sides create the same negotiated channels, so no renegotiation is needed
+export function openDataChannels(peerId, onMessage, onReady) {
+    const peerEntry = peers[peerId];
+    const pc = peerEntry && peerEntry.connection && peerEntry.connection._pc;
+    if (!pc || DATA_CHANNEL_COUNT <= 0) return;
+
+    peerEntry.dataChannels = [];
+    peerEntry.drainCallbacks = [];
+    peerEntry.nextChannel = 0;
+    let opened = 0;
+
+    for (let i = 0; i < DATA_CHANNEL_COUNT; i++) {
+        let channel;
+        try {
+            channel = pc.createDataChannel(`p2p-data-${i}`, {
+                negotiated: true,
+                id: CHANNEL_ID_BASE + i,
+                ordered: DATA_CHANNEL_ORDERED
+            });
+        } catch (error) {
+            console.warn(`Could not open data channel ${i} to peer ${peerId}:`, error);
+            break;
+        }
+        channel.binaryType = 'arraybuffer';
+        channel.bufferedAmountLowThreshold = BUFFER_LOW_WATER;
+
+        channel.onopen = () => {
+            opened++;
+            if (opened === peerEntry.dataChannels.length) {
+                console.log(`Opened ${opened} data channels to peer ${peerId}`);
+                onReady(opened);
+            }
+        };
+        channel.onmessage = (event) => onMessage(event.data);
+        channel.onbufferedamountlow = () => flushDrainCallbacks(peerEntry);
+        channel.onerror = (event) => console.error(`Data channel ${i} error with ${peerId}:`, event);
+
+        peerEntry.dataChannels.push(channel);
+    }
+}
+
+export function closeDataChannels(peerId) {
+    const peerEntry = peers[peerId];
+    if (!peerEntry || !peerEntry.dataChannels) return;
+    peerEntry.dataChannels.forEach(channel => {
+        try {
+            channel.close();
+        } catch (_) {
+            // Already closed with the connection
+        }
+    });
+    peerEntry.dataChannels = null;
+    peerEntry.remoteChannelCount = 0;
+    flushDrainCallbacks(peerEntry);
+}
+
+// Channels both ends have open
+function usableChannels(peerEntry) {
+    if (!peerEntry || !peerEntry.dataChannels || !peerEntry.remoteChannelCount) return [];
+    return peerEntry.dataChannels
+        .slice(0, peerEntry.remoteChannelCount)
+        .filter(channel => channel.readyState === 'open');
+}
+
+export function hasDataChannels(peerId) {
+    return usableChannels(peers[peerId]).length > 0;
+}
+
+// Send on the next channel with room in its buffer; false if every channel is full
+export function sendDataFrame(peerId, frame) {
+    const peerEntry = peers[peerId];
+    const channels = usableChannels(peerEntry);
+    for (let attempt = 0; attempt < channels.length; attempt++) {
+        const channel = channels[peerEntry.nextChannel % channels.length];
+        peerEntry.nextChannel = (peerEntry.nextChannel + 1) % channels.length;
+        if (channel.bufferedAmount < BUFFER_HIGH_WATER) {
+            channel.send(frame);
+            return true;
+        }
+    }
+    return false;
+}
+
+// Whether the peer can take another frame right now
+export function canSendFrame(peerId) {
+    const peerEntry = peers[peerId];
+    const channels = usableChannels(peerEntry);
+    if (channels.length > 0) {
+        return channels.some(channel => channel.bufferedAmount < BUFFER_HIGH_WATER);
+    }
+    const connection = peerEntry && peerEntry.connection;
+    return !!connection && (connection.bufferSize || 0) < BUFFER_HIGH_WATER;
+}
+
+// Send on the striped channels, or the SimplePeer channel without them; false if full
+export function sendFrame(peerId, frame) {
+    if (hasDataChannels(peerId)) {
+        return sendDataFrame(peerId, frame);
+    }
+    const connection = peers[peerId].connection;
+    if ((connection.bufferSize || 0) >= BUFFER_HIGH_WATER) return false;
+    connection.send(frame);
+    return true;
+}
+
+// Run the callback once any data channel to this peer has drained
+export function waitForDrain(peerId, callback) {
+    const peerEntry = peers[peerId];
+    if (!hasDataChannels(peerId)) {
+        // SimplePeer does not expose a drain event; poll its buffer instead
+        setTimeout(callback, 50);
+        return;
+    }
+    peerEntry.drainCallbacks.push(callback);
+}
+
+function flushDrainCallbacks(peerEntry) {
+    const callbacks = peerEntry.drainCallbacks || [];
+    peerEntry.drainCallbacks = [];
+    callbacks.forEach(callback => callback());
+}
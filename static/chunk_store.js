@@ -0,0 +1,136 @@
+// Persistent chunk store: the transfer worker writes received chunks through
+// to IndexedDB, keyed by file ID and chunk index, so a refresh no longer
+// throws a download away. Completed files are restored and shared again on
+// load; partial ones resume when a peer lists them again. Files are kept per
+// room, so nothing received in one room is shared or resumed in another.
+
+import { CHUNK_SIZE } from "./file_transfer.js";
+import { openChunkStore, persistStoredFile, resumeStoredFile, loadStoredFile, renameStoredFile, storeWholeFile, touchStoredFile, computeMerkleRoot } from "./transfer_engine.js";
+import { registerContent, startHashing } from "./content.js";
+import { unpackFiles, buildTar } from "./batch.js";
+import { broadcastFileList, scheduleFileListBroadcast } from "./websocket.js";
+
+const STORE_QUOTA_SHARE = 0.5;              // of the origin's storage quota
+const STORE_QUOTA_MAX = 2 * 1024 ** 3;      // bytes, whatever the browser would allow
+
+let storeOpen = false;
+// Partial downloads left by an earlier page load, keyed by file ID
+const resumable = {};
+
+async function storeQuota() {
+    if (!navigator.storage || !navigator.storage.estimate) return STORE_QUOTA_MAX;
+    try {
+        const { quota } = await navigator.storage.estimate();
+        return quota ? Math.min(STORE_QUOTA_MAX, Math.floor(quota * STORE_QUOTA_SHARE)) : STORE_QUOTA_MAX;
+    } catch (error) {
+        return STORE_QUOTA_MAX;
+    }
+}
+
+// Open the store, bring back completed files and note partial ones
+export async function restoreStoredFiles() {
+    let records;
+    try {
+        records = await openChunkStore(await storeQuota(), roomId);
+    } catch (error) {
+        console.warn("Chunk store unavailable, downloads will not survive a refresh:", error.message);
+        return;
+    }
+    storeOpen = true;
+
+    let restored = 0;
+    for (const record of records) {
+        if (files[record.fileId]) continue;
+        if (!record.complete) {
+            resumable[record.fileId] = record;
+            continue;
+        }
+        const blob = await loadStoredFile(record.fileId);
+        if (!blob) continue;
+        files[record.fileId] = {
+            name: record.name,
+            receivedChunks: record.totalChunks,
+            totalChunks: record.totalChunks,
+            size: blob.size,
+            folder: record.folder || 0,
+            completeBlob: blob
+        };
+        if (record.folder) {
+            files[record.fileId].entries = await unpackFiles(blob);
+            files[record.fileId].completeUrl = URL.createObjectURL(buildTar(files[record.fileId].entries));
+        } else {
+            files[record.fileId].completeUrl = URL.createObjectURL(blob);
+        }
+        // Content IDs stored by an older build are recomputed rather than advertised
+        if (record.contentId && record.chunkHashes &&
+                await computeMerkleRoot(new Uint8Array(record.chunkHashes), blob.size).catch(() => null) === record.contentId) {
+            registerContent(record.fileId, record.contentId, new Uint8Array(record.chunkHashes));
+        } else {
+            startHashing(record.fileId, blob, scheduleFileListBroadcast);
+        }
+        restored++;
+    }
+
+    const partial = Object.keys(resumable).length;
+    if (restored || partial) {
+        console.log(`Chunk store: restored ${restored} file(s), ${partial} partial download(s) to resume`);
+    }
+    if (restored && myPeerId) {
+        broadcastFileList();
+    }
+}
+
+// Write a download's record; its chunks are stored as they arrive
+export function persistDownload(fileId, complete = false) {
+    const file = files[fileId];
+    if (!storeOpen || !file) return;
+    persistStoredFile(fileId, {
+        roomId: roomId,
+        name: file.name,
+        totalChunks: file.totalChunks,
+        folder: file.folder || 0,
+        contentId: file.contentId || null,
+        chunkHashes: file.chunkHashes ? file.chunkHashes.slice().buffer : null,
+        complete: complete
+    }).catch(error => console.warn(`Could not store ${fileId}:`, error.message));
+}
+
+// Files that arrived whole (unpacked from a batch) are stored in one go
+export function storeCompletedFile(fileId, blob) {
+    if (!storeOpen) return;
+    storeWholeFile(fileId, { roomId: roomId, name: files[fileId].name, folder: 0 }, blob, CHUNK_SIZE)
+        .catch(error => console.warn(`Could not store ${fileId}:`, error.message));
+}
+
+// Serving a stored file keeps it from being evicted first
+export function touchStoredDownload(fileId) {
+    if (!storeOpen || !files[fileId] || !files[fileId].totalChunks) return;
+    touchStoredFile(fileId).catch(() => {});
+}
+
+function findResumable(fileId, contentId) {
+    if (resumable[fileId]) return resumable[fileId];
+    return contentId ? Object.values(resumable).find(record => record.contentId === contentId) || null : null;
+}
+
+export function hasStoredDownload(fileId, contentId = null) {
+    return findResumable(fileId, contentId) !== null && !files[fileId];
+}
+
+// Take over a partial download from the store under fileId (the same content
+// may be listed under a new ID). Resolves to { record, indices, bytes } or null.
+export async function claimStoredDownload(fileId, contentId = null) {
+    const record = findResumable(fileId, contentId);
+    if (!record) return null;
+    delete resumable[record.fileId];
+    try {
+        if (record.fileId !== fileId) {
+            await renameStoredFile(record.fileId, fileId);
+        }
+        const { indices, bytes } = await resumeStoredFile(fileId, record.totalChunks);
+        return { record, indices, bytes };
+    } catch (error) {
+        console.warn(`Could not resume ${fileId} from the chunk store:`, error.message);
+        return null;
+    }
+}
@@ -0,0 +1,109 @@
+// Adaptive per-chunk compression for uploads. Each chunk is compressed on its
+// own in the transfer worker, so chunk indices, progress and hash checks are
+// unchanged; a policy per upload samples the first chunks and keeps
+// compressing only while it beats sending the bytes raw over the link.
+
+export const COMPRESSION_FORMAT = 'deflate-raw';
+
+const params = new URLSearchParams(window.location.search);
+// ?compression=0 turns it off, e.g. for benchmarking raw transfers
+const COMPRESSION_ENABLED = params.get('compression') !== '0';
+
+const SAMPLE_CHUNKS = 4;           // chunks compressed before deciding
+const MAX_RATIO = 0.9;             // compressed/raw above this is not worth it
+const PROBE_INTERVAL = 256;        // re-check a disabled upload every this many chunks
+
+// Formats that are already compressed
+const COMPRESSED_EXTENSIONS = new Set([
+    'zip', 'gz', 'tgz', 'bz2', 'xz', 'zst', '7z', 'rar', 'br', 'lz4',
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'avif', 'heic',
+    'mp3', 'm4a', 'aac', 'ogg', 'opus', 'flac',
+    'mp4', 'm4v', 'mov', 'mkv', 'webm', 'avi',
+    'pdf', 'docx', 'xlsx', 'pptx', 'odt', 'jar', 'apk', 'woff2'
+]);
+
+let decompressionSupported = null;
+
+// Whether this browser can decompress what a sender compresses
+export function canDecompress() {
+    if (decompressionSupported === null) {
+        try {
+            new DecompressionStream(COMPRESSION_FORMAT);
+            decompressionSupported = true;
+        } catch (error) {
+            decompressionSupported = false;
+        }
+    }
+    return decompressionSupported;
+}
+
+function looksCompressed(fileName, type) {
+    const extension = (fileName || '').split('.').pop().toLowerCase();
+    if (COMPRESSED_EXTENSIONS.has(extension)) return true;
+    if (!type) return false;
+    return type.startsWith('video/') ||
+        (type.startsWith('image/') && type !== 'image/svg+xml' && type !== 'image/bmp') ||
+        (type.startsWith('audio/') && type !== 'audio/wav');
+}
+
+// Policy for one upload, or null if the receiver can't decompress or the file won't shrink
+export function createCompressionPolicy(fileName, type, format) {
+    if (!COMPRESSION_ENABLED || format !== COMPRESSION_FORMAT || typeof CompressionStream === 'undefined') {
+        return null;
+    }
+    if (looksCompressed(fileName, type)) {
+        console.log(`Not compressing ${fileName}: already a compressed format`);
+        return null;
+    }
+    return {
+        fileName: fileName,
+        enabled: true,
+        sampled: 0,
+        sinceProbe: 0,
+        rawBytes: 0,
+        compressedBytes: 0,
+        compressMs: 0
+    };
+}
+
+// Whether to compress the next chunk; disabled uploads still probe now and then
+export function shouldCompress(policy) {
+    if (!policy) return false;
+    if (policy.enabled) return true;
+    policy.sinceProbe++;
+    if (policy.sinceProbe >= PROBE_INTERVAL) {
+        policy.sinceProbe = 0;
+        return true;
+    }
+    return false;
+}
+
+// Feed back a compressed chunk and re-decide. linkRate is the peer's measured
+// wire rate in bytes/s (0 if unknown yet).
+export function recordCompression(policy, rawBytes, compressedBytes, compressMs, linkRate) {
+    if (!policy || rawBytes === 0) return;
+
+    // Smooth once past the sample so the policy follows changes within the file
+    if (policy.sampled >= SAMPLE_CHUNKS) {
+        policy.rawBytes *= 0.9;
+        policy.compressedBytes *= 0.9;
+        policy.compressMs *= 0.9;
+    }
+    policy.sampled++;
+    policy.rawBytes += rawBytes;
+    policy.compressedBytes += compressedBytes;
+    policy.compressMs += compressMs;
+    if (policy.sampled < SAMPLE_CHUNKS) return;
+
+    const ratio = policy.compressedBytes / policy.rawBytes;
+    const compressRate = policy.compressMs > 0 ? policy.rawBytes / (policy.compressMs / 1000) : Infinity;
+
+    // Sending n bytes raw takes n/link; compressed it takes n*ratio/link + n/compressRate
+    const wins = ratio < MAX_RATIO && (!linkRate || linkRate < compressRate * (1 - ratio));
+    if (wins !== policy.enabled) {
+        console.log(`${wins ? 'Compressing' : 'Not compressing'} ${policy.fileName}: ratio ${ratio.toFixed(2)}, ` +
+            `compression ${(compressRate / 1024 / 1024).toFixed(1)} MB/s, link ${(linkRate / 1024 / 1024).toFixed(1)} MB/s`);
+        policy.enabled = wins;
+        policy.sinceProbe = 0;
+    }
+}
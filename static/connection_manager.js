@@ -0,0 +1,76 @@
+// Connection setup helpers: the ICE configuration served with the room page,
+// RTCPeerConnections warmed up ahead of time so candidate gathering overlaps
+// page load and signaling, and time-to-open measurements.
+
+const WARM_POOL_SIZE = 2;          // pre-gathering connections kept ready
+
+const warmConnections = [];
+const timings = [];
+
+export function getIceConfig() {
+    const config = (typeof ICE_CONFIG !== 'undefined' && ICE_CONFIG) || {};
+    const iceConfig = {
+        iceServers: config.iceServers || [{ urls: 'stun:stun.l.google.com:19302' }],
+        iceCandidatePoolSize: config.iceCandidatePoolSize || 0
+    };
+    if (config.iceTransportPolicy) {
+        iceConfig.iceTransportPolicy = config.iceTransportPolicy;
+    }
+    return iceConfig;
+}
+
+// Connections created with a candidate pool start gathering right away
+export function prewarmConnections() {
+    if (typeof RTCPeerConnection === 'undefined') return;
+    const config = getIceConfig();
+    if (!config.iceCandidatePoolSize) return;
+    while (warmConnections.length < WARM_POOL_SIZE) {
+        try {
+            warmConnections.push(new RTCPeerConnection(config));
+        } catch (error) {
+            console.warn("Could not pre-create a peer connection:", error);
+            return;
+        }
+    }
+}
+
+// Stands in for RTCPeerConnection inside SimplePeer and hands out a warm one when there is one
+function PooledPeerConnection(config) {
+    let pc = warmConnections.shift();
+    while (pc && pc.signalingState === 'closed') {
+        pc = warmConnections.shift();
+    }
+    setTimeout(prewarmConnections, 0);
+    return pc || new RTCPeerConnection(config);
+}
+
+export function createSimplePeer(initiator) {
+    return new SimplePeer({
+        initiator: initiator,
+        trickle: true,
+        config: getIceConfig(),
+        wrtc: {
+            RTCPeerConnection: PooledPeerConnection,
+            RTCSessionDescription: window.RTCSessionDescription,
+            RTCIceCandidate: window.RTCIceCandidate
+        }
+    });
+}
+
+// startedAt is the performance.now() of the attempt that succeeded
+export function recordConnectionOpen(peerId, startedAt, attempts) {
+    const now = performance.now();
+    timings.push({
+        peerId: peerId,
+        setupMs: now - startedAt,
+        sincePageLoadMs: now,
+        attempts: attempts
+    });
+    if (timings.length > 1000) {
+        timings.shift();
+    }
+}
+
+export function getConnectionTimings() {
+    return timings.slice();
+}
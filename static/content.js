@@ -0,0 +1,142 @@
+// Content addressing: every file we hold is hashed per chunk in the transfer
+// worker, and the Merkle root of those hashes (the content ID) identifies the
+// file across peers and refreshes. Receivers use it to skip files and chunks
+// they already have, and the chunk hashes to verify data as it arrives.
+
+import { CHUNK_SIZE } from "./file_transfer.js";
+import { hashFile } from "./transfer_engine.js";
+
+const MANIFEST_PAGE = 4096;        // chunk hashes per manifest message (128 KB)
+const MANIFEST_TIMEOUT = 5000;
+
+// contentId -> fileId of a complete file we hold
+const localContent = {};
+// chunk hash (hex) -> { fileId, index } of a chunk we hold
+const localChunks = new Map();
+// Manifest requests waiting for their pages, keyed by "peerId:fileId"
+const pendingManifests = {};
+
+export function toHex(bytes) {
+    return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+}
+
+export function chunkHashHex(hashes, index) {
+    return toHex(hashes.subarray(index * 32, index * 32 + 32));
+}
+
+// Hash a file in the background; it is served under its file ID meanwhile
+export function startHashing(fileId, blob, onHashed) {
+    hashFile(blob, CHUNK_SIZE)
+        .then(({ root, hashes }) => {
+            if (!files[fileId]) return;
+            registerContent(fileId, root, hashes);
+            console.log(`Hashed ${files[fileId].name}: ${root}`);
+            onHashed();
+        })
+        .catch(error => {
+            console.warn(`Could not hash ${fileId}, sharing it without a content ID:`, error.message);
+        });
+}
+
+export function registerContent(fileId, contentId, hashes) {
+    files[fileId].contentId = contentId;
+    files[fileId].chunkHashes = hashes;
+    if (!localContent[contentId]) {
+        localContent[contentId] = fileId;
+    }
+    const totalChunks = hashes.byteLength / 32;
+    for (let index = 0; index < totalChunks; index++) {
+        const hash = chunkHashHex(hashes, index);
+        if (!localChunks.has(hash)) {
+            localChunks.set(hash, { fileId, index });
+        }
+    }
+}
+
+export function findLocalContent(contentId) {
+    const fileId = contentId && localContent[contentId];
+    return fileId && files[fileId] ? fileId : null;
+}
+
+export function findLocalChunk(hash) {
+    const location = localChunks.get(hash);
+    return location && files[location.fileId] ? location : null;
+}
+
+// Send our chunk hashes for a file, split into pages that fit a data channel message
+export function handleManifestRequest(peerId, fileId) {
+    const file = files[fileId];
+    const peer = peers[peerId] && peers[peerId].connection;
+    if (!peer) return;
+
+    if (!file || !file.chunkHashes) {
+        peer.send(JSON.stringify({ type: 'manifest', fileId: fileId, unavailable: true }));
+        return;
+    }
+
+    const totalChunks = file.chunkHashes.byteLength / 32;
+    let offset = 0;
+    do {
+        const count = Math.min(MANIFEST_PAGE, totalChunks - offset);
+        const header = new TextEncoder().encode(JSON.stringify({
+            type: 'manifest',
+            fileId: fileId,
+            contentId: file.contentId,
+            offset: offset,
+            count: count,
+            totalChunks: totalChunks
+        }));
+        const frame = new Uint8Array(header.byteLength + 1 + count * 32);
+        frame.set(header, 0);
+        frame[header.byteLength] = 0; // separator
+        frame.set(file.chunkHashes.subarray(offset * 32, (offset + count) * 32), header.byteLength + 1);
+        peer.send(frame);
+        offset += MANIFEST_PAGE;
+    } while (offset < totalChunks);
+}
+
+// Ask a holder for its chunk hashes; resolves to null if it has none yet
+export function fetchManifest(peerId, fileId) {
+    const key = `${peerId}:${fileId}`;
+    return new Promise((resolve) => {
+        const timer = setTimeout(() => {
+            delete pendingManifests[key];
+            resolve(null);
+        }, MANIFEST_TIMEOUT);
+        pendingManifests[key] = { resolve, timer, hashes: null, received: 0 };
+        try {
+            peers[peerId].connection.send(JSON.stringify({ type: 'manifest-request', fileId: fileId }));
+        } catch (error) {
+            clearTimeout(timer);
+            delete pendingManifests[key];
+            resolve(null);
+        }
+    });
+}
+
+export function handleManifest(peerId, parsed, bytes, payloadOffset) {
+    const key = `${peerId}:${parsed.fileId}`;
+    const pending = pendingManifests[key];
+    if (!pending) return;
+
+    const finish = (result) => {
+        clearTimeout(pending.timer);
+        delete pendingManifests[key];
+        pending.resolve(result);
+    };
+
+    if (parsed.unavailable) {
+        finish(null);
+        return;
+    }
+    if (!pending.hashes) {
+        pending.hashes = new Uint8Array(parsed.totalChunks * 32);
+        pending.contentId = parsed.contentId;
+    }
+    pending.hashes.set(bytes.subarray(payloadOffset, payloadOffset + parsed.count * 32), parsed.offset * 32);
+    pending.received += parsed.count;
+
+    if (pending.received >= parsed.totalChunks) {
+        finish({ contentId: pending.contentId, hashes: pending.hashes });
+    }
+}
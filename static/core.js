@@ -1,11 +1,18 @@
-import { handleFiles } from './file_transfer.js';
-import { showToast, initDebugConsole } from './ui.js';
+import { handleFiles, shareFolder, downloadAllFromPeers } from './file_transfer.js';
+import { showToast, initDebugConsole, updateUploadStats } from './ui.js';
 import { initWebSocket } from './websocket.js';
+import { getSchedulerStats, setBandwidthCap } from './scheduler.js';
+import { readDroppedItems } from './batch.js';
+import { restoreStoredFiles } from './chunk_store.js';
+import { startTelemetry } from './telemetry.js';
 
 
 export async function init() {
     console.log("Initializing...");
     initWebSocket();
+    // Downloads kept from before a refresh are shared again, partial ones resume
+    restoreStoredFiles();
+    startTelemetry();
     //initDebugConsole();
 
     try {
@@ -13,6 +20,7 @@ export async function init() {
         // Set up file drop zone
         const fileDrop = document.getElementById('fileDrop');
         const fileInput = document.getElementById('fileInput');
+        const folderInput = document.getElementById('folderInput');
 
         fileDrop.addEventListener('click', () => {
             fileInput.click();
@@ -27,13 +35,16 @@ export async function init() {
             fileDrop.classList.remove('active');
         });
 
-        fileDrop.addEventListener('drop', (e) => {
+        fileDrop.addEventListener('drop', async (e) => {
             e.preventDefault();
             fileDrop.classList.remove('active');
 
-            if (e.dataTransfer.files.length > 0) {
-                handleFiles(e.dataTransfer.files);
+            // Dropped folders are shared whole, as one transfer each
+            const { looseFiles, folders } = await readDroppedItems(e.dataTransfer);
+            if (looseFiles.length > 0) {
+                handleFiles(looseFiles);
             }
+            Object.keys(folders).forEach(folderName => shareFolder(folderName, folders[folderName]));
         });
 
         fileInput.addEventListener('change', () => {
@@ -42,6 +53,27 @@ export async function init() {
             }
         });
 
+        document.getElementById('folderBtn').addEventListener('click', (e) => {
+            e.stopPropagation();
+            folderInput.click();
+        });
+
+        folderInput.addEventListener('change', () => {
+            if (folderInput.files.length > 0) {
+                handleFiles(folderInput.files);
+            }
+        });
+
+        document.getElementById('downloadAllBtn').addEventListener('click', () => {
+            downloadAllFromPeers();
+        });
+
+        // Upload scheduler limit and stats
+        document.getElementById('uploadCap').addEventListener('change', (e) => {
+            setBandwidthCap(parseFloat(e.target.value) * 1024 * 1024);
+        });
+        setInterval(() => updateUploadStats(getSchedulerStats()), 1000);
+
         // Setup copy button
         document.getElementById('copyCodeBtn').addEventListener('click', () => {
             const roomCode = document.getElementById('roomCode').textContent;
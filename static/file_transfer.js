@@ -1,54 +1,139 @@
-import { broadcastFileList } from "./websocket.js";
-import { updateFileDownloadStatus, showToast, addFileToUI, updateSenderFileStatus } from "./ui.js";
-import { initializePeerConnection } from "./peer.js";
+import { broadcastFileList, scheduleFileListBroadcast } from "./websocket.js";
+import { updateFileDownloadStatus, scheduleFileDownloadStatus, showToast, addFileToUI, addBatchToUI, removeFileFromUI, renderFileList, setDownloadButton, updateSenderFileStatus, scheduleSenderFileStatus } from "./ui.js";
+import { openOnDemand } from "./topology.js";
+import { findFileHolders, startSwarmDownload, handleSwarmChunk, requeueSwarmChunk, abortSwarmDownload } from "./swarm.js";
+import { storeChunk, assembleFile, computeMerkleRoot, onWorkerFailure } from "./transfer_engine.js";
+import { enqueueUpload, getUpload, addChunks, cancelUpload } from "./scheduler.js";
+import { startHashing, registerContent, findLocalContent, findLocalChunk, fetchManifest, chunkHashHex } from "./content.js";
+import { COMPRESSION_FORMAT, canDecompress, createCompressionPolicy } from "./compression.js";
+import { packFiles, unpackFiles, buildTar } from "./batch.js";
+import { persistDownload, storeCompletedFile, touchStoredDownload, hasStoredDownload, claimStoredDownload } from "./chunk_store.js";
+import { recordTransfer } from "./telemetry.js";
+
+export const CHUNK_SIZE = 16384; // 16KB chunks
+export const FILE_LIST_PAGE = 1000; // entries per file-list message
+
+function sanitizeFileName(fileId) {
+    return fileId.replace(/[^a-zA-Z0-9._-]/g, '_');
+}
 
 export function handleFiles(newFiles) {
     console.log("Handling files:", newFiles);
-    function sanitizeFileName(fileId) {
-        return fileId.replace(/[^a-zA-Z0-9._-]/g, '_');
-    }
+    // Files picked from a folder input carry their path inside the folder
+    const folders = {};
     for (const file of newFiles) {
+        if (file.webkitRelativePath) {
+            const folderName = file.webkitRelativePath.split('/')[0];
+            folders[folderName] = folders[folderName] || [];
+            folders[folderName].push({
+                path: file.webkitRelativePath.slice(folderName.length + 1),
+                blob: file
+            });
+            continue;
+        }
         //const fileId = `${myPeerId}-${Date.now()}-${file.name}`;
         const fileId = sanitizeFileName(`${myPeerId}-${Date.now()}-${file.name}`);
         files[fileId] = file;
         files[fileId].downloaders = {};
-        addFileToUI(fileId, file.name, URL.createObjectURL(file), file.size, true, {});
+        files[fileId].completeUrl = URL.createObjectURL(file);
+        addFileToUI(fileId, file.name, files[fileId].completeUrl, file.size, true, {});
+        // Content ID follows once hashing finishes; the file is shareable right away
+        startHashing(fileId, file, scheduleFileListBroadcast);
+    }
+    Object.keys(folders).forEach(folderName => shareFolder(folderName, folders[folderName], false));
+    broadcastFileList();
+}
+
+// A folder is shared as one packed transfer; receivers save it as a tar
+// archive or write it out into a directory
+export function shareFolder(folderName, entries, broadcast = true) {
+    const packed = packFiles(entries);
+    const fileId = sanitizeFileName(`${myPeerId}-${Date.now()}-${folderName}.tar`);
+    packed.name = `${folderName}.tar`;
+    packed.folder = entries.length;
+    packed.entries = entries;
+    packed.downloaders = {};
+    packed.completeUrl = URL.createObjectURL(buildTar(entries));
+    files[fileId] = packed;
+    console.log(`Sharing folder ${folderName} with ${entries.length} files (${packed.size} bytes)`);
+
+    addFileToUI(fileId, packed.name, packed.completeUrl, packed.size, true, {});
+    startHashing(fileId, packed, scheduleFileListBroadcast);
+    if (broadcast) {
         broadcastFileList();
     }
 }
 
 export function handleFileList(peerId, fileList) {
     console.log(`Received file list from peer ${peerId}:`, fileList);
+    if (!peers[peerId]) {
+        // Outside our neighbour set in a large room; connected on demand for a download
+        peers[peerId] = {
+            connection: null,
+            files: [],
+            connectionAttempts: 0,
+            state: CONNECTION_STATES.DISCONNECTED
+        };
+    }
     const peerFiles = peers[peerId].files;
     fileList.forEach(fileInfo => {
-        if (!peerFiles.some(f => f.fileId === fileInfo.fileId)) {
-            fileInfo.size = fileInfo.size || 0;
+        fileInfo.size = fileInfo.size || 0;
+        const existing = peerFiles.find(f => f.fileId === fileInfo.fileId);
+        if (!existing) {
             peerFiles.push(fileInfo);
+        } else {
+            // Picks up the content ID once the holder has hashed the file
+            Object.assign(existing, fileInfo);
         }
     });
     updateFileList();
+
+    // Pick up downloads a refresh interrupted, now that a peer lists them again
+    fileList.forEach(fileInfo => {
+        if (hasStoredDownload(fileInfo.fileId, fileInfo.contentId)) {
+            console.log(`Resuming ${fileInfo.fileName} from the chunk store`);
+            requestFileFromPeer(peerId, fileInfo.fileId);
+        }
+    });
+}
+
+// Files we can serve to others: our own files and downloads that have completed
+export function getAdvertisedFiles() {
+    return Object.keys(files)
+        .filter(fileId => !files[fileId].totalChunks || files[fileId].completeBlob)
+        .map(fileId => {
+            const file = files[fileId];
+            return {
+                fileId: fileId,
+                fileName: file.name,
+                size: file.size || 0,
+                contentId: file.contentId || null,
+                folder: file.folder || undefined
+            };
+        });
+}
+
+// Blob to read chunks from, for both local files and completed downloads
+function getFileBlob(file) {
+    return file.completeBlob || file;
 }
 
 export function sendFileList(peer) {
     console.log("Sending file list to peer");
 
     // A list of files with proper metadata
-    const fileList = Object.keys(files).map(fileId => {
-        const file = files[fileId];
-        return {
-            fileId: fileId,
-            fileName: file.name,
-            size: file.size || (file.chunks ? file.chunks.reduce((total, chunk) => total + (chunk ? chunk.byteLength : 0), 0) : 0)
-        };
-    });
+    const fileList = getAdvertisedFiles();
 
-    // Send the list to the peer
+    // Send the list to the peer, in pages that fit a data channel message
     try {
-        const message = JSON.stringify({
-            type: 'file-list',
-            files: fileList
-        });
-        peer.send(message);
+        let offset = 0;
+        do {
+            peer.send(JSON.stringify({
+                type: 'file-list',
+                files: fileList.slice(offset, offset + FILE_LIST_PAGE)
+            }));
+            offset += FILE_LIST_PAGE;
+        } while (offset < fileList.length);
         console.log(`Sent file list with ${fileList.length} files`);
     } catch (error) {
         console.error("Error sending file list:", error);
@@ -56,105 +141,54 @@ export function sendFileList(peer) {
 }
 
 export function updateFileList() {
-    //console.log("Updating file list in UI");
-    const fileList = document.getElementById('fileList');
-    fileList.innerHTML = '';
-
-    // Check if there are any files to display
-    const allFiles = [];
+    // Batches in progress come first, each on a row of its own
+    const allFiles = Object.keys(pendingBatches).map(batchId => ({
+        fileId: batchId,
+        fileName: pendingBatches[batchId].label,
+        size: pendingBatches[batchId].size,
+        batch: true
+    }));
 
     // Add my own files
     Object.keys(files).forEach(fileId => {
+        if (pendingBatches[fileId]) return;
         const fileObj = files[fileId];
-        // Only create URL if it's an actual File/Blob object
-        let url = null;
-
-        if (fileObj instanceof Blob || fileObj instanceof File) {
-            url = URL.createObjectURL(fileObj);
-        } else if (fileObj.completeBlob) {
-            url = URL.createObjectURL(fileObj.completeBlob);
-        } else if (fileObj.completeUrl) {
-            url = fileObj.completeUrl;
-        }
-
         allFiles.push({
             fileId: fileId,
             fileName: fileObj.name,
-            url: url,
+            url: fileObj.completeUrl || null,
             size: fileObj.size || 0,
             ownedByMe: true,
             downloaders: fileObj.downloaders || {}
         });
     });
 
-    // Add files from peers
+    // Add files from peers, once per file ID and content
+    const listed = new Set(allFiles.map(f => f.fileId));
+    const listedContent = new Set();
     Object.keys(peers).forEach(peerId => {
-        if (peers[peerId].files && peers[peerId].files.length > 0) {
-            peers[peerId].files.forEach(fileInfo => {
-                // Only add if not already in the list
-                if (!allFiles.some(f => f.fileId === fileInfo.fileId)) {
-                    allFiles.push({
-                        fileId: fileInfo.fileId,
-                        fileName: fileInfo.fileName,
-                        peerId: peerId,
-                        ownedByMe: false,
-                        size: fileInfo.size || 0
-                    });
-                }
+        (peers[peerId].files || []).forEach(fileInfo => {
+            // Skip content we already hold, whatever ID it is shared under
+            if (findLocalContent(fileInfo.contentId)) return;
+            if (listed.has(fileInfo.fileId) || (fileInfo.contentId && listedContent.has(fileInfo.contentId))) return;
+            listed.add(fileInfo.fileId);
+            if (fileInfo.contentId) {
+                listedContent.add(fileInfo.contentId);
+            }
+            allFiles.push({
+                fileId: fileInfo.fileId,
+                fileName: fileInfo.fileName,
+                peerId: peerId,
+                ownedByMe: false,
+                size: fileInfo.size || 0
             });
-        }
+        });
     });
 
-    // Display placeholder if no files
-    if (allFiles.length === 0) {
-        const placeholder = document.createElement('li');
-        placeholder.className = 'file-item';
-        placeholder.style.justifyContent = 'center';
-        placeholder.style.fontStyle = 'italic';
-        placeholder.style.color = '#666';
-        placeholder.textContent = 'No files shared yet';
-        fileList.appendChild(placeholder);
-        return;
-    }
-
-    // Add files to UI
-    allFiles.forEach(fileInfo => {
-        if (fileInfo.ownedByMe) {
-            addFileToUI(fileInfo.fileId, fileInfo.fileName, fileInfo.url, fileInfo.size, true, fileInfo.downloaders);
-        } else {
-            // For peer files that don't have a URL yet
-            const listItem = document.createElement('li');
-            listItem.className = 'file-item';
-            listItem.setAttribute('data-file-id', fileInfo.fileId);
-
-            const fileSize = fileInfo.size ?
-                (parseInt(fileInfo.size) / 1024).toFixed(2) + ' KB' : 'Unknown size';
-
-            listItem.innerHTML = `
-                        <div class="file-info">
-                            <span class="file-name">${fileInfo.fileName}</span>
-                            <span class="file-meta">${fileSize}</span>
-                            <span class="file-status">Available from peer</span>
-                        </div>
-                        <button class="download-btn" data-file-id="${fileInfo.fileId}" data-peer-id="${fileInfo.peerId}">Download</button>
-                    `;
-
-            // Add click handler to request file
-            const downloadBtn = listItem.querySelector('.download-btn');
-            downloadBtn.addEventListener('click', () => {
-                const fileId = downloadBtn.getAttribute('data-file-id');
-                const peerId = downloadBtn.getAttribute('data-peer-id');
-                requestFileFromPeer(peerId, fileId);
-                downloadBtn.textContent = "Downloading...";
-                downloadBtn.disabled = true;
-            });
-
-            fileList.appendChild(listItem);
-        }
-    });
+    renderFileList(allFiles);
 }
 
-export function handleFileRequest(peerId, fileId) {
+export function handleFileRequest(peerId, fileId, chunks = null, alias = null, compression = null) {
     console.log(`Peer ${peerId} requested file with ID: ${fileId}`);
     const file = files[fileId];
     if (!file) {
@@ -162,7 +196,15 @@ export function handleFileRequest(peerId, fileId) {
         return;
     }
 
+    // Swarm downloaders request further chunk ranges while an upload is running
+    const upload = getUpload(peerId, fileId);
+    if (upload && chunks) {
+        addChunks(upload, chunks);
+        return;
+    }
+
     console.log(`Preparing to send file: ${file.name}, size: ${file.size} bytes`);
+    touchStoredDownload(fileId);
 
     // Track downloaders for this file
     if (!file.downloaders) {
@@ -179,12 +221,162 @@ export function handleFileRequest(peerId, fileId) {
 
     // Adding a slight delay to ensure connection is stable
     setTimeout(() => {
-        sendFileToPeer(peerId, fileId, file);
+        sendFileToPeer(peerId, fileId, file, chunks, alias, compression);
     }, 100);
 }
 
-export function requestFileFromPeer(peerId, fileId) {
+export function handleFileCancel(peerId, fileId, chunks = null) {
+    if (!chunks) {
+        console.log(`Peer ${peerId} cancelled the rest of ${fileId}`);
+    }
+    // Partial cancels drop chunks another source already delivered
+    cancelUpload(peerId, fileId, chunks);
+}
+
+export function requestChunksFromPeer(peerId, fileId, chunks, alias = null) {
+    if (!peers[peerId] || !peers[peerId].connection || !peers[peerId].connected) {
+        return false;
+    }
+    try {
+        peers[peerId].connection.send(JSON.stringify({
+            type: 'file-request',
+            fileId: fileId,
+            chunks: chunks,
+            as: alias && alias !== fileId ? alias : undefined,
+            compression: acceptedCompression()
+        }));
+        return true;
+    } catch (error) {
+        console.error(`Error requesting chunks from peer ${peerId}:`, error);
+        return false;
+    }
+}
+
+// Compression format we can take chunks in, sent along with every request
+function acceptedCompression() {
+    return canDecompress() ? COMPRESSION_FORMAT : undefined;
+}
+
+export function cancelChunksFromPeer(peerId, fileId, chunks = null) {
+    if (!peers[peerId] || !peers[peerId].connection || !peers[peerId].connected) {
+        return;
+    }
+    try {
+        peers[peerId].connection.send(JSON.stringify({
+            type: 'file-cancel',
+            fileId: fileId,
+            chunks: chunks
+        }));
+    } catch (error) {
+        console.error(`Error cancelling chunks from peer ${peerId}:`, error);
+    }
+}
+
+// Listing for a file as advertised by any peer
+function findListing(fileId) {
+    for (const peerId of Object.keys(peers)) {
+        const listing = (peers[peerId].files || []).find(f => f.fileId === fileId);
+        if (listing) return listing;
+    }
+    return null;
+}
+
+// Fetch and check the chunk hashes, then copy any chunks we already hold.
+// Returns the chunk indices still to download, or null for the whole file.
+async function prepareVerifiedDownload(fileId, listing, holder) {
+    updateFileDownloadStatus(fileId, "Fetching chunk hashes...");
+    const manifest = await fetchManifest(holder.peerId, holder.fileId);
+    if (!manifest) return null;
+
+    if (manifest.hashes.byteLength / 32 !== Math.ceil(listing.size / CHUNK_SIZE)) {
+        console.warn(`Chunk hashes for ${fileId} do not match its advertised size, downloading unverified`);
+        return null;
+    }
+    let root;
+    try {
+        root = await computeMerkleRoot(manifest.hashes, listing.size);
+    } catch (error) {
+        console.warn(`Could not check chunk hashes for ${fileId}, downloading unverified:`, error.message);
+        return null;
+    }
+    if (root !== listing.contentId) {
+        console.warn(`Chunk hashes for ${fileId} do not match its content ID, downloading unverified`);
+        return null;
+    }
+
+    const totalChunks = manifest.hashes.byteLength / 32;
+    if (!files[fileId]) {
+        createDownloadRecord(fileId, listing.fileName, totalChunks);
+    }
+    files[fileId].contentId = listing.contentId;
+    files[fileId].chunkHashes = manifest.hashes;
+    persistDownload(fileId);
+
+    const missing = [];
+    const local = [];
+    for (let index = 0; index < totalChunks; index++) {
+        // Chunks resumed from the chunk store are already held
+        if (files[fileId].processedChunks.has(index)) continue;
+        const location = findLocalChunk(chunkHashHex(manifest.hashes, index));
+        if (location) {
+            local.push([index, location]);
+        } else {
+            missing.push(index);
+        }
+    }
+    if (local.length === 0) return files[fileId].receivedChunks ? missing : null;
+
+    console.log(`Reusing ${local.length}/${totalChunks} chunks of ${listing.fileName} we already hold`);
+    copyLocalChunks(fileId, listing.fileName, totalChunks, local);
+    return missing;
+}
+
+async function copyLocalChunks(fileId, fileName, totalChunks, local) {
+    for (const [index, location] of local) {
+        const source = getFileBlob(files[location.fileId]);
+        const start = location.index * CHUNK_SIZE;
+        const buffer = await source.slice(start, Math.min(source.size, start + CHUNK_SIZE)).arrayBuffer();
+        await handleFileData(fileId, fileName, new Uint8Array(buffer), 0, totalChunks, index, null);
+    }
+}
+
+// Peer each download was asked of, so it can be asked again
+const requestedFrom = {};
+
+export async function requestFileFromPeer(peerId, fileId) {
     console.log(`Requesting file ${fileId} from peer ${peerId}`);
+    requestedFrom[fileId] = peerId;
+
+    // Content we already hold under another ID is never fetched again
+    const listing = findListing(fileId);
+    if (listing && findLocalContent(listing.contentId)) {
+        showToast(`You already have "${listing.fileName}"`);
+        updateFileDownloadStatus(fileId, "Already downloaded");
+        return;
+    }
+
+    // Chunks a refresh interrupted are taken from the chunk store
+    let missing = null;
+    if (!files[fileId]) {
+        const resumed = await resumeFromStore(fileId, listing);
+        if (resumed === 'complete') return;
+        missing = resumed;
+    }
+
+    const holders = findFileHolders(fileId, listing && listing.contentId);
+    if (listing && listing.contentId && holders.length > 0) {
+        const holder = holders.find(h => h.peerId === peerId) || holders[0];
+        missing = (await prepareVerifiedDownload(fileId, listing, holder)) || missing;
+        if (missing && missing.length === 0) return;
+    }
+
+    // Pull from every peer that holds the file when more than one does
+    if (holders.length > 1 && listing && listing.size > 0) {
+        console.log(`Downloading ${fileId} from ${holders.length} peers`);
+        startSwarmDownload(fileId, listing.fileName, listing.size, holders, missing);
+        updateFileDownloadStatus(fileId, `Requesting file from ${holders.length} peers...`);
+        return;
+    }
 
     // Check if peer exists and has a valid connection
     if (!peers[peerId]) {
@@ -194,45 +386,29 @@ export function requestFileFromPeer(peerId, fileId) {
     }
 
     if (!peers[peerId].connection || !peers[peerId].connected) {
-        console.error(`No active connection to peer ${peerId}`);
-        showToast(`Connection to peer ${peerId} lost. Try refreshing the page.`);
-
-        // Try to re-establish connection
-        initializePeerConnection(peerId);
-
-        // Update UI to show connection issue
-        const downloadBtn = document.querySelector(`button[data-file-id="${fileId}"]`);
-        if (downloadBtn) {
-            downloadBtn.textContent = "Reconnecting...";
-
-            // Try again after 3 seconds if connection established
-            setTimeout(() => {
-                if (peers[peerId] && peers[peerId].connected) {
-                    requestFileFromPeer(peerId, fileId);
-                } else {
-                    downloadBtn.textContent = "Connection Failed";
-                    downloadBtn.disabled = true;
-                }
-            }, 3000);
+        // Not a neighbour, or the connection dropped: open one for this download
+        setDownloadButton(fileId, "Connecting...", true);
+        if (!(await openOnDemand(peerId))) {
+            console.error(`No active connection to peer ${peerId}`);
+            showToast(`Could not connect to peer ${peerId}. Try refreshing the page.`);
+            setDownloadButton(fileId, "Connection Failed", true);
+            return;
         }
-        return;
     }
 
     // Send file request message
     const message = JSON.stringify({
         type: 'file-request',
-        fileId: fileId
+        fileId: fileId,
+        chunks: missing || undefined,
+        compression: acceptedCompression()
     });
 
     try {
         peers[peerId].connection.send(message);
 
         // Update UI
-        const downloadBtn = document.querySelector(`button[data-file-id="${fileId}"]`);
-        if (downloadBtn) {
-            downloadBtn.textContent = "Downloading...";
-            downloadBtn.disabled = true;
-        }
+        setDownloadButton(fileId, "Downloading...", true);
 
         // Update status
         updateFileDownloadStatus(fileId, "Requesting file...");
@@ -241,27 +417,236 @@ export function requestFileFromPeer(peerId, fileId) {
         showToast(`Error requesting file: ${error.message}`);
 
         // Update UI
-        const downloadBtn = document.querySelector(`button[data-file-id="${fileId}"]`);
-        if (downloadBtn) {
-            downloadBtn.textContent = "Retry";
-            downloadBtn.disabled = false;
+        setDownloadButton(fileId, "Retry", false);
+    }
+}
+
+// The transfer worker died holding chunks of these downloads. Their received
+// state is cleared and they are requested again, now assembled inline.
+function restartLostDownloads() {
+    Object.keys(files).forEach(fileId => {
+        const file = files[fileId];
+        if (!file.processedChunks || file.completeBlob || file.processedChunks.size === 0) return;
+        console.warn(`Transfer worker lost the chunks of ${file.name}, downloading them again`);
+
+        // Batches are packed for one request only, so they are asked for anew
+        const batch = pendingBatches[fileId];
+        if (batch) {
+            cancelChunksFromPeer(batch.peerId, fileId);
+            delete pendingBatches[fileId];
+            delete files[fileId];
+            removeFileFromUI(fileId);
+            requestBatchFromPeer(batch.peerId, batch.fileIds);
+            return;
+        }
+
+        file.processedChunks.clear();
+        file.receivedChunks = 0;
+        file.size = 0;
+        file.resumedBytes = 0;
+        file.lastReportedProgress = undefined;
+        file.startTime = Date.now();
+        const peerId = requestedFrom[fileId];
+        if (!abortSwarmDownload(fileId) && peerId) {
+            cancelChunksFromPeer(peerId, fileId);
         }
+        if (!peerId) {
+            updateFileDownloadStatus(fileId, "Error: transfer worker failed");
+            setDownloadButton(fileId, "Retry", false);
+            return;
+        }
+        updateFileDownloadStatus(fileId, "Transfer worker failed, downloading again...");
+        requestFileFromPeer(peerId, fileId);
+    });
+}
+onWorkerFailure(restartLostDownloads);
+
+// Record for an incoming file; chunk data itself lives in the transfer worker,
+// which also writes it through to the chunk store (batches excepted)
+function createDownloadRecord(fileId, fileName, totalChunks) {
+    const listing = findListing(fileId);
+    files[fileId] = {
+        name: fileName,
+        receivedChunks: 0,
+        totalChunks: totalChunks,
+        size: 0,
+        folder: listing && listing.folder ? listing.folder : 0,
+        startTime: Date.now(),
+        processedChunks: new Set() // Track which chunks we've already processed
+    };
+    if (!pendingBatches[fileId]) {
+        persistDownload(fileId);
     }
 }
 
-export async function handleFileData(fileId, fileName, chunk, totalChunks, chunkIndex) {
-    //console.log(`Receiving chunk ${chunkIndex + 1}/${totalChunks} for file ${fileName}`);
+// Set up a download from the chunks a previous page load stored. Resolves to
+// the chunk indices still missing, 'complete' if none were, or null when the
+// store holds nothing for this file.
+async function resumeFromStore(fileId, listing) {
+    const stored = await claimStoredDownload(fileId, listing && listing.contentId);
+    if (!stored || files[fileId]) return null;
+
+    const { record, indices, bytes } = stored;
+    files[fileId] = {
+        name: record.name,
+        receivedChunks: indices.length,
+        totalChunks: record.totalChunks,
+        size: bytes,
+        folder: record.folder || 0,
+        startTime: Date.now(),
+        resumedBytes: bytes,
+        processedChunks: new Set(indices)
+    };
+    if (record.contentId && record.chunkHashes) {
+        files[fileId].contentId = record.contentId;
+        files[fileId].chunkHashes = new Uint8Array(record.chunkHashes);
+    }
+    console.log(`Resuming ${record.name}: ${indices.length}/${record.totalChunks} chunks already stored`);
 
-    // Initialize file record if it doesn't exist
-    if (!files[fileId]) {
+    if (indices.length === record.totalChunks) {
+        await completeDownload(fileId, record.name);
+        return 'complete';
+    }
+    updateFileDownloadStatus(fileId, `Resuming: ${indices.length}/${record.totalChunks} chunks already stored`);
+    const missing = [];
+    for (let index = 0; index < record.totalChunks; index++) {
+        if (!files[fileId].processedChunks.has(index)) missing.push(index);
+    }
+    return missing;
+}
+
+// Batches we asked for, keyed by batch ID
+const pendingBatches = {};
+// Batch requests being received in pages, keyed by "peerId:batchId"
+const pendingBatchRequests = {};
+const BATCH_REQUEST_PAGE = 1000;   // file IDs per batch-request message
+
+// Ask one peer for many files at once; they come back to back as one transfer
+export async function requestBatchFromPeer(peerId, fileIds) {
+    if (!peers[peerId] || !(await openOnDemand(peerId))) {
+        showToast(`Could not connect to peer ${peerId}. Try refreshing the page.`);
+        return false;
+    }
+
+    // Prefixed with the sender's ID like its own file IDs, so progress updates reach it
+    const batchId = `${peerId}-batch-${Date.now()}`;
+    const listings = {};
+    (peers[peerId].files || []).forEach(fileInfo => {
+        listings[fileInfo.fileId] = fileInfo;
+    });
+    const size = fileIds.reduce((total, fileId) => total + (listings[fileId] ? listings[fileId].size : 0), 0);
+    pendingBatches[batchId] = {
+        peerId: peerId,
+        fileIds: fileIds,
+        listings: listings,
+        label: `${fileIds.length} files from peer ${peerId}`,
+        size: size
+    };
+    addBatchToUI(batchId, pendingBatches[batchId].label, size);
+
+    try {
+        for (let offset = 0; offset < fileIds.length; offset += BATCH_REQUEST_PAGE) {
+            peers[peerId].connection.send(JSON.stringify({
+                type: 'batch-request',
+                batchId: batchId,
+                files: fileIds.slice(offset, offset + BATCH_REQUEST_PAGE),
+                more: offset + BATCH_REQUEST_PAGE < fileIds.length,
+                compression: acceptedCompression()
+            }));
+        }
+        updateFileDownloadStatus(batchId, "Requesting files...");
+        return true;
+    } catch (error) {
+        console.error(`Error requesting batch from peer ${peerId}:`, error);
+        showToast(`Error requesting files: ${error.message}`);
+        delete pendingBatches[batchId];
+        removeFileFromUI(batchId);
+        return false;
+    }
+}
+
+// Download every file we don't have yet, one batch per peer
+export function downloadAllFromPeers() {
+    const seen = new Set();
+    Object.values(pendingBatches).forEach(batch => batch.fileIds.forEach(fileId => seen.add(fileId)));
+
+    // Peers outside our neighbour set are connected on demand
+    Object.keys(peers).forEach(peerId => {
+        const wanted = (peers[peerId].files || []).filter(fileInfo => {
+            const key = fileInfo.contentId || fileInfo.fileId;
+            if (files[fileInfo.fileId] || seen.has(fileInfo.fileId) || seen.has(key) ||
+                    findLocalContent(fileInfo.contentId)) {
+                return false;
+            }
+            seen.add(key);
+            return true;
+        });
+        if (wanted.length === 1) {
+            requestFileFromPeer(peerId, wanted[0].fileId);
+        } else if (wanted.length > 1) {
+            requestBatchFromPeer(peerId, wanted.map(fileInfo => fileInfo.fileId));
+        }
+    });
+}
+
+export function handleBatchRequest(peerId, batchId, fileIds, complete, compression = null) {
+    const key = `${peerId}:${batchId}`;
+    const requested = (pendingBatchRequests[key] || []).concat(fileIds);
+    if (!complete) {
+        pendingBatchRequests[key] = requested;
+        return;
+    }
+    delete pendingBatchRequests[key];
+
+    const entries = requested
+        .filter(fileId => files[fileId] && (!files[fileId].totalChunks || files[fileId].completeBlob))
+        .map(fileId => ({ path: fileId, blob: getFileBlob(files[fileId]) }));
+    if (entries.length < requested.length) {
+        console.warn(`${requested.length - entries.length} files in batch ${batchId} are not available`);
+    }
+    console.log(`Peer ${peerId} requested ${entries.length} files as one batch`);
+
+    const packed = packFiles(entries);
+    packed.name = `${entries.length} files`;
+    sendFileToPeer(peerId, batchId, packed, null, null, compression);
+}
+
+// Turn a received batch into the individual files it carries
+async function completeBatch(batchId, blob) {
+    const batch = pendingBatches[batchId];
+    delete pendingBatches[batchId];
+    delete files[batchId];
+
+    updateFileDownloadStatus(batchId, "Unpacking files...");
+    const entries = await unpackFiles(blob);
+    entries.forEach(({ path: fileId, blob: fileBlob }) => {
+        const listing = batch.listings[fileId];
+        const totalChunks = Math.ceil(fileBlob.size / CHUNK_SIZE);
         files[fileId] = {
-            name: fileName,
-            chunks: new Array(totalChunks),
-            receivedChunks: 0,
+            name: listing ? listing.fileName : fileId,
+            receivedChunks: totalChunks,
             totalChunks: totalChunks,
-            size: 0,
-            processedChunks: new Set() // Track which chunks we've already processed
+            size: fileBlob.size,
+            completeBlob: fileBlob,
+            completeUrl: URL.createObjectURL(fileBlob)
         };
+        storeCompletedFile(fileId, fileBlob);
+        startHashing(fileId, fileBlob, scheduleFileListBroadcast);
+    });
+
+    removeFileFromUI(batchId);
+    updateFileList();
+    sendDownloadProgressUpdate(batchId, batch.label, 100, true);
+    showToast(`${entries.length} files downloaded from peer ${batch.peerId}`);
+    broadcastFileList();
+}
+
+export async function handleFileData(fileId, fileName, frame, payloadOffset, totalChunks, chunkIndex, fromPeerId = null, compressed = null) {
+    //console.log(`Receiving chunk ${chunkIndex + 1}/${totalChunks} for file ${fileName}`);
+
+    // Initialize file record if it doesn't exist
+    if (!files[fileId]) {
+        createDownloadRecord(fileId, fileName, totalChunks);
     }
 
     // Skip if we already processed this chunk
@@ -270,97 +655,113 @@ export async function handleFileData(fileId, fileName, chunk, totalChunks, chunk
         return;
     }
 
+    // Claimed before the store so a duplicate arriving meanwhile is skipped;
+    // released again if the store fails
+    let stored = false;
     try {
-        // Convert chunk to ArrayBuffer
-        let binaryChunk;
-
-        if (chunk instanceof ArrayBuffer) {
-            binaryChunk = chunk;
-        } else if (typeof chunk === 'string') {
-            try {
-                binaryChunk = new TextEncoder().encode(chunk).buffer;
-            } catch (error) {
-                console.error("Error converting string chunk:", error);
-                binaryChunk = new ArrayBuffer(0); // Fallback to empty buffer
-            }
-        } else if (chunk instanceof Blob) {
-            binaryChunk = await chunk.arrayBuffer();
-        } else if (typeof chunk === 'object') {
-            // Handle object type
-            console.log("Handling object type chunk");
-            try {
-                const jsonString = JSON.stringify(chunk);
-                binaryChunk = new TextEncoder().encode(jsonString).buffer;
-            } catch (e) {
-                console.error("Error converting object chunk:", e);
-                if (chunk && chunk.data) {
-                    if (typeof chunk.data === 'string') {
-                        binaryChunk = new TextEncoder().encode(chunk.data).buffer;
-                    } else if (chunk.data instanceof ArrayBuffer) {
-                        binaryChunk = chunk.data;
-                    } else {
-                        binaryChunk = new ArrayBuffer(0);
-                    }
-                } else {
-                    binaryChunk = new ArrayBuffer(0);
-                }
+        // Hand the chunk to the worker for reassembly, checked against its hash when we have them
+        files[fileId].processedChunks.add(chunkIndex);
+        const expectedHash = files[fileId].chunkHashes ? chunkHashHex(files[fileId].chunkHashes, chunkIndex) : null;
+        const chunkLength = await storeChunk(fileId, chunkIndex, totalChunks, frame, payloadOffset, expectedHash, compressed);
+        stored = true;
+        if (chunkLength === null) {
+            console.warn(`Chunk ${chunkIndex} of ${fileName} failed verification, requesting it again`);
+            files[fileId].processedChunks.delete(chunkIndex);
+            if (!requeueSwarmChunk(fileId, chunkIndex) && fromPeerId) {
+                requestChunksFromPeer(fromPeerId, fileId, [chunkIndex]);
             }
-        } else {
-            console.error(`Unsupported chunk type: ${typeof chunk}`);
-            binaryChunk = new ArrayBuffer(0);
+            return;
         }
-
-        // Store the chunk
-        files[fileId].chunks[chunkIndex] = binaryChunk;
-        files[fileId].processedChunks.add(chunkIndex);
         files[fileId].receivedChunks++;
-        files[fileId].size += binaryChunk.byteLength;
+        files[fileId].size += chunkLength;
+
+        // Let a multi-source download hand this source its next range
+        handleSwarmChunk(fileId, chunkIndex, chunkLength, fromPeerId);
 
-        // Update UI with progress
-        updateFileDownloadStatus(fileId, `Downloading: ${files[fileId].receivedChunks}/${totalChunks} chunks (${(files[fileId].size / 1024).toFixed(2)} KB)`);
+        // Update UI with progress, at most once per frame
+        scheduleFileDownloadStatus(fileId, () =>
+            `Downloading: ${files[fileId].receivedChunks}/${totalChunks} chunks (${(files[fileId].size / 1024).toFixed(2)} KB)`);
 
-        // Send progress update to the sender every 10% 
-        const progress = Math.round((files[fileId].receivedChunks / totalChunks) * 100);
-        // Send updates on 10% intervals
-        if (progress % 10 === 0) {
+        // Send progress update to the sender every 10%
+        const progress = Math.floor((files[fileId].receivedChunks / totalChunks) * 100);
+        if (progress % 10 === 0 && progress !== files[fileId].lastReportedProgress) {
+            files[fileId].lastReportedProgress = progress;
             sendDownloadProgressUpdate(fileId, fileName, progress);
         }
 
         // Check if file is complete
         if (files[fileId].receivedChunks === totalChunks) {
-            console.log(`All ${totalChunks} chunks received for ${fileName}, assembling file...`);
+            await completeDownload(fileId, fileName);
+        }
+    } catch (error) {
+        console.error(`Error processing chunk ${chunkIndex} for file ${fileName}:`, error);
+        if (!stored && files[fileId]) {
+            files[fileId].processedChunks.delete(chunkIndex);
+        }
+        updateFileDownloadStatus(fileId, `Error: ${error.message}`);
+
+        // Send error notification to sender
+        sendDownloadProgressUpdate(fileId, fileName, -1, false, error.message);
+    }
+}
 
-            try {
-                // Create Blob from all chunks
-                const nonNullChunks = files[fileId].chunks.filter(c => c !== null && c !== undefined);
-                const blob = new Blob(nonNullChunks, { type: 'application/octet-stream' });
+// Assemble a file once every chunk is held, then share it on
+async function completeDownload(fileId, fileName) {
+    console.log(`All ${files[fileId].totalChunks} chunks received for ${fileName}, assembling file...`);
+
+    try {
+        // Create Blob from all chunks
+        const blob = await assembleFile(fileId);
+        recordTransfer('download', blob.size - (files[fileId].resumedBytes || 0), Date.now() - files[fileId].startTime);
+
+        // A batch of files we asked for turns into the individual files
+        if (pendingBatches[fileId]) {
+            await completeBatch(fileId, blob);
+            return;
+        }
 
-                // Create download URL
-                const url = URL.createObjectURL(blob);
+        // Folders are saved as a tar archive of their files
+        let url;
+        if (files[fileId].folder) {
+            files[fileId].entries = await unpackFiles(blob);
+            url = URL.createObjectURL(buildTar(files[fileId].entries));
+        } else {
+            url = URL.createObjectURL(blob);
+        }
 
-                // Update file info
-                files[fileId].completeBlob = blob;
-                files[fileId].completeUrl = url;
+        // Update file info
+        files[fileId].completeBlob = blob;
+        files[fileId].completeUrl = url;
+        // Restored and shared again after a refresh
+        persistDownload(fileId, true);
 
-                // Update UI
-                updateFileDownloadStatus(fileId, `Complete: ${(blob.size / 1024).toFixed(2)} KB`);
+        // Update UI
+        const verified = files[fileId].chunkHashes ? ' (verified)' : '';
+        updateFileDownloadStatus(fileId, `Complete: ${(blob.size / 1024).toFixed(2)} KB${verified}`);
 
-                // Send completion notification to sender
-                sendDownloadProgressUpdate(fileId, fileName, 100, true);
+        // Send completion notification to sender
+        sendDownloadProgressUpdate(fileId, fileName, 100, true);
 
-                // Show success message
-                showToast(`File "${fileName}" downloaded successfully!`);
-            } catch (error) {
-                console.error(`Error creating file blob: ${error.message}`);
-                updateFileDownloadStatus(fileId, `Error: ${error.message}`);
+        // Show success message
+        showToast(`File "${fileName}" downloaded successfully!`);
 
-                // Send error notification to sender
-                sendDownloadProgressUpdate(fileId, fileName, -1, false, error.message);
-            }
+        // Re-advertise so other peers can pull from us too
+        if (files[fileId].chunkHashes) {
+            registerContent(fileId, files[fileId].contentId, files[fileId].chunkHashes);
+        } else {
+            startHashing(fileId, blob, scheduleFileListBroadcast);
         }
+        broadcastFileList();
     } catch (error) {
-        console.error(`Error processing chunk ${chunkIndex} for file ${fileName}:`, error);
+        console.error(`Error creating file blob: ${error.message}`);
         updateFileDownloadStatus(fileId, `Error: ${error.message}`);
+        // The held chunks went with the failed assembly; a retry starts over
+        if (files[fileId] && files[fileId].processedChunks) {
+            files[fileId].processedChunks.clear();
+            files[fileId].receivedChunks = 0;
+            files[fileId].size = 0;
+        }
+        setDownloadButton(fileId, "Retry", false);
 
         // Send error notification to sender
         sendDownloadProgressUpdate(fileId, fileName, -1, false, error.message);
@@ -437,25 +838,12 @@ export function handleDownloadProgress(fileId, progress, downloaderId, completed
     updateSenderFileStatus(fileId, file.downloaders);
 }
 
-export function sendFileToPeer(peerId, fileId, file) {
+export function sendFileToPeer(peerId, fileId, file, chunkIndices = null, alias = null, compression = null) {
     if (!peers[peerId] || !peers[peerId].connection) {
         console.error(`No connection to peer ${peerId}`);
         return;
     }
 
-    const peer = peers[peerId].connection;
-    const chunkSize = 16384; // 16KB chunks
-    const totalChunks = Math.ceil(file.size / chunkSize);
-
-    // Track sent chunks and queue
-    const sentChunks = new Set();
-    let completedChunks = 0;
-    const chunkQueue = [];
-    let sending = false;
-
-    const maxParallel = 4;
-    let activeTransfers = 0;
-
     // Update downloader status
     if (!file.downloaders) file.downloaders = {};
     file.downloaders[peerId] = {
@@ -465,151 +853,45 @@ export function sendFileToPeer(peerId, fileId, file) {
     };
     updateSenderFileStatus(fileId, file.downloaders);
 
-    // Function to process the next chunk in queue
-    function processQueue() {
-        if (sending || chunkQueue.length === 0) return;
-
-        sending = true;
-        const index = chunkQueue.shift();
-
-        // Calculate chunk boundaries
-        const start = index * chunkSize;
-        const end = Math.min(file.size, start + chunkSize);
-        const chunk = file.slice(start, end);
-
-        // Read chunk data
-        const reader = new FileReader();
-        reader.onload = () => {
-            try {
-                const arrayBuffer = reader.result;
-
-                const message = {
-                    type: 'file-data',
-                    fileId: fileId,
-                    fileName: file.name,
-                    chunkIndex: index,
-                    totalChunks: totalChunks
-                };
-                const metaBuffer = new TextEncoder().encode(JSON.stringify(message));
-                const separator = new Uint8Array([0]);
-                const fullMessage = new Blob([metaBuffer, separator, arrayBuffer]);
-
-                // Send to peer with backpressure handling
-                try {
-                    peer.send(fullMessage);
-
-                    // Update counters
-                    completedChunks++;
-                    activeTransfers--;
-
-                    // Log progress periodically
-                    const progressPercentage = Math.round((completedChunks / totalChunks) * 100);
-                    if (progressPercentage % 10 === 0 || completedChunks === totalChunks) {
-                        console.log(`Sent ${progressPercentage}% of ${file.name}`);
-
-                        // Update downloader progress in our tracking
-                        if (file.downloaders && file.downloaders[peerId]) {
-                            file.downloaders[peerId].progress = progressPercentage;
-                            updateSenderFileStatus(fileId, file.downloaders);
-                        }
-                    }
-
-                    // Check if we're done
-                    if (completedChunks === totalChunks) {
-                        console.log(`Finished sending file ${file.name}`);
-
-                        // Update downloader status to completed
-                        if (file.downloaders && file.downloaders[peerId]) {
-                            file.downloaders[peerId].status = 'completed';
-                            file.downloaders[peerId].completedTime = Date.now();
-                            updateSenderFileStatus(fileId, file.downloaders);
-                        }
-                        return;
-                    }
-
-                    // to prevent overwhelming the channel
-                    setTimeout(() => {
-                        sending = false;
-                        processQueue();
-                    }, 0);
-
-                    // Queue more chunks if needed
-                    queueNextChunks();
-                } catch (error) {
-                    //console.error(`Error sending chunk ${index}:`, error);
-
-                    if (error.message && error.message.includes('send queue is full')) {
-                        // Put the chunk back in the queue for retry
-                        chunkQueue.unshift(index);
-                        activeTransfers--;
-
-                        // Wait longer before retrying
-                        setTimeout(() => {
-                            sending = false;
-                            processQueue();
-                        }, 200);
-                    } else {
-                        // For other errors, wait a bit and retry
-                        sentChunks.delete(index);
-                        activeTransfers--;
-                        setTimeout(() => {
-                            sending = false;
-                            chunkQueue.unshift(index);
-                            processQueue();
-                        }, 1000);
-                    }
+    let lastLoggedProgress = -1;
+    let bytesSent = 0;
+    const startedAt = Date.now();
+
+    // Chunks go out through the shared upload scheduler
+    enqueueUpload(peerId, fileId, getFileBlob(file), chunkIndices, {
+        header: {
+            type: 'file-data',
+            // Receivers that found the same content under another ID name their own
+            fileId: alias || fileId,
+            fileName: file.name
+        },
+        // Only when the receiver can decompress and the file looks compressible
+        compression: createCompressionPolicy(file.name, file.type, compression),
+        onSent: (sentChunks, requestedChunks) => {
+            bytesSent = Math.min(sentChunks * CHUNK_SIZE, file.size);
+            // Log progress periodically
+            const progressPercentage = Math.round((sentChunks / requestedChunks) * 100);
+            if ((progressPercentage % 10 === 0 && progressPercentage !== lastLoggedProgress) || sentChunks === requestedChunks) {
+                lastLoggedProgress = progressPercentage;
+                console.log(`Sent ${progressPercentage}% of ${file.name}`);
+
+                // Update downloader progress in our tracking
+                if (file.downloaders && file.downloaders[peerId]) {
+                    file.downloaders[peerId].progress = progressPercentage;
+                    scheduleSenderFileStatus(fileId, file.downloaders);
                 }
-            } catch (error) {
-                //console.error(`Error processing chunk ${index}:`, error);
-                sentChunks.delete(index);
-                activeTransfers--;
-                setTimeout(() => {
-                    sending = false;
-                    chunkQueue.unshift(index);
-                    processQueue();
-                }, 1000);
             }
-        };
-
-        reader.onerror = (error) => {
-            //console.error(`Error reading chunk ${index}:`, error);
-            sentChunks.delete(index);
-            activeTransfers--;
-            setTimeout(() => {
-                sending = false;
-                chunkQueue.unshift(index);
-                processQueue();
-            }, 1000);
-        };
-
-        reader.readAsArrayBuffer(chunk);
-    }
-
-    // Function to queue chunks for sending
-    function queueNextChunks() {
-        // Only queue chunks if we're under the parallel limit and there are chunks left
-        while (activeTransfers < maxParallel && chunkQueue.length < maxParallel * 4) {
-            // Find next unsent chunk
-            let nextIndex = 0;
-            while (nextIndex < totalChunks && (sentChunks.has(nextIndex) || chunkQueue.includes(nextIndex))) {
-                nextIndex++;
-            }
-
-            if (nextIndex < totalChunks) {
-                sentChunks.add(nextIndex);
-                chunkQueue.push(nextIndex);
-                activeTransfers++;
-            } else {
-                break; // No more chunks to queue
+        },
+        onComplete: () => {
+            console.log(`Finished sending file ${file.name}`);
+            recordTransfer('upload', bytesSent, Date.now() - startedAt);
+
+            // Update downloader status to completed
+            if (file.downloaders && file.downloaders[peerId]) {
+                file.downloaders[peerId].status = 'completed';
+                file.downloaders[peerId].completedTime = Date.now();
+                updateSenderFileStatus(fileId, file.downloaders);
             }
         }
-
-        // Start processing if not already processing
-        if (!sending && chunkQueue.length > 0) {
-            processQueue();
-        }
-    }
-
-    // Start the transfer process
-    queueNextChunks();
-}
\ No newline at end of file
+    });
+}
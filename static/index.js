@@ -19,9 +19,22 @@ import {
 // Peer connection related functions
 import {  
     handleSignal, 
-    initializePeerConnection 
+    initializePeerConnection,
+    connectToPeer
 } from './peer.js';
 
+// Connection setup
+import {
+    prewarmConnections,
+    getConnectionTimings
+} from './connection_manager.js';
+
+// Overlay topology for large rooms
+import {
+    getTopologyStats,
+    openOnDemand
+} from './topology.js';
+
 // File transfer related functions
 import { 
     handleFiles, 
@@ -33,6 +46,48 @@ import {
     sendFileToPeer,
     updateFileList
 } from './file_transfer.js';
+
+// Multi-source download related functions
+import {
+    findFileHolders,
+    startSwarmDownload
+} from './swarm.js';
+
+// Striped data channel related functions
+import {
+    openDataChannels,
+    sendDataFrame
+} from './channels.js';
+
+// Off-main-thread transfer engine
+import {
+    readChunkFrame,
+    storeChunk,
+    assembleFile
+} from './transfer_engine.js';
+
+// Content addressing
+import {
+    startHashing,
+    findLocalContent,
+    fetchManifest
+} from './content.js';
+
+// Upload scheduler
+import {
+    enqueueUpload,
+    getSchedulerStats,
+    setBandwidthCap
+} from './scheduler.js';
+
+// Exposed for the benchmark suite
+window.getSchedulerStats = getSchedulerStats;
+window.setBandwidthCap = setBandwidthCap;
+window.getConnectionTimings = getConnectionTimings;
+window.getTopologyStats = getTopologyStats;
+
+// Start gathering ICE candidates while the rest of the page loads
+prewarmConnections();
       
 window.addEventListener('load', init);
 console.log("Initialization complete.");
\ No newline at end of file
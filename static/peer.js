@@ -1,222 +1,420 @@
 import { updateStatus } from "./core.js";
 import { sendSignal } from "./websocket.js";
 import { showToast, updatePeersList } from "./ui.js";
-import { handleFileData, handleFileList, handleFileRequest, sendFileList, handleDownloadProgress } from "./file_transfer.js";
+import { handleFileData, handleFileList, handleFileRequest, handleFileCancel, handleBatchRequest, sendFileList, handleDownloadProgress } from "./file_transfer.js";
+import { handleSwarmPeerLost } from "./swarm.js";
+import { openDataChannels, closeDataChannels } from "./channels.js";
+import { cancelPeerUploads } from "./scheduler.js";
+import { handleManifestRequest, handleManifest } from "./content.js";
+import { createSimplePeer, recordConnectionOpen } from "./connection_manager.js";
+import { isNeighbour } from "./topology.js";
+import { relayAvailable, openRelay, isRelayed } from "./relay.js";
+import { recordPeerLatency } from "./telemetry.js";
 
-export function initializePeerConnection(peerId) {
-    if (peers[peerId] && peers[peerId].state === CONNECTION_STATES.CONNECTED) {
-        console.log(`Connection with peer ${peerId} already exists`);
-        return peers[peerId].connection;
+const ANSWER_TIMEOUT = 3000;       // the initiator retries if nothing comes back
+const OFFER_WAIT = 3000;           // the other side asks for an offer if none arrives
+const CONNECT_TIMEOUT = 10000;     // hard limit for a single attempt
+const DISCONNECT_GRACE = 2000;     // ICE 'disconnected' during setup often recovers
+const RETRY_BASE = 500;
+const MAX_ATTEMPTS = 5;
+const RELAY_AFTER_ATTEMPTS = 2;    // failed direct attempts before falling back to the relay
+
+// Timers for peers we expect an offer from, keyed by peer ID
+const offerTimers = {};
+
+// Exactly one side of each pair creates the offer, so attempts never collide
+export function isInitiator(peerId) {
+    return myPeerId < peerId;
+}
+
+// Safe to call from every room event: starts the connection if we are the
+// initiator, otherwise waits for the other side's offer and nudges it if needed.
+// immediate skips the wait, for connections opened on demand.
+export function connectToPeer(peerId, immediate = false) {
+    if (!myPeerId || !peerId || peerId === myPeerId) return;
+    const existing = peers[peerId];
+    if (existing && existing.connection && existing.state !== CONNECTION_STATES.ERROR &&
+            existing.state !== CONNECTION_STATES.DISCONNECTED) {
+        return;
     }
-    if (peers[peerId] && peers[peerId].state === CONNECTION_STATES.ERROR) {
-        if (peers[peerId].connection) {
-            peers[peerId].connection.destroy();
-        }
+
+    if (isInitiator(peerId)) {
+        initializePeerConnection(peerId, true);
+        return;
     }
-    if (peers[peerId] && peers[peerId].state === CONNECTION_STATES.CONNECTING) {
-        console.log(`Connection attempt with peer ${peerId} already in progress`);
+    clearTimeout(offerTimers[peerId]);
+    if (immediate) {
+        requestOffer(peerId);
         return;
     }
+    offerTimers[peerId] = setTimeout(() => {
+        delete offerTimers[peerId];
+        if (!peers[peerId] || !peers[peerId].connection) {
+            requestOffer(peerId);
+        }
+    }, OFFER_WAIT);
+}
+
+function requestOffer(peerId) {
+    console.log(`Asking peer ${peerId} to start the connection`);
+    sendSignal(peerId, { type: 'connect-request' });
+}
+
+export function initializePeerConnection(peerId, initiator = isInitiator(peerId)) {
+    const existing = peers[peerId];
+    if (existing && existing.state === CONNECTION_STATES.CONNECTED && existing.connection) {
+        console.log(`Connection with peer ${peerId} already exists`);
+        return existing.connection;
+    }
+    if (existing && existing.connection) {
+        // Replace a stale or failed attempt
+        teardownConnection(peerId);
+    }
+    clearTimeout(offerTimers[peerId]);
+    delete offerTimers[peerId];
 
     updateStatus(`Connecting to peer: ${peerId}...`);
-    console.log(`Initializing connection with peer: ${peerId}`);
+    console.log(`Initializing connection with peer: ${peerId} (${initiator ? 'initiator' : 'answering'})`);
 
-    const peer = new SimplePeer({
-        initiator: myPeerId < peerId,
-        trickle: true
-    });
+    const peer = createSimplePeer(initiator);
+    const isCurrent = () => peers[peerId] && peers[peerId].connection === peer;
 
     peers[peerId] = {
         connection: peer,
+        initiator: initiator,
         files: [],
-        connectionAttempts: peers[peerId] ? peers[peerId].connectionAttempts + 1 : 1,
+        connectionAttempts: existing ? (existing.connectionAttempts || 0) + 1 : 1,
         lastConnectionAttempt: Date.now(),
+        startedAt: performance.now(),
         state: CONNECTION_STATES.CONNECTING,
-        timeoutTimer: setTimeout(() => handleConnectionTimeout(peerId), 10000)
+        timeoutTimer: setTimeout(() => handleConnectionFailure(peerId, peer, 'timed out'), CONNECT_TIMEOUT),
+        answerTimer: initiator ? setTimeout(() => {
+            if (isCurrent() && !peers[peerId].remoteSignalled) {
+                handleConnectionFailure(peerId, peer, 'no answer');
+            }
+        }, ANSWER_TIMEOUT) : null
     };
 
     // Handle peer events
     peer.on('signal', (data) => {
-        console.log(`Signal generated for peer: ${peerId}`, data);
+        if (!isCurrent()) return;
+        //console.log(`Signal generated for peer: ${peerId}`, data);
         peers[peerId].state = CONNECTION_STATES.SIGNALING;
         // Send signaling data to the other peer via server
         sendSignal(peerId, data);
     });
 
+    // Fail fast on ICE state instead of waiting out the timeout
+    peer.on('iceStateChange', (iceConnectionState) => {
+        if (!isCurrent()) return;
+        const entry = peers[peerId];
+        if (iceConnectionState === 'failed') {
+            handleConnectionFailure(peerId, peer, 'ICE failed');
+        } else if (iceConnectionState === 'disconnected' && entry.state !== CONNECTION_STATES.CONNECTED) {
+            clearTimeout(entry.graceTimer);
+            entry.graceTimer = setTimeout(() => {
+                if (isCurrent() && peer._pc && peer._pc.iceConnectionState === 'disconnected') {
+                    handleConnectionFailure(peerId, peer, 'ICE disconnected');
+                }
+            }, DISCONNECT_GRACE);
+        }
+    });
+
     peer.on('connect', () => {
+        if (!isCurrent()) return;
         console.log(`Connected to peer: ${peerId}`);
-        clearTimeout(peers[peerId].timeoutTimer);
-        peers[peerId].state = CONNECTION_STATES.CONNECTED;
-        updateStatus(`Connected to peer: ${peerId}`);
-        showToast(`Connected to peer: ${peerId}`);
-        peers[peerId].connected = true;
-        // Send file list to new peer
-        sendFileList(peer);
+        const entry = peers[peerId];
+        clearConnectionTimers(entry);
+        recordConnectionOpen(peerId, entry.startedAt, entry.connectionAttempts);
+        handlePeerConnected(peerId, peer);
     });
 
-    peer.on('data', async (data) => {
-        // Convert buffer to string if needed
-        let isJSON = false;
-        let jsonStr = '';
-
-        if (typeof data === 'string') {
-            jsonStr = data;
-            isJSON = true;
-        } else if (data instanceof ArrayBuffer || data instanceof Uint8Array) {
-            try {
-                const text = new TextDecoder().decode(data);
-                if (text.trim().startsWith('{') && text.includes('"type":')) {
-                    jsonStr = text;
-                    isJSON = true;
-                }
-            } catch (_) {
-                isJSON = false;
-            }
-        }
-
-        if (isJSON) {
-            try {
-                // The message was [JSON, separator (0x00), binary data]
-                const separatorIndex = jsonStr.indexOf('\u0000');
-                if (separatorIndex !== -1) {
-                    jsonStr = jsonStr.slice(0, separatorIndex);
-                }
-                const parsed = JSON.parse(jsonStr);
-                switch (parsed.type) {
-                    case 'file-list':
-                        handleFileList(peerId, parsed.files);
-                        break;
-                    case 'file-request':
-                        handleFileRequest(peerId, parsed.fileId);
-                        break;
-                    case 'file-data':
-                        const chunkBuffer = new Uint8Array(data.slice(separatorIndex + 1));
-                        handleFileData(parsed.fileId, parsed.fileName, chunkBuffer.buffer, parsed.totalChunks, parsed.chunkIndex);
-                        break;
-                    case 'ping':
-                        peer.connection.send(JSON.stringify({ type: 'pong', timestamp: parsed.timestamp }));
-                        break;
-                    case 'pong':
-                        const latency = Date.now() - parsed.timestamp;
-                        console.log(`Latency to peer ${peerId}: ${latency}ms`);
-                        peers[peerId].lastDataReceived = Date.now();
-                    case 'download-progress':
-                        handleDownloadProgress(
-                            parsed.fileId, 
-                            parsed.progress, 
-                            parsed.downloaderId, 
-                            parsed.completed || false, 
-                            parsed.error || null
-                        );
-                        break;
-
-                    default:
-                        console.warn("Unhandled JSON message type:", parsed);
-                }
-                return;
-            } catch (e) {
-                console.warn("Failed to parse JSON:", e);
-            }
-        }
+    peer.on('data', (data) => {
+        handlePeerMessage(peerId, data);
     });
 
 
     peer.on('error', (err) => {
         console.error(`Peer connection error with ${peerId}:`, err);
-        updateStatus(`Connection error with peer: ${peerId}`);
+        if (isCurrent()) {
+            updateStatus(`Connection error with peer: ${peerId}`);
+        }
     });
 
     peer.on('close', () => {
         console.log(`Connection closed with peer: ${peerId}`);
+        // Attempts we replaced or already failed have been cleaned up
+        if (!isCurrent()) return;
         updateStatus(`Connection closed with peer: ${peerId}`);
-        if (peers[peerId] && peers[peerId].timeoutTimer) {
-            clearTimeout(peers[peerId].timeoutTimer);
-        }
-        if (peers[peerId]) {
-            peers[peerId].state = CONNECTION_STATES.DISCONNECTED;
-            
-            // Only attempt to reconnect if this wasn't a manual disconnect
-            if (!peers[peerId].manualDisconnect) {
-                // Implement backoff reconnection
-                const backoffTime = Math.min(1000 * Math.pow(2, peers[peerId].connectionAttempts), 30000);
-                console.log(`Will attempt reconnection in ${backoffTime}ms`);
-                
-                setTimeout(() => {
-                    initializePeerConnection(peerId);
-                }, backoffTime);
-            } else {
-                // Clean up the peer object if this was a manual disconnect
-                delete peers[peerId];
-            }
+        if (peers[peerId].manualDisconnect) {
+            teardownConnection(peerId);
+            // Clean up the peer object if this was a manual disconnect
+            delete peers[peerId];
+            updatePeersList();
+            return;
         }
-        updatePeersList();
+        handleConnectionFailure(peerId, peer, 'closed');
     });
 
     return peer;
 }
 
-export function handleSignal(signal) {
-    if (!signal || !signal.from || !signal.signal) {
-        console.error("Received invalid signal data", signal);
-        return;
+// A direct or relayed connection is ready to carry messages
+export function handlePeerConnected(peerId, connection) {
+    const entry = peers[peerId];
+    const via = entry.relayed ? ' (relayed)' : '';
+    entry.state = CONNECTION_STATES.CONNECTED;
+    entry.connectionAttempts = 0;
+    entry.connectedAt = Date.now();
+    updateStatus(`Connected to peer: ${peerId}${via}`);
+    showToast(`Connected to peer: ${peerId}${via}`);
+    entry.connected = true;
+    // Send file list to new peer
+    sendFileList(connection);
+    // Open the striped data channels for file chunks
+    openDataChannels(peerId, (data) => handlePeerMessage(peerId, data), (count) => {
+        connection.send(JSON.stringify({ type: 'channels-ready', count: count }));
+    });
+}
+
+function clearConnectionTimers(entry) {
+    clearTimeout(entry.timeoutTimer);
+    clearTimeout(entry.answerTimer);
+    clearTimeout(entry.graceTimer);
+}
+
+// Drop everything tied to the current connection to a peer
+export function teardownConnection(peerId) {
+    const entry = peers[peerId];
+    if (!entry) return;
+    const connection = entry.connection;
+    clearConnectionTimers(entry);
+    handleSwarmPeerLost(peerId);
+    cancelPeerUploads(peerId);
+    closeDataChannels(peerId);
+    entry.connection = null;
+    entry.connected = false;
+    entry.state = CONNECTION_STATES.DISCONNECTED;
+    if (connection) {
+        connection.destroy();
     }
+}
 
-    const fromPeerId = signal.from;
-    const signalData = signal.signal;
+// Close an on-demand connection we no longer need; the listing stays so it can be reopened
+export function closeIdleConnection(peerId) {
+    const entry = peers[peerId];
+    if (!entry || !entry.connection) return;
+    try {
+        // Tells the other side not to reconnect
+        entry.connection.send(JSON.stringify({ type: 'bye' }));
+    } catch (error) {
+        console.warn(`Could not say goodbye to ${peerId}:`, error);
+    }
+    teardownConnection(peerId);
+    updatePeersList();
+}
 
-    //console.log(`Received signal from peer: ${fromPeerId}`, signalData);
-    console.log(`Received signal from peer: ${fromPeerId}`);
+// One attempt failed or an open connection dropped: retry with backoff.
+// Only the initiator reconnects; the other side asks it for a new offer.
+// When direct attempts can't get through, both sides fall back to the relay.
+function handleConnectionFailure(peerId, peer, reason) {
+    const entry = peers[peerId];
+    if (!entry || entry.connection !== peer) return;
+
+    const wasConnected = entry.state === CONNECTION_STATES.CONNECTED;
+    console.log(`Connection with peer ${peerId} failed: ${reason}`);
+    updateStatus(`Connection with peer ${peerId} failed (${reason}), retrying...`);
+    teardownConnection(peerId);
+    entry.state = CONNECTION_STATES.ERROR;
+    if (wasConnected) {
+        entry.connectionAttempts = 0;
+    }
 
-    // If we don't have a connection to this peer yet, create one
-    if (!peers[fromPeerId]) {
-        initializePeerConnection(fromPeerId);
-    } else if (peers[fromPeerId].state === CONNECTION_STATES.ERROR) {
-        // If the connection was in error state, reinitialize
-        initializePeerConnection(fromPeerId);
+    if (!wasConnected && relayAvailable() &&
+            (reason === 'ICE failed' || entry.connectionAttempts >= RELAY_AFTER_ATTEMPTS)) {
+        console.log(`Direct connection to ${peerId} failed (${reason}), falling back to the relay`);
+        openRelay(peerId).then(opened => {
+            if (!opened && isNeighbour(peerId)) scheduleReconnect(peerId);
+        });
+        updatePeersList();
+        return;
+    }
+
+    // Outside our neighbour set the connection is reopened when a transfer needs it
+    if (!isNeighbour(peerId)) {
+        entry.state = CONNECTION_STATES.DISCONNECTED;
+        updatePeersList();
+        return;
+    }
+    scheduleReconnect(peerId);
+}
+
+function scheduleReconnect(peerId) {
+    const entry = peers[peerId];
+    if (!entry || entry.connection) return;
+    if (entry.connectionAttempts >= MAX_ATTEMPTS) {
+        console.log(`Max reconnection attempts reached for peer: ${peerId}`);
+        delete peers[peerId];
+        updatePeersList();
+        return;
     }
 
-    // Process the signal with simple-peer
+    const backoffTime = Math.min(RETRY_BASE * Math.pow(2, entry.connectionAttempts), 30000);
+    console.log(`Will retry connection in ${backoffTime}ms (attempt ${entry.connectionAttempts + 1})`);
     setTimeout(() => {
-    try {
-        if (peers[fromPeerId] && peers[fromPeerId].connection) {
-            peers[fromPeerId].connection.signal(signalData);
-            peers[fromPeerId].lastSignalReceived = Date.now();
+        const current = peers[peerId];
+        if (!current || current.connection) return;
+        if (isInitiator(peerId)) {
+            initializePeerConnection(peerId, true);
         } else {
-            console.error(`Peer ${fromPeerId} not ready for signaling yet`);
+            current.connectionAttempts++;
+            requestOffer(peerId);
         }
-    } catch (error) {
-        console.error(`Error processing signal from ${fromPeerId}:`, error);
-        peers[fromPeerId].state = CONNECTION_STATES.ERROR;
+    }, backoffTime);
+    updatePeersList();
+}
+
+// Messages are JSON, optionally followed by a 0x00 separator and binary chunk data.
+// They arrive on the SimplePeer channel, the striped data channels and the relay alike.
+export function handlePeerMessage(peerId, data) {
+    let bytes;
+    if (typeof data === 'string') {
+        bytes = new TextEncoder().encode(data);
+    } else if (data instanceof ArrayBuffer) {
+        bytes = new Uint8Array(data);
+    } else if (data instanceof Uint8Array) {
+        bytes = data;
+    } else {
+        console.warn("Unsupported message type from peer:", typeof data);
+        return;
+    }
+
+    // Only decode the header, not the chunk payload
+    const separatorIndex = bytes.indexOf(0);
+    const header = separatorIndex === -1 ? bytes : bytes.subarray(0, separatorIndex);
+
+    let parsed;
+    try {
+        const jsonStr = new TextDecoder().decode(header);
+        if (!jsonStr.trim().startsWith('{')) return;
+        parsed = JSON.parse(jsonStr);
+    } catch (e) {
+        console.warn("Failed to parse JSON:", e);
+        return;
+    }
+
+    const peer = peers[peerId] && peers[peerId].connection;
+    if (peers[peerId]) {
+        peers[peerId].lastDataReceived = Date.now();
+    }
+    switch (parsed.type) {
+        case 'file-list':
+            handleFileList(peerId, parsed.files);
+            break;
+        case 'file-request':
+            handleFileRequest(peerId, parsed.fileId, parsed.chunks || null, parsed.as || null, parsed.compression || null);
+            break;
+        case 'batch-request':
+            handleBatchRequest(peerId, parsed.batchId, parsed.files || [], !parsed.more, parsed.compression || null);
+            break;
+        case 'file-cancel':
+            handleFileCancel(peerId, parsed.fileId, parsed.chunks || null);
+            break;
+        case 'file-data':
+            handleFileData(parsed.fileId, parsed.fileName, bytes, separatorIndex + 1, parsed.totalChunks, parsed.chunkIndex, peerId, parsed.compressed || null);
+            break;
+        case 'manifest-request':
+            handleManifestRequest(peerId, parsed.fileId);
+            break;
+        case 'manifest':
+            handleManifest(peerId, parsed, bytes, separatorIndex + 1);
+            break;
+        case 'bye':
+            console.log(`Peer ${peerId} closed an idle connection`);
+            teardownConnection(peerId);
+            updatePeersList();
+            break;
+        case 'channels-ready':
+            peers[peerId].remoteChannelCount = parsed.count;
+            console.log(`Peer ${peerId} has ${parsed.count} data channels open`);
+            break;
+        case 'ping':
+            if (peer) {
+                peer.send(JSON.stringify({ type: 'pong', timestamp: parsed.timestamp }));
+            }
+            break;
+        case 'pong':
+            const latency = Date.now() - parsed.timestamp;
+            console.log(`Latency to peer ${peerId}: ${latency}ms`);
+            peers[peerId].latencySamples = peers[peerId].latencySamples || [];
+            peers[peerId].latencySamples.push(latency);
+            if (peers[peerId].latencySamples.length > 1000) {
+                peers[peerId].latencySamples.shift();
+            }
+            recordPeerLatency(latency);
+            break;
+        case 'download-progress':
+            handleDownloadProgress(
+                parsed.fileId, 
+                parsed.progress, 
+                parsed.downloaderId, 
+                parsed.completed || false, 
+                parsed.error || null
+            );
+            break;
+
+        default:
+            console.warn("Unhandled JSON message type:", parsed);
     }
-}, 0);
 }
 
-function handleConnectionTimeout(peerId) {
-    if (!peers[peerId] || peers[peerId].state === CONNECTION_STATES.CONNECTED) {
+export function handleSignal(signal) {
+    if (!signal || !signal.from || !signal.signal) {
+        console.error("Received invalid signal data", signal);
         return;
     }
 
-    console.log(`Connection timeout with peer: ${peerId}`);
-    updateStatus(`Connection timeout with peer: ${peerId}`);
+    const fromPeerId = signal.from;
+    const signalData = signal.signal;
+
+    //console.log(`Received signal from peer: ${fromPeerId}`, signalData);
 
-    if (peers[peerId].connection) {
-        peers[peerId].connection.destroy();
+    // Late signals from attempts made before falling back to the relay
+    if (isRelayed(fromPeerId)) {
+        console.log(`Ignoring signal from ${fromPeerId}, connected through the relay`);
+        return;
     }
 
-    peers[peerId].state = CONNECTION_STATES.ERROR;
+    // The other side is waiting for our offer
+    if (signalData.type === 'connect-request') {
+        const entry = peers[fromPeerId];
+        const stale = !entry || !entry.connection ||
+            entry.state === CONNECTION_STATES.CONNECTED ||
+            performance.now() - entry.startedAt > ANSWER_TIMEOUT;
+        if (stale) {
+            initializePeerConnection(fromPeerId, true);
+        }
+        return;
+    }
 
-    // Backoff for reconnection attempts
-    const maxAttempts = 5;
-    if (peers[peerId].connectionAttempts < maxAttempts) {
-        const backoffTime = Math.min(1000 * Math.pow(2, peers[peerId].connectionAttempts), 30000);
-        console.log(`Will retry connection in ${backoffTime}ms (attempt ${peers[peerId].connectionAttempts})`);
+    // Every offer starts a fresh attempt on our side
+    if (signalData.type === 'offer') {
+        initializePeerConnection(fromPeerId, false);
+    }
 
-        setTimeout(() => {
-            initializePeerConnection(peerId);
-        }, backoffTime);
-    } else {
-        console.log(`Max reconnection attempts reached for peer: ${peerId}`);
-        delete peers[peerId];
-        updatePeersList();
+    const entry = peers[fromPeerId];
+    if (!entry || !entry.connection) {
+        console.warn(`No connection attempt with ${fromPeerId}, dropping its signal`);
+        return;
     }
-}
\ No newline at end of file
+
+    // Apply signals as they arrive; SimplePeer queues candidates that beat the description
+    try {
+        entry.connection.signal(signalData);
+        entry.lastSignalReceived = Date.now();
+        entry.remoteSignalled = true;
+    } catch (error) {
+        console.error(`Error processing signal from ${fromPeerId}:`, error);
+        handleConnectionFailure(fromPeerId, entry.connection, 'bad signal');
+    }
+}
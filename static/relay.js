@@ -0,0 +1,154 @@
+// Fallback through the server for peers whose direct connection can't get
+// through NAT. A RelayConnection stands in for the SimplePeer object in
+// peers[peerId].connection: send() and bufferSize are all the transfer code
+// relies on, so scheduling and backpressure work over the relay unchanged.
+
+import { handlePeerMessage, handlePeerConnected, teardownConnection, connectToPeer } from "./peer.js";
+import { showToast, updatePeersList } from "./ui.js";
+
+const RELAY_NAMESPACE = '/relay';
+
+let relaySocket = null;
+let joined = null;
+// From 'registered'; proves to the server that this relay socket is ours
+let relayToken = null;
+
+export function relayAvailable() {
+    return typeof RELAY_ENABLED !== 'undefined' && RELAY_ENABLED;
+}
+
+class RelayConnection {
+    constructor(peerId) {
+        this.peerId = peerId;
+        this.bufferSize = 0;       // bytes the server hasn't acknowledged yet
+        this.destroyed = false;
+    }
+
+    send(data) {
+        if (this.destroyed) return;
+        const bytes = typeof data === 'string' ? new TextEncoder().encode(data) : data;
+        const size = bytes.byteLength;
+        this.bufferSize += size;
+        relaySocket.emit('relay_frame', this.peerId, bytes, (reply) => {
+            this.bufferSize -= size;
+            if (!reply || !reply.ok) {
+                handleRelayFailure(this, reply ? reply.reason : 'no reply');
+            }
+        });
+    }
+
+    destroy() {
+        if (this.destroyed) return;
+        this.destroyed = true;
+        relaySocket.emit('relay_close', { to: this.peerId });
+    }
+}
+
+function sendJoin() {
+    return new Promise(resolve => {
+        relaySocket.emit('relay_join', { room_id: roomId, peer_id: myPeerId, token: relayToken }, (reply) => {
+            if (!reply || !reply.ok) {
+                console.warn("Could not join the relay:", reply && reply.reason);
+            }
+            resolve(!!reply && reply.ok);
+        });
+    });
+}
+
+// Join the relay namespace early so peers can reach us as soon as they fall back
+export function joinRelay(token = null) {
+    if (!relayAvailable()) return Promise.resolve(false);
+    if (token && token !== relayToken) {
+        relayToken = token;
+        // Registered again (after a reconnect): join again under the new token
+        if (joined && relaySocket.connected) {
+            joined = sendJoin();
+            return joined;
+        }
+    }
+    if (joined) return joined;
+
+    // Multiplexed over the page's existing Socket.IO connection
+    relaySocket = io(RELAY_NAMESPACE);
+    joined = new Promise(resolve => {
+        relaySocket.on('connect', () => sendJoin().then(resolve));
+    });
+
+    relaySocket.on('relay_open', (data) => attachRelay(data.from));
+    relaySocket.on('relay_close', (data) => {
+        const entry = peers[data.from];
+        if (entry && entry.connection instanceof RelayConnection) {
+            console.log(`Peer ${data.from} closed the relayed connection`);
+            entry.connection.destroyed = true;
+            teardownConnection(data.from);
+            updatePeersList();
+        }
+    });
+    relaySocket.on('relay_frame', (fromPeerId, frame, ack) => {
+        ack();
+        handlePeerMessage(fromPeerId, new Uint8Array(frame));
+    });
+    relaySocket.on('disconnect', () => {
+        // The server forgot our pairs; try direct again, which falls back here if it must
+        Object.keys(peers).forEach(peerId => {
+            const entry = peers[peerId];
+            if (entry.connection instanceof RelayConnection) {
+                entry.connection.destroyed = true;
+                teardownConnection(peerId);
+                connectToPeer(peerId);
+            }
+        });
+        updatePeersList();
+    });
+    return joined;
+}
+
+// Ask the server to relay between us and a peer; resolves to whether it could
+export async function openRelay(peerId) {
+    if (!(await joinRelay())) return false;
+    const reply = await new Promise(resolve => relaySocket.emit('relay_open', { to: peerId }, resolve));
+    if (!reply || !reply.ok) {
+        console.warn(`Relay to ${peerId} unavailable:`, reply && reply.reason);
+        return false;
+    }
+    attachRelay(peerId);
+    return true;
+}
+
+export function isRelayed(peerId) {
+    return !!peers[peerId] && peers[peerId].connection instanceof RelayConnection;
+}
+
+// Both ends may fall back at once; the second open finds the relay in place
+function attachRelay(peerId) {
+    if (!peerId || isRelayed(peerId)) return;
+    if (peers[peerId] && peers[peerId].connection) {
+        teardownConnection(peerId);
+    }
+    console.log(`Relaying through the server to peer ${peerId}`);
+    const connection = new RelayConnection(peerId);
+    peers[peerId] = {
+        files: [],
+        connectionAttempts: 0,
+        ...peers[peerId],
+        connection: connection,
+        relayed: true,
+        state: CONNECTION_STATES.CONNECTING
+    };
+    handlePeerConnected(peerId, connection);
+    updatePeersList();
+}
+
+function handleRelayFailure(connection, reason) {
+    if (connection.destroyed) return;
+    console.warn(`Relay to ${connection.peerId} failed: ${reason}`);
+    if (reason === 'quota') {
+        showToast(`Relay limit reached for peer ${connection.peerId}`);
+    }
+    if (peers[connection.peerId] && peers[connection.peerId].connection === connection) {
+        teardownConnection(connection.peerId);
+        updatePeersList();
+    } else {
+        connection.destroy();
+    }
+}
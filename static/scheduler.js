@@ -0,0 +1,396 @@
+// Upload scheduler shared by every transfer this client serves. Chunks are
+// picked by weighted fair queuing: first across peers, then across each
+// peer's transfers, with small files in a higher priority class. Transfers
+// close to finishing weigh more, so they drain first, and a peer weighs as
+// much as its heaviest queued transfer. A peer whose
+// channel is full is skipped rather than waited on, so a slow receiver never
+// holds up the others.
+
+import { CHUNK_SIZE } from "./file_transfer.js";
+import { canSendFrame, sendFrame, waitForDrain } from "./channels.js";
+import { readChunkFrame } from "./transfer_engine.js";
+import { COMPRESSION_FORMAT, shouldCompress, recordCompression } from "./compression.js";
+
+const MAX_READS_IN_FLIGHT = 8;             // chunk reads pending in the transfer worker
+const SMALL_FILE_SIZE = 1024 * 1024;       // files up to this size jump the queue
+const RATE_WINDOW = 2000;                  // ms of history for the per-peer rate
+// [remaining bytes up to, weight], checked in order; larger remainders weigh 1
+const REMAINING_WEIGHTS = [[16 * 1024 * 1024, 4], [256 * 1024 * 1024, 2]];
+
+// Active uploads, keyed by "peerId:fileId"
+const uploads = {};
+// Per-peer virtual finish time and counters
+const peerStates = {};
+
+let virtualTime = 0;
+let readsInFlight = 0;
+let pumpScheduled = false;
+
+// Optional global cap, as a token bucket in bytes
+let bandwidthCap = 0;                      // bytes/s, 0 = unlimited
+let tokens = 0;
+let lastRefill = performance.now();
+let refillTimer = null;
+
+const totals = {
+    bytesSent: 0,
+    wireBytesSent: 0,          // after compression
+    chunksSent: 0,
+    compressedChunks: 0,
+    retries: 0,
+    backpressureStalls: 0
+};
+
+function peerState(peerId) {
+    if (!peerStates[peerId]) {
+        peerStates[peerId] = {
+            finishTime: virtualTime,
+            bytesSent: 0,
+            recent: []           // [timestamp, wire bytes] samples for the rate
+        };
+    }
+    return peerStates[peerId];
+}
+
+// Register chunks to send to a peer; callbacks report progress back to the caller
+export function enqueueUpload(peerId, fileId, source, chunks, callbacks = {}) {
+    const key = `${peerId}:${fileId}`;
+    const totalChunks = Math.ceil(source.size / CHUNK_SIZE);
+    const upload = {
+        peerId: peerId,
+        fileId: fileId,
+        source: source,
+        totalChunks: totalChunks,
+        remaining: [],
+        requestedChunks: 0,
+        sentChunks: 0,
+        inFlight: 0,
+        blockedFrames: [],
+        weight: 1,
+        priority: source.size <= SMALL_FILE_SIZE ? 1 : 0,
+        finishTime: peerState(peerId).finishTime,
+        cancelled: false,
+        compression: callbacks.compression || null,
+        header: callbacks.header || {},
+        onSent: callbacks.onSent || (() => {}),
+        onComplete: callbacks.onComplete || (() => {})
+    };
+    uploads[key] = upload;
+    addChunks(upload, chunks || Array.from({ length: totalChunks }, (_, index) => index));
+    return upload;
+}
+
+export function getUpload(peerId, fileId) {
+    return uploads[`${peerId}:${fileId}`] || null;
+}
+
+export function addChunks(upload, chunks) {
+    const queued = new Set(upload.remaining);
+    chunks.forEach(index => {
+        if (index >= 0 && index < upload.totalChunks && !queued.has(index)) {
+            upload.remaining.push(index);
+            upload.requestedChunks++;
+        }
+    });
+    upload.weight = uploadWeight(upload);
+    schedulePump();
+}
+
+// Drop some chunks (null = all) from an upload
+export function cancelUpload(peerId, fileId, chunks = null) {
+    const upload = getUpload(peerId, fileId);
+    if (!upload) return;
+
+    if (chunks) {
+        const cancelled = new Set(chunks);
+        const before = upload.remaining.length;
+        upload.remaining = upload.remaining.filter(index => !cancelled.has(index));
+        upload.requestedChunks -= before - upload.remaining.length;
+        upload.weight = uploadWeight(upload);
+        checkComplete(upload);
+        return;
+    }
+
+    upload.cancelled = true;
+    upload.remaining = [];
+    upload.blockedFrames = [];
+    delete uploads[`${peerId}:${fileId}`];
+}
+
+export function cancelPeerUploads(peerId) {
+    Object.values(uploads)
+        .filter(upload => upload.peerId === peerId)
+        .forEach(upload => cancelUpload(peerId, upload.fileId));
+    delete peerStates[peerId];
+}
+
+// Cap total upload rate across all peers; 0 removes the cap
+export function setBandwidthCap(bytesPerSecond) {
+    bandwidthCap = Math.max(0, bytesPerSecond || 0);
+    tokens = 0;
+    lastRefill = performance.now();
+    console.log(bandwidthCap ? `Upload cap set to ${(bandwidthCap / 1024 / 1024).toFixed(2)} MB/s` : "Upload cap removed");
+    schedulePump();
+}
+
+function takeTokens(bytes) {
+    if (!bandwidthCap) return true;
+    const now = performance.now();
+    // Allow at most a quarter second of burst
+    tokens = Math.min(bandwidthCap / 4, tokens + (now - lastRefill) / 1000 * bandwidthCap);
+    lastRefill = now;
+    if (tokens >= bytes) {
+        tokens -= bytes;
+        return true;
+    }
+    if (!refillTimer) {
+        const wait = Math.ceil((bytes - tokens) / bandwidthCap * 1000);
+        refillTimer = setTimeout(() => {
+            refillTimer = null;
+            schedulePump();
+        }, wait);
+    }
+    return false;
+}
+
+// Compression saved bytes that were charged up front
+function refundTokens(bytes) {
+    if (bandwidthCap) {
+        tokens = Math.min(bandwidthCap / 4, tokens + bytes);
+    }
+}
+
+// Wire bytes/s sent to a peer over the last RATE_WINDOW
+function peerRate(state, now = performance.now()) {
+    const recentBytes = state.recent
+        .filter(([timestamp]) => now - timestamp <= RATE_WINDOW)
+        .reduce((total, [, bytes]) => total + bytes, 0);
+    return recentBytes / (RATE_WINDOW / 1000);
+}
+
+// Weight of a transfer from the bytes it still has queued
+function uploadWeight(upload) {
+    const remainingBytes = upload.remaining.length * CHUNK_SIZE;
+    for (const [limit, weight] of REMAINING_WEIGHTS) {
+        if (remainingBytes <= limit) return weight;
+    }
+    return 1;
+}
+
+// A peer weighs as much as its heaviest transfer with data queued
+function peerWeight(peerId) {
+    return Object.values(uploads)
+        .filter(upload => upload.peerId === peerId && upload.remaining.length > 0)
+        .reduce((weight, upload) => Math.max(weight, upload.weight), 1);
+}
+
+// Upload with the smallest virtual finish time, among peers that can take data
+function pickUpload() {
+    let candidates = Object.values(uploads).filter(upload =>
+        !upload.cancelled &&
+        upload.remaining.length > 0 &&
+        upload.blockedFrames.length === 0 &&
+        canSendFrame(upload.peerId)
+    );
+    if (candidates.length === 0) return null;
+
+    // Strict priority between classes, fair queuing within one
+    const topPriority = Math.max(...candidates.map(upload => upload.priority));
+    candidates = candidates.filter(upload => upload.priority === topPriority);
+
+    let bestPeer = null;
+    candidates.forEach(upload => {
+        const state = peerState(upload.peerId);
+        if (!bestPeer || state.finishTime < peerState(bestPeer).finishTime) {
+            bestPeer = upload.peerId;
+        }
+    });
+
+    let best = null;
+    candidates.forEach(upload => {
+        if (upload.peerId === bestPeer && (!best || upload.finishTime < best.finishTime)) {
+            best = upload;
+        }
+    });
+    return best;
+}
+
+function schedulePump() {
+    if (pumpScheduled) return;
+    pumpScheduled = true;
+    setTimeout(() => {
+        pumpScheduled = false;
+        pump();
+    }, 0);
+}
+
+// Virtual time follows the slowest-served peer that still has data queued
+function updateVirtualTime() {
+    const backlogged = Object.values(uploads)
+        .filter(upload => upload.remaining.length > 0)
+        .map(upload => peerState(upload.peerId).finishTime);
+    if (backlogged.length > 0) {
+        virtualTime = Math.max(virtualTime, Math.min(...backlogged));
+    }
+}
+
+// Wake the pump when a peer we skipped for backpressure drains
+function waitOnFullPeers() {
+    Object.values(uploads).forEach(upload => {
+        const state = peerState(upload.peerId);
+        if (upload.remaining.length === 0 || state.waitingForDrain || canSendFrame(upload.peerId)) return;
+        state.waitingForDrain = true;
+        totals.backpressureStalls++;
+        waitForDrain(upload.peerId, () => {
+            state.waitingForDrain = false;
+            schedulePump();
+        });
+    });
+}
+
+function pump() {
+    while (readsInFlight < MAX_READS_IN_FLIGHT) {
+        const upload = pickUpload();
+        if (!upload) {
+            waitOnFullPeers();
+            return;
+        }
+
+        const index = upload.remaining[0];
+        const start = index * CHUNK_SIZE;
+        const end = Math.min(upload.source.size, start + CHUNK_SIZE);
+        if (!takeTokens(end - start)) return;
+
+        // Advance virtual time for the peer and the transfer, by bytes sent over weight
+        const state = peerState(upload.peerId);
+        const cost = end - start;
+        state.finishTime = Math.max(state.finishTime, virtualTime) + cost / peerWeight(upload.peerId);
+        upload.remaining.shift();
+        upload.finishTime = Math.max(upload.finishTime, virtualTime) + cost / upload.weight;
+        upload.weight = uploadWeight(upload);
+        updateVirtualTime();
+
+        readsInFlight++;
+        upload.inFlight++;
+        const header = { ...upload.header, chunkIndex: index, totalChunks: upload.totalChunks };
+        const compress = shouldCompress(upload.compression) ? COMPRESSION_FORMAT : null;
+        readChunkFrame(upload.source, header, start, end, compress).then((result) => {
+            readsInFlight--;
+            const wireBytes = Math.min(result.rawBytes, result.compressedBytes);
+            if (compress) {
+                recordCompression(upload.compression, result.rawBytes, result.compressedBytes,
+                    result.compressMs, peerRate(state));
+                refundTokens(result.rawBytes - wireBytes);
+            }
+            deliver(upload, index, result.frame, end - start, wireBytes);
+            schedulePump();
+        }).catch((error) => {
+            readsInFlight--;
+            retryChunk(upload, index, error);
+        });
+    }
+}
+
+function deliver(upload, index, frame, bytes, wireBytes) {
+    if (upload.cancelled) return;
+    try {
+        if (upload.blockedFrames.length > 0 || !sendFrame(upload.peerId, frame)) {
+            // Channel filled up while the chunk was being read; hold it until it drains
+            upload.blockedFrames.push({ index, frame, bytes, wireBytes });
+            if (upload.blockedFrames.length === 1) {
+                waitForDrain(upload.peerId, () => flushBlocked(upload));
+            }
+            return;
+        }
+    } catch (error) {
+        retryChunk(upload, index, error);
+        return;
+    }
+    recordSent(upload, bytes, wireBytes);
+}
+
+function flushBlocked(upload) {
+    if (upload.cancelled) return;
+    while (upload.blockedFrames.length > 0) {
+        const { index, frame, bytes, wireBytes } = upload.blockedFrames[0];
+        try {
+            if (!sendFrame(upload.peerId, frame)) {
+                waitForDrain(upload.peerId, () => flushBlocked(upload));
+                return;
+            }
+        } catch (error) {
+            upload.blockedFrames.shift();
+            retryChunk(upload, index, error);
+            continue;
+        }
+        upload.blockedFrames.shift();
+        recordSent(upload, bytes, wireBytes);
+    }
+    schedulePump();
+}
+
+function retryChunk(upload, index, error) {
+    //console.error(`Error sending chunk ${index}:`, error);
+    upload.inFlight--;
+    totals.retries++;
+    setTimeout(() => {
+        if (upload.cancelled) return;
+        upload.remaining.unshift(index);
+        schedulePump();
+    }, 1000);
+}
+
+function recordSent(upload, bytes, wireBytes) {
+    upload.inFlight--;
+    upload.sentChunks++;
+    totals.bytesSent += bytes;
+    totals.wireBytesSent += wireBytes;
+    totals.chunksSent++;
+    if (wireBytes < bytes) {
+        totals.compressedChunks++;
+    }
+
+    const state = peerState(upload.peerId);
+    const now = performance.now();
+    state.bytesSent += bytes;
+    state.recent.push([now, wireBytes]);
+    while (state.recent.length > 0 && now - state.recent[0][0] > RATE_WINDOW) {
+        state.recent.shift();
+    }
+
+    upload.onSent(upload.sentChunks, upload.requestedChunks);
+    checkComplete(upload);
+}
+
+function checkComplete(upload) {
+    if (upload.cancelled || upload.remaining.length > 0 || upload.inFlight > 0) return;
+    if (upload.sentChunks < upload.requestedChunks) return;
+    delete uploads[`${upload.peerId}:${upload.fileId}`];
+    upload.onComplete();
+}
+
+export function getSchedulerStats() {
+    const now = performance.now();
+    const peerStats = {};
+    Object.keys(peerStates).forEach(peerId => {
+        const state = peerStates[peerId];
+        peerStats[peerId] = {
+            bytesSent: state.bytesSent,
+            rate: peerRate(state, now),
+            weight: peerWeight(peerId),
+            uploads: Object.values(uploads).filter(upload => upload.peerId === peerId).length,
+            queuedChunks: Object.values(uploads)
+                .filter(upload => upload.peerId === peerId)
+                .reduce((total, upload) => total + upload.remaining.length, 0)
+        };
+    });
+
+    return {
+        activeUploads: Object.keys(uploads).length,
+        readsInFlight: readsInFlight,
+        bandwidthCap: bandwidthCap,
+        totalRate: Object.values(peerStats).reduce((total, peer) => total + peer.rate, 0),
+        ...totals,
+        peers: peerStats
+    };
+}
@@ -0,0 +1,236 @@
+import { CHUNK_SIZE, requestChunksFromPeer, cancelChunksFromPeer } from "./file_transfer.js";
+import { updateFileDownloadStatus, setDownloadButton } from "./ui.js";
+
+// Multi-source downloads in progress, keyed by file ID
+const swarms = {};
+
+const MIN_BLOCK = 16;          // chunks per request for a source we know nothing about
+const MAX_BLOCK = 512;
+const BLOCK_SECONDS = 2;       // size each request to roughly this much transfer time
+const ENDGAME_COPIES = 2;      // max sources fetching the same chunk near the end
+const STALL_TIMEOUT = 10000;   // drop a source that delivers nothing for this long
+
+// Connected peers holding the file, matched by ID or by content ID, with the ID each uses
+export function findFileHolders(fileId, contentId = null) {
+    const holders = [];
+    Object.keys(peers).forEach(peerId => {
+        if (!peers[peerId].connected || !peers[peerId].files) return;
+        const listing = peers[peerId].files.find(f =>
+            f.fileId === fileId || (contentId && f.contentId === contentId));
+        if (listing) {
+            holders.push({ peerId: peerId, fileId: listing.fileId });
+        }
+    });
+    return holders;
+}
+
+// chunks limits the download to those indices (the rest are already held)
+export function startSwarmDownload(fileId, fileName, size, holders, chunks = null) {
+    if (swarms[fileId]) {
+        console.log(`Swarm download for ${fileId} already running`);
+        return;
+    }
+
+    const totalChunks = Math.ceil(size / CHUNK_SIZE);
+    const unassigned = chunks ? [...chunks] : Array.from({ length: totalChunks }, (_, index) => index);
+    const wanted = new Set(unassigned);
+    const swarm = {
+        fileId: fileId,
+        fileName: fileName,
+        totalChunks: totalChunks,
+        unassigned: unassigned,
+        received: new Set(Array.from({ length: totalChunks }, (_, index) => index).filter(index => !wanted.has(index))),
+        copies: {},
+        sources: {},
+        stallTimer: null
+    };
+    swarms[fileId] = swarm;
+
+    holders.forEach(holder => addSource(swarm, holder.peerId, holder.fileId));
+    holders.forEach(holder => assignWork(swarm, holder.peerId));
+
+    swarm.stallTimer = setInterval(() => checkStalledSources(swarm), STALL_TIMEOUT / 2);
+}
+
+function addSource(swarm, peerId, fileId) {
+    swarm.sources[peerId] = {
+        fileId: fileId,          // the ID this source shares the file under
+        pending: new Set(),
+        rate: 0,                 // bytes/s, smoothed
+        windowBytes: 0,
+        windowStart: Date.now(),
+        lastChunkAt: Date.now()
+    };
+}
+
+// Chunks to request next from a source, scaled to its measured rate
+function blockSizeFor(source) {
+    if (!source.rate) return MIN_BLOCK;
+    const chunks = Math.ceil(source.rate * BLOCK_SECONDS / CHUNK_SIZE);
+    return Math.max(MIN_BLOCK, Math.min(MAX_BLOCK, chunks));
+}
+
+function assignWork(swarm, peerId) {
+    const source = swarm.sources[peerId];
+    if (!source) return;
+
+    // Keep the next block in flight before the current one drains
+    const blockSize = blockSizeFor(source);
+    if (source.pending.size > blockSize / 2) return;
+
+    let chunks = swarm.unassigned.splice(0, blockSize - source.pending.size);
+    if (chunks.length === 0 && source.pending.size === 0) {
+        chunks = pickEndgameChunks(swarm, peerId, blockSize);
+    }
+    if (chunks.length === 0) return;
+
+    chunks.forEach(index => {
+        source.pending.add(index);
+        swarm.copies[index] = (swarm.copies[index] || 0) + 1;
+    });
+    source.lastChunkAt = Date.now();
+
+    if (!requestChunksFromPeer(peerId, source.fileId, chunks, swarm.fileId)) {
+        console.warn(`Could not request chunks from ${peerId}, dropping source`);
+        dropSource(swarm, peerId);
+    }
+}
+
+// Near the end, idle sources re-request chunks still outstanding at slower sources
+function pickEndgameChunks(swarm, peerId, limit) {
+    const others = Object.keys(swarm.sources)
+        .filter(id => id !== peerId)
+        .sort((a, b) => swarm.sources[a].rate - swarm.sources[b].rate);
+
+    const chunks = [];
+    for (const id of others) {
+        for (const index of swarm.sources[id].pending) {
+            if (chunks.length >= limit) return chunks;
+            if (!swarm.received.has(index) && swarm.copies[index] < ENDGAME_COPIES) {
+                chunks.push(index);
+            }
+        }
+    }
+    return chunks;
+}
+
+export function handleSwarmChunk(fileId, chunkIndex, byteLength, fromPeerId) {
+    const swarm = swarms[fileId];
+    if (!swarm || swarm.received.has(chunkIndex)) return;
+    swarm.received.add(chunkIndex);
+
+    // Tell any other source fetching the same chunk to skip it
+    Object.keys(swarm.sources).forEach(peerId => {
+        const source = swarm.sources[peerId];
+        if (source.pending.delete(chunkIndex) && peerId !== fromPeerId) {
+            cancelChunksFromPeer(peerId, source.fileId, [chunkIndex]);
+        }
+    });
+
+    const source = swarm.sources[fromPeerId];
+    if (source) {
+        const now = Date.now();
+        source.lastChunkAt = now;
+        source.windowBytes += byteLength;
+        const elapsed = now - source.windowStart;
+        if (elapsed >= 500) {
+            const sample = source.windowBytes / (elapsed / 1000);
+            source.rate = source.rate ? source.rate * 0.7 + sample * 0.3 : sample;
+            source.windowBytes = 0;
+            source.windowStart = now;
+        }
+    }
+
+    if (swarm.received.size === swarm.totalChunks) {
+        finishSwarm(swarm);
+        return;
+    }
+
+    if (source) {
+        assignWork(swarm, fromPeerId);
+    }
+    // Sources that went idle can pick up endgame duplicates now
+    Object.keys(swarm.sources).forEach(peerId => {
+        if (peerId !== fromPeerId && swarm.sources[peerId].pending.size === 0) {
+            assignWork(swarm, peerId);
+        }
+    });
+}
+
+function dropSource(swarm, peerId) {
+    const source = swarm.sources[peerId];
+    if (!source) return;
+    delete swarm.sources[peerId];
+
+    // Hand its outstanding chunks back to the pool
+    source.pending.forEach(index => {
+        swarm.copies[index]--;
+        if (!swarm.received.has(index) && swarm.copies[index] === 0) {
+            swarm.unassigned.push(index);
+        }
+    });
+
+    const remaining = Object.keys(swarm.sources);
+    if (remaining.length === 0) {
+        // Give up on this swarm; a retry starts a new one with whoever holds the file then
+        console.warn(`No sources left for ${swarm.fileId}`);
+        clearInterval(swarm.stallTimer);
+        delete swarms[swarm.fileId];
+        updateFileDownloadStatus(swarm.fileId, "Stalled: no peers holding this file are connected");
+        setDownloadButton(swarm.fileId, "Retry", false);
+        return;
+    }
+    remaining.forEach(id => assignWork(swarm, id));
+}
+
+function checkStalledSources(swarm) {
+    const now = Date.now();
+    Object.keys(swarm.sources).forEach(peerId => {
+        const source = swarm.sources[peerId];
+        if (source.pending.size > 0 && now - source.lastChunkAt > STALL_TIMEOUT) {
+            console.warn(`Source ${peerId} stalled for ${swarm.fileId}`);
+            cancelChunksFromPeer(peerId, source.fileId);
+            dropSource(swarm, peerId);
+        }
+    });
+}
+
+// Stop the swarm and cancel whatever its sources still owe
+function stopSwarm(swarm) {
+    clearInterval(swarm.stallTimer);
+    Object.keys(swarm.sources).forEach(peerId => {
+        if (swarm.sources[peerId].pending.size > 0) {
+            cancelChunksFromPeer(peerId, swarm.sources[peerId].fileId);
+        }
+    });
+    delete swarms[swarm.fileId];
+}
+
+function finishSwarm(swarm) {
+    stopSwarm(swarm);
+    console.log(`Swarm download of ${swarm.fileName} complete`);
+}
+
+// Drop a running swarm so the download can start over; false if none was running
+export function abortSwarmDownload(fileId) {
+    const swarm = swarms[fileId];
+    if (!swarm) return false;
+    stopSwarm(swarm);
+    return true;
+}
+
+// Put back a chunk that failed verification; false if no swarm is running for the file
+export function requeueSwarmChunk(fileId, chunkIndex) {
+    const swarm = swarms[fileId];
+    if (!swarm) return false;
+    swarm.received.delete(chunkIndex);
+    Object.values(swarm.sources).forEach(source => source.pending.delete(chunkIndex));
+    swarm.copies[chunkIndex] = 0;
+    swarm.unassigned.unshift(chunkIndex);
+    Object.keys(swarm.sources).forEach(peerId => assignWork(swarm, peerId));
+    return true;
+}
+
+export function handleSwarmPeerLost(peerId) {
+    Object.values(swarms).forEach(swarm => dropSource(swarm, peerId));
+}
@@ -0,0 +1,124 @@
+// Connection and transfer telemetry. Every SAMPLE_INTERVAL each direct
+// connection's getStats() is read for its selected candidate pair (RTT,
+// local candidate type, available outgoing bitrate, bytes moved) and each
+// peer is pinged over its control channel; transfers are timed as they
+// finish. Samples go to the server in one batch every TELEMETRY_INTERVAL
+// seconds, where they are folded into histograms (see /metrics).
+
+const SAMPLE_INTERVAL = 10000;
+const MAX_BATCH = 500;                 // samples kept between reports; older ones are dropped
+const MIN_RATE_BYTES = 64 * 1024;      // a sample period moving less than this is idle, not slow
+const MIN_TRANSFER_BYTES = 64 * 1024;  // smaller transfers measure latency rather than throughput
+
+let samples = [];
+let transfers = [];
+// peerId -> { at, sent, received } of the previous sample of its candidate pair
+const previousBytes = {};
+
+function addSample(sample) {
+    samples.push(sample);
+    if (samples.length > MAX_BATCH) {
+        samples.shift();
+    }
+}
+
+export function startTelemetry() {
+    if (!TELEMETRY_INTERVAL) return;
+    setInterval(sampleConnections, SAMPLE_INTERVAL);
+    setInterval(reportTelemetry, TELEMETRY_INTERVAL * 1000);
+}
+
+async function sampleConnections() {
+    for (const peerId of Object.keys(peers)) {
+        const entry = peers[peerId];
+        if (!entry || !entry.connected || !entry.connection) continue;
+        // Answered with a pong, which lands in recordPeerLatency
+        try {
+            entry.connection.send(JSON.stringify({ type: 'ping', timestamp: Date.now() }));
+        } catch (error) {
+            continue;
+        }
+        if (entry.relayed) {
+            addSample({ candidate_type: 'server-relay' });
+            continue;
+        }
+        const pc = entry.connection._pc;
+        if (!pc || !pc.getStats) continue;
+        try {
+            const sample = await readConnectionStats(peerId, pc);
+            if (sample) addSample(sample);
+        } catch (error) {
+            console.warn(`Could not read stats for peer ${peerId}:`, error.message);
+        }
+    }
+    Object.keys(previousBytes).forEach(peerId => {
+        if (!peers[peerId]) delete previousBytes[peerId];
+    });
+}
+
+function selectedCandidatePair(report) {
+    let pair = null;
+    report.forEach(stat => {
+        if (stat.type === 'transport' && stat.selectedCandidatePairId) {
+            pair = report.get(stat.selectedCandidatePairId) || pair;
+        }
+    });
+    if (pair) return pair;
+    // Firefox has no transport stats; it flags the pair instead
+    report.forEach(stat => {
+        if (stat.type === 'candidate-pair' && (stat.selected || (stat.nominated && stat.state === 'succeeded'))) {
+            pair = pair || stat;
+        }
+    });
+    return pair;
+}
+
+async function readConnectionStats(peerId, pc) {
+    const report = await pc.getStats();
+    const pair = selectedCandidatePair(report);
+    if (!pair) return null;
+
+    const local = report.get(pair.localCandidateId);
+    const sample = {};
+    if (local && local.candidateType) sample.candidate_type = local.candidateType;
+    if (pair.currentRoundTripTime !== undefined) sample.rtt_ms = pair.currentRoundTripTime * 1000;
+    if (pair.availableOutgoingBitrate !== undefined) sample.outgoing_bitrate_bps = pair.availableOutgoingBitrate;
+
+    // Rates over the period since this peer's previous sample, when data actually moved
+    const previous = previousBytes[peerId];
+    if (previous && pair.timestamp > previous.at) {
+        const seconds = (pair.timestamp - previous.at) / 1000;
+        const sent = pair.bytesSent - previous.sent;
+        const received = pair.bytesReceived - previous.received;
+        if (sent >= MIN_RATE_BYTES) sample.send_rate_bps = sent * 8 / seconds;
+        if (received >= MIN_RATE_BYTES) sample.receive_rate_bps = received * 8 / seconds;
+    }
+    previousBytes[peerId] = { at: pair.timestamp, sent: pair.bytesSent, received: pair.bytesReceived };
+    return sample;
+}
+
+// Application-level round trip over the control channel, queueing included
+export function recordPeerLatency(latency) {
+    if (!TELEMETRY_INTERVAL) return;
+    addSample({ app_rtt_ms: latency });
+}
+
+// direction is 'download' or 'upload'
+export function recordTransfer(direction, bytes, milliseconds) {
+    if (!TELEMETRY_INTERVAL || bytes < MIN_TRANSFER_BYTES || milliseconds <= 0) return;
+    transfers.push({ direction: direction, bytes: bytes, seconds: milliseconds / 1000 });
+    if (transfers.length > MAX_BATCH) {
+        transfers.shift();
+    }
+}
+
+function reportTelemetry() {
+    if (!socket || !socket.connected || (samples.length === 0 && transfers.length === 0)) return;
+    socket.emit('telemetry', {
+        room_id: roomId,
+        samples: samples,
+        transfers: transfers
+    });
+    samples = [];
+    transfers = [];
+}
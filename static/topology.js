@@ -0,0 +1,81 @@
+// Overlay topology for large rooms. Above a size threshold the server gives
+// each peer a bounded set of neighbours to keep connections with instead of
+// the whole room; a transfer with anyone else opens a connection on demand,
+// which is closed again once it has been idle for a while.
+
+import { connectToPeer, closeIdleConnection } from "./peer.js";
+import { getSchedulerStats } from "./scheduler.js";
+
+const ON_DEMAND_TIMEOUT = 15000;   // give up opening an on-demand connection after this
+const IDLE_TIMEOUT = 60000;        // close on-demand connections quiet for this long
+const SWEEP_INTERVAL = 15000;
+
+let planned = false;
+let neighbours = new Set();
+let roomSize = 0;
+let sweepTimer = null;
+
+// Apply a room_peers/registered payload from the server
+export function updateTopology(data) {
+    planned = !!data.planned;
+    neighbours = new Set(data.peers || []);
+    roomSize = data.room_size || (data.peers || []).length;
+    if (planned && !sweepTimer) {
+        sweepTimer = setInterval(closeIdleConnections, SWEEP_INTERVAL);
+    }
+}
+
+export function isPlanned() {
+    return planned;
+}
+
+// Peers we keep a standing connection with: everyone unless the room is planned
+export function isNeighbour(peerId) {
+    return !planned || neighbours.has(peerId);
+}
+
+export function getTopologyStats() {
+    return {
+        planned: planned,
+        roomSize: roomSize,
+        neighbours: planned ? neighbours.size - 1 : roomSize - 1,
+        connections: Object.values(peers).filter(entry => entry.connected).length
+    };
+}
+
+// Connect to a peer for a transfer; resolves to whether the connection opened
+export function openOnDemand(peerId, timeout = ON_DEMAND_TIMEOUT) {
+    if (peers[peerId] && peers[peerId].connected) {
+        return Promise.resolve(true);
+    }
+    console.log(`Opening on-demand connection to ${peerId}`);
+    connectToPeer(peerId, true);
+
+    const deadline = Date.now() + timeout;
+    return new Promise(resolve => {
+        const check = setInterval(() => {
+            if (peers[peerId] && peers[peerId].connected) {
+                clearInterval(check);
+                resolve(true);
+            } else if (Date.now() > deadline) {
+                clearInterval(check);
+                resolve(false);
+            }
+        }, 100);
+    });
+}
+
+function closeIdleConnections() {
+    const now = Date.now();
+    const schedulerPeers = getSchedulerStats().peers;
+    Object.keys(peers).forEach(peerId => {
+        const entry = peers[peerId];
+        if (!entry.connected || isNeighbour(peerId)) return;
+        const uploading = schedulerPeers[peerId] && schedulerPeers[peerId].uploads > 0;
+        const lastActive = Math.max(entry.lastDataReceived || 0, entry.connectedAt || 0);
+        if (!uploading && now - lastActive > IDLE_TIMEOUT) {
+            console.log(`Closing idle on-demand connection to ${peerId}`);
+            closeIdleConnection(peerId);
+        }
+    });
+}
@@ -0,0 +1,210 @@
+// Main-thread side of the transfer worker. Falls back to doing the same work
+// inline when module workers are not available.
+
+let worker = null;
+let workerFailed = false;
+let nextRequestId = 1;
+const pendingRequests = {};
+// Called once if the worker dies, with whatever it held lost
+const failureListeners = [];
+
+// Inline fallback storage for incoming chunks
+const inlineIncoming = {};
+
+function getWorker() {
+    if (worker || workerFailed) return worker;
+    try {
+        // resolve() goes through the page's import map, which points at the content-hashed URL
+        const url = import.meta.resolve ? import.meta.resolve('./transfer_worker.js')
+            : new URL('./transfer_worker.js', import.meta.url);
+        worker = new Worker(url);
+        worker.onmessage = (event) => {
+            const reply = event.data;
+            const pending = pendingRequests[reply.id];
+            if (!pending) return;
+            delete pendingRequests[reply.id];
+            if (reply.error) {
+                pending.reject(new Error(reply.error));
+            } else {
+                pending.resolve(reply);
+            }
+        };
+        // A worker that fails to load or dies fails everything it was asked
+        // to do; later calls take the inline path
+        worker.onerror = (event) => {
+            if (workerFailed) return;
+            console.error("Transfer worker error, processing chunks on the main thread:", event.message);
+            event.target.terminate();
+            worker = null;
+            workerFailed = true;
+            for (const id of Object.keys(pendingRequests)) {
+                pendingRequests[id].reject(new Error("Transfer worker failed"));
+                delete pendingRequests[id];
+            }
+            failureListeners.forEach(listener => listener());
+        };
+    } catch (error) {
+        console.warn("Transfer worker unavailable, processing chunks on the main thread:", error);
+        workerFailed = true;
+        worker = null;
+    }
+    return worker;
+}
+
+// Chunks sent to the worker unawaited are lost with it; owners of downloads
+// register here to fetch them again
+export function onWorkerFailure(listener) {
+    failureListeners.push(listener);
+}
+
+function callWorker(message, transfer = []) {
+    return new Promise((resolve, reject) => {
+        const id = nextRequestId++;
+        pendingRequests[id] = { resolve, reject };
+        worker.postMessage({ ...message, id }, transfer);
+    });
+}
+
+// Read bytes [start, end) of a Blob into a ready-to-send frame. With a
+// compression format the worker compresses the payload when that shrinks it;
+// resolves to { frame, rawBytes, compressedBytes, compressMs }.
+export async function readChunkFrame(blob, header, start, end, compress = null) {
+    if (getWorker()) {
+        const reply = await callWorker({ op: 'frame', blob, header, start, end, compress });
+        return {
+            frame: new Uint8Array(reply.frame),
+            rawBytes: reply.rawBytes,
+            compressedBytes: reply.compressedBytes,
+            compressMs: reply.compressMs
+        };
+    }
+
+    // Inline fallback never compresses
+    const payload = await blob.slice(start, end).arrayBuffer();
+    const meta = new TextEncoder().encode(JSON.stringify(header));
+    const frame = new Uint8Array(meta.byteLength + 1 + payload.byteLength);
+    frame.set(meta, 0);
+    frame[meta.byteLength] = 0; // separator
+    frame.set(new Uint8Array(payload), meta.byteLength + 1);
+    return { frame, rawBytes: payload.byteLength, compressedBytes: payload.byteLength, compressMs: 0 };
+}
+
+// Hand a received frame to the worker; the payload starts at byte `offset`.
+// Compressed payloads are inflated first, and with an expected hash the
+// worker verifies the result. Resolves to the chunk's length once kept, or
+// null if it failed verification.
+export async function storeChunk(fileId, chunkIndex, totalChunks, bytes, offset, expectedHash = null, compressed = null) {
+    if (getWorker()) {
+        // Transfer the buffer when the frame owns it, copy when it is a view into a shared one
+        let buffer = bytes.buffer;
+        if (bytes.byteOffset !== 0 || bytes.byteLength !== buffer.byteLength) {
+            buffer = bytes.slice().buffer;
+        }
+        const message = { op: 'store', fileId, chunkIndex, totalChunks, buffer, offset, expectedHash, compressed };
+        if (!expectedHash && !compressed) {
+            const length = buffer.byteLength - offset;
+            worker.postMessage(message, [buffer]);
+            return length;
+        }
+        const reply = await callWorker(message, [buffer]);
+        return reply.ok ? reply.length : null;
+    }
+
+    // Inline fallback keeps chunks unverified
+    let payload = bytes.slice(offset);
+    if (compressed) {
+        const stream = new Blob([payload]).stream().pipeThrough(new DecompressionStream(compressed));
+        payload = new Uint8Array(await new Response(stream).arrayBuffer());
+    }
+    if (!inlineIncoming[fileId]) {
+        inlineIncoming[fileId] = new Array(totalChunks);
+    }
+    inlineIncoming[fileId][chunkIndex] = payload;
+    return payload.byteLength;
+}
+
+// Per-chunk SHA-256 hashes (32 bytes each) and their Merkle root, as hex
+export async function hashFile(blob, chunkSize) {
+    if (!getWorker()) {
+        throw new Error("Hashing needs the transfer worker");
+    }
+    const reply = await callWorker({ op: 'hash', blob, chunkSize });
+    return { root: reply.root, hashes: new Uint8Array(reply.hashes) };
+}
+
+// Content ID for a file of the given size with these chunk hashes
+export async function computeMerkleRoot(hashes, size) {
+    if (!getWorker()) {
+        throw new Error("Hashing needs the transfer worker");
+    }
+    const reply = await callWorker({ op: 'root', hashes: hashes.slice().buffer, size: size });
+    return reply.root;
+}
+
+// Build the final Blob once every chunk has been stored
+export async function assembleFile(fileId) {
+    if (getWorker()) {
+        const reply = await callWorker({ op: 'assemble', fileId });
+        return reply.blob;
+    }
+
+    const chunks = inlineIncoming[fileId] || [];
+    delete inlineIncoming[fileId];
+    const missing = Array.from(chunks).filter(chunk => chunk === undefined).length;
+    if (missing > 0) {
+        throw new Error(`${missing} of ${chunks.length} chunks are missing`);
+    }
+    return new Blob(chunks, { type: 'application/octet-stream' });
+}
+
+export function discardFile(fileId) {
+    if (getWorker()) {
+        worker.postMessage({ op: 'discard', fileId });
+        return;
+    }
+    delete inlineIncoming[fileId];
+}
+
+// Persistent chunk store, kept by the transfer worker in IndexedDB. Without
+// the worker nothing is persisted and these reject.
+async function callStore(message) {
+    if (!getWorker()) {
+        throw new Error("The chunk store needs the transfer worker");
+    }
+    const reply = await callWorker(message);
+    return reply.result;
+}
+
+// Open the store, evicting least recently used files past `quota` bytes;
+// resolves to the records of the files it holds
+export function openChunkStore(quota, roomId) {
+    return callStore({ op: 'store-open', quota, roomId });
+}
+
+// Create or update a file's record; chunks stored for it from now on are written through
+export function persistStoredFile(fileId, meta) {
+    return callStore({ op: 'store-persist', fileId, meta });
+}
+
+// Resolves to { indices, bytes } of the chunks already stored for a partial download
+export function resumeStoredFile(fileId, totalChunks) {
+    return callStore({ op: 'store-resume', fileId, totalChunks });
+}
+
+// A complete stored file as a Blob, or null if chunks are missing
+export function loadStoredFile(fileId) {
+    return callStore({ op: 'store-load', fileId });
+}
+
+export function renameStoredFile(fromId, toId) {
+    return callStore({ op: 'store-rename', fromId, toId });
+}
+
+export function storeWholeFile(fileId, meta, blob, chunkSize) {
+    return callStore({ op: 'store-file', fileId, meta, blob, chunkSize });
+}
+
+// Mark a stored file as recently used, so it is evicted last
+export function touchStoredFile(fileId) {
+    return callStore({ op: 'store-touch', fileId });
+}
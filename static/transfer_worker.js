@@ -0,0 +1,515 @@
+// Transfer worker: reads, compresses and frames outgoing chunks, keeps
+// incoming chunks until a file is complete and hashes content, so none of
+// that work lands on the UI thread. Incoming chunks are also written through
+// to an IndexedDB chunk store, so downloads survive a page refresh.
+
+const encoder = new TextEncoder();
+
+// Incoming files being reassembled, keyed by file ID. A chunk slot is
+// undefined until received and null once it only lives in the chunk store.
+const incoming = {};
+
+const STORE_NAME = 'p2p-chunk-store';
+const STORE_FLUSH_MS = 100;        // write received chunks at least this often
+const STORE_FLUSH_CHUNKS = 64;     // or as soon as this many are waiting
+const STORE_OTHER_ROOM_TTL = 24 * 60 * 60 * 1000;  // ms an unused file from another room is kept
+
+let storeDb = null;                // promise of the open database, null when unavailable
+let storeQuota = 0;                // bytes kept before least recently used files are evicted
+const storedFiles = new Map();     // file ID -> record, mirrored from the 'files' store
+let pendingWrites = [];
+let flushTimer = null;
+let flushing = Promise.resolve();
+
+async function pipeBytes(bytes, transform) {
+    const stream = new Blob([bytes]).stream().pipeThrough(transform);
+    return new Uint8Array(await new Response(stream).arrayBuffer());
+}
+
+// With request.compress the payload is compressed, and kept only if it shrank
+async function frameChunk(request) {
+    let payload = new Uint8Array(await request.blob.slice(request.start, request.end).arrayBuffer());
+    const rawBytes = payload.byteLength;
+    let compressMs = 0;
+    let compressedBytes = rawBytes;
+    let headerFields = request.header;
+
+    if (request.compress) {
+        const started = performance.now();
+        const compressed = await pipeBytes(payload, new CompressionStream(request.compress));
+        compressMs = performance.now() - started;
+        compressedBytes = compressed.byteLength;
+        if (compressed.byteLength < payload.byteLength) {
+            payload = compressed;
+            headerFields = { ...headerFields, compressed: request.compress };
+        }
+    }
+    const header = encoder.encode(JSON.stringify(headerFields));
+
+    // [JSON header, separator (0x00), binary data]
+    const frame = new Uint8Array(header.byteLength + 1 + payload.byteLength);
+    frame.set(header, 0);
+    frame[header.byteLength] = 0;
+    frame.set(payload, header.byteLength + 1);
+    return { frame: frame.buffer, rawBytes, compressedBytes, compressMs };
+}
+
+async function sha256(data) {
+    return new Uint8Array(await crypto.subtle.digest('SHA-256', data));
+}
+
+function toHex(bytes) {
+    return Array.from(bytes, b => b.toString(16).padStart(2, '0')).join('');
+}
+
+// Domain prefixes, so a leaf, an inner node and the root can never collide
+const MERKLE_LEAF = 0x00;
+const MERKLE_NODE = 0x01;
+const MERKLE_ROOT = 0x02;
+
+// Binary Merkle tree over the chunk hashes; an odd node is carried up as is.
+// The chunk count and file size are hashed into the root along with the tree.
+async function merkleRoot(hashes, size) {
+    const totalChunks = hashes.byteLength / 32;
+    let level = [];
+    for (let offset = 0; offset < hashes.byteLength; offset += 32) {
+        const leaf = new Uint8Array(33);
+        leaf[0] = MERKLE_LEAF;
+        leaf.set(hashes.subarray(offset, offset + 32), 1);
+        level.push(await sha256(leaf));
+    }
+    while (level.length > 1) {
+        const next = [];
+        for (let i = 0; i < level.length; i += 2) {
+            if (i + 1 === level.length) {
+                next.push(level[i]);
+                continue;
+            }
+            const node = new Uint8Array(65);
+            node[0] = MERKLE_NODE;
+            node.set(level[i], 1);
+            node.set(level[i + 1], 33);
+            next.push(await sha256(node));
+        }
+        level = next;
+    }
+
+    const root = new Uint8Array(49);
+    const view = new DataView(root.buffer);
+    root[0] = MERKLE_ROOT;
+    view.setBigUint64(1, BigInt(totalChunks));
+    view.setBigUint64(9, BigInt(size));
+    if (level.length > 0) {
+        root.set(level[0], 17);
+    }
+    return toHex(await sha256(root));
+}
+
+// SHA-256 of every chunk plus the Merkle root, reading the file in large slices
+async function hashFile(request) {
+    const chunkSize = request.chunkSize;
+    const totalChunks = Math.ceil(request.blob.size / chunkSize);
+    const hashes = new Uint8Array(totalChunks * 32);
+    const sliceChunks = 256;
+
+    for (let first = 0; first < totalChunks; first += sliceChunks) {
+        const start = first * chunkSize;
+        const end = Math.min(request.blob.size, start + sliceChunks * chunkSize);
+        const slice = new Uint8Array(await request.blob.slice(start, end).arrayBuffer());
+        for (let offset = 0, index = first; offset < slice.byteLength; offset += chunkSize, index++) {
+            hashes.set(await sha256(slice.subarray(offset, offset + chunkSize)), index * 32);
+        }
+    }
+    return { root: await merkleRoot(hashes, request.blob.size), hashes: hashes.buffer };
+}
+
+function incomingFile(fileId, totalChunks) {
+    if (!incoming[fileId]) {
+        incoming[fileId] = {
+            chunks: new Array(totalChunks),
+            persisted: false
+        };
+    }
+    return incoming[fileId];
+}
+
+function storeChunk(request, payload) {
+    const file = incomingFile(request.fileId, request.totalChunks);
+    file.chunks[request.chunkIndex] = payload;
+    if (file.persisted) {
+        queueWrite(request.fileId, request.chunkIndex, payload);
+    }
+}
+
+// Number of chunk slots with nothing in them (holes in a sparse array included)
+function countMissing(parts) {
+    let missing = 0;
+    for (let index = 0; index < parts.length; index++) {
+        if (!parts[index]) missing++;
+    }
+    return missing;
+}
+
+async function assembleFile(request) {
+    const file = incoming[request.fileId];
+    if (!file) return null;
+    delete incoming[request.fileId];
+    let parts = file.chunks;
+    if (file.chunks.includes(null)) {
+        // Chunks already written out are read back as Blobs, which the browser keeps on disk
+        await flushWrites();
+        const stored = await readStoredChunks(request.fileId);
+        parts = file.chunks.map((chunk, index) => chunk || stored.get(index));
+    }
+    const missing = countMissing(parts);
+    if (missing > 0) {
+        throw new Error(`${missing} of ${parts.length} chunks are missing`);
+    }
+    return new Blob(parts, { type: 'application/octet-stream' });
+}
+
+// Chunk store: 'files' holds one record per file (name, chunk count, content
+// ID and hashes, bytes stored, last use), 'chunks' holds a Blob per chunk
+// keyed by [fileId, index]. Writes are batched into one transaction per flush.
+
+function idbRequest(request) {
+    return new Promise((resolve, reject) => {
+        request.onsuccess = () => resolve(request.result);
+        request.onerror = () => reject(request.error);
+    });
+}
+
+function idbDone(transaction) {
+    return new Promise((resolve, reject) => {
+        transaction.oncomplete = () => resolve();
+        transaction.onerror = transaction.onabort = () => reject(transaction.error || new Error("Transaction aborted"));
+    });
+}
+
+function chunkRange(fileId) {
+    return IDBKeyRange.bound([fileId, 0], [fileId, Infinity]);
+}
+
+// Open the store and hand back the records of the files held for this room.
+// Files from other rooms stay hidden and are dropped once they go unused.
+async function openStore(request) {
+    storeQuota = request.quota;
+    if (!storeDb) {
+        storeDb = new Promise((resolve, reject) => {
+            const open = indexedDB.open(STORE_NAME, 1);
+            open.onupgradeneeded = () => {
+                open.result.createObjectStore('files', { keyPath: 'fileId' });
+                open.result.createObjectStore('chunks');
+            };
+            open.onsuccess = () => resolve(open.result);
+            open.onerror = () => reject(open.error);
+        });
+    }
+    try {
+        const db = await storeDb;
+        const records = await idbRequest(db.transaction('files').objectStore('files').getAll());
+        const now = Date.now();
+        const current = [];
+        for (const record of records) {
+            if (record.roomId === request.roomId) {
+                current.push(record);
+            } else if (!record.roomId || now - record.lastUsed > STORE_OTHER_ROOM_TTL) {
+                await deleteStored(record.fileId);
+                continue;
+            }
+            storedFiles.set(record.fileId, record);
+        }
+        return current;
+    } catch (error) {
+        storeDb = null;
+        throw error;
+    }
+}
+
+async function putRecord(record) {
+    const transaction = (await storeDb).transaction('files', 'readwrite');
+    transaction.objectStore('files').put(record);
+    await idbDone(transaction);
+}
+
+// Create or update a file's record; its chunks are written through from now on
+async function persistFile(request) {
+    let record = storedFiles.get(request.fileId);
+    if (!record) {
+        record = { fileId: request.fileId, bytes: 0, chunks: 0, complete: false };
+        storedFiles.set(request.fileId, record);
+    }
+    Object.assign(record, request.meta, { lastUsed: Date.now() });
+    await putRecord(record);
+}
+
+function queueWrite(fileId, chunkIndex, payload) {
+    // A Blob copies just this chunk, not the whole frame the payload is a view into
+    pendingWrites.push({ fileId, chunkIndex, blob: new Blob([payload]) });
+    if (pendingWrites.length >= STORE_FLUSH_CHUNKS) {
+        flushWrites();
+    } else if (!flushTimer) {
+        flushTimer = setTimeout(flushWrites, STORE_FLUSH_MS);
+    }
+}
+
+// Flushes run one after another, so chunks reach the store in arrival order
+function flushWrites() {
+    clearTimeout(flushTimer);
+    flushTimer = null;
+    const writes = pendingWrites;
+    pendingWrites = [];
+    flushing = flushing.then(() => writeChunks(writes));
+    return flushing;
+}
+
+async function writeChunks(writes) {
+    if (writes.length === 0) return;
+    try {
+        await evictStored(writes.reduce((total, write) => total + write.blob.size, 0));
+        // Skip files discarded or evicted since their chunks were queued
+        writes = writes.filter(write => storedFiles.has(write.fileId));
+        const transaction = (await storeDb).transaction(['files', 'chunks'], 'readwrite');
+        const chunks = transaction.objectStore('chunks');
+        const updated = new Set();
+        writes.forEach(write => {
+            chunks.put(write.blob, [write.fileId, write.chunkIndex]);
+            // Records are updated in place so a concurrent persist sees the new counts
+            const record = storedFiles.get(write.fileId);
+            record.bytes += write.blob.size;
+            record.chunks++;
+            record.lastUsed = Date.now();
+            updated.add(record);
+        });
+        updated.forEach(record => transaction.objectStore('files').put(record));
+        await idbDone(transaction);
+
+        // The store has them now; drop the in-memory copies
+        writes.forEach(write => {
+            const file = incoming[write.fileId];
+            if (file) file.chunks[write.chunkIndex] = null;
+        });
+    } catch (error) {
+        // Usually the browser's quota: these files carry on in memory only
+        console.warn("Chunk store write failed, keeping downloads in memory:", error.message);
+        writes.forEach(write => {
+            if (incoming[write.fileId]) incoming[write.fileId].persisted = false;
+        });
+    }
+}
+
+// Evict least recently used files until `extra` more bytes fit in the quota.
+// Files still being received are never evicted.
+async function evictStored(extra) {
+    let total = extra;
+    storedFiles.forEach(record => { total += record.bytes; });
+    if (total <= storeQuota) return;
+
+    const candidates = [...storedFiles.values()]
+        .filter(record => !incoming[record.fileId])
+        .sort((a, b) => a.lastUsed - b.lastUsed);
+    for (const record of candidates) {
+        if (total <= storeQuota) break;
+        total -= record.bytes;
+        await deleteStored(record.fileId);
+        console.log(`Evicted ${record.name} (${record.bytes} bytes) from the chunk store`);
+    }
+}
+
+async function deleteStored(fileId) {
+    storedFiles.delete(fileId);
+    const transaction = (await storeDb).transaction(['files', 'chunks'], 'readwrite');
+    transaction.objectStore('files').delete(fileId);
+    transaction.objectStore('chunks').delete(chunkRange(fileId));
+    await idbDone(transaction);
+}
+
+// index -> Blob for every stored chunk of a file
+async function readStoredChunks(fileId) {
+    const store = (await storeDb).transaction('chunks').objectStore('chunks');
+    const [keys, blobs] = await Promise.all([
+        idbRequest(store.getAllKeys(chunkRange(fileId))),
+        idbRequest(store.getAll(chunkRange(fileId)))
+    ]);
+    return new Map(keys.map((key, i) => [key[1], blobs[i]]));
+}
+
+// Pick a partial download back up: stored chunks count as received and new
+// ones are written through. Resolves to the stored chunk indices and their size.
+async function resumeStored(request) {
+    const file = incomingFile(request.fileId, request.totalChunks);
+    file.persisted = true;
+    const stored = await readStoredChunks(request.fileId);
+    let bytes = 0;
+    stored.forEach((blob, index) => {
+        if (file.chunks[index] === undefined) file.chunks[index] = null;
+        bytes += blob.size;
+    });
+    return { indices: [...stored.keys()], bytes };
+}
+
+// A complete file from the store, as one Blob
+async function loadStored(request) {
+    const record = storedFiles.get(request.fileId);
+    if (!record) return null;
+    const stored = await readStoredChunks(request.fileId);
+    const parts = [];
+    for (let index = 0; index < record.totalChunks; index++) {
+        if (!stored.has(index)) return null;
+        parts.push(stored.get(index));
+    }
+    record.lastUsed = Date.now();
+    await putRecord(record);
+    return new Blob(parts, { type: 'application/octet-stream' });
+}
+
+// Move a stored file to another ID, when a peer shares the same content under a new one
+async function renameStored(request) {
+    const record = storedFiles.get(request.fromId);
+    if (!record) return;
+    const stored = await readStoredChunks(request.fromId);
+    const transaction = (await storeDb).transaction(['files', 'chunks'], 'readwrite');
+    const chunks = transaction.objectStore('chunks');
+    stored.forEach((blob, index) => chunks.put(blob, [request.toId, index]));
+    chunks.delete(chunkRange(request.fromId));
+    const renamed = { ...record, fileId: request.toId };
+    transaction.objectStore('files').delete(request.fromId);
+    transaction.objectStore('files').put(renamed);
+    await idbDone(transaction);
+    storedFiles.delete(request.fromId);
+    storedFiles.set(request.toId, renamed);
+}
+
+// Store a file that arrived whole (unpacked from a batch), in chunk-sized pieces
+async function storeWholeFile(request) {
+    const size = request.blob.size;
+    const totalChunks = Math.max(1, Math.ceil(size / request.chunkSize));
+    await evictStored(size);
+    const record = {
+        ...request.meta,
+        fileId: request.fileId,
+        totalChunks: totalChunks,
+        bytes: size,
+        chunks: totalChunks,
+        complete: true,
+        lastUsed: Date.now()
+    };
+    const transaction = (await storeDb).transaction(['files', 'chunks'], 'readwrite');
+    const chunks = transaction.objectStore('chunks');
+    for (let index = 0; index < totalChunks; index++) {
+        const start = index * request.chunkSize;
+        chunks.put(request.blob.slice(start, Math.min(size, start + request.chunkSize)), [request.fileId, index]);
+    }
+    transaction.objectStore('files').put(record);
+    await idbDone(transaction);
+    storedFiles.set(request.fileId, record);
+}
+
+async function touchStored(request) {
+    const record = storedFiles.get(request.fileId);
+    if (!record) return;
+    record.lastUsed = Date.now();
+    await putRecord(record);
+}
+
+// Store ops reply with { result } or { error }
+async function replyWith(request, work) {
+    try {
+        self.postMessage({ id: request.id, result: await work(request) });
+    } catch (error) {
+        self.postMessage({ id: request.id, error: error.message });
+    }
+}
+
+self.onmessage = async (event) => {
+    const request = event.data;
+    switch (request.op) {
+        case 'frame':
+            try {
+                const result = await frameChunk(request);
+                self.postMessage({ id: request.id, ...result }, [result.frame]);
+            } catch (error) {
+                self.postMessage({ id: request.id, error: error.message });
+            }
+            break;
+        case 'store':
+            try {
+                // Keep a view into the transferred frame instead of copying the payload out
+                let payload = new Uint8Array(request.buffer, request.offset);
+                if (request.compressed) {
+                    payload = await pipeBytes(payload, new DecompressionStream(request.compressed));
+                }
+                // Check the payload against the manifest hash before keeping it
+                if (request.expectedHash) {
+                    const actual = await sha256(payload);
+                    if (toHex(actual) !== request.expectedHash) {
+                        self.postMessage({ id: request.id, ok: false });
+                        break;
+                    }
+                }
+                storeChunk(request, payload);
+                if (request.id) {
+                    self.postMessage({ id: request.id, ok: true, length: payload.byteLength });
+                }
+            } catch (error) {
+                self.postMessage({ id: request.id, error: error.message });
+            }
+            break;
+        case 'hash':
+            try {
+                const result = await hashFile(request);
+                self.postMessage({ id: request.id, root: result.root, hashes: result.hashes }, [result.hashes]);
+            } catch (error) {
+                self.postMessage({ id: request.id, error: error.message });
+            }
+            break;
+        case 'root':
+            try {
+                self.postMessage({ id: request.id, root: await merkleRoot(new Uint8Array(request.hashes), request.size) });
+            } catch (error) {
+                self.postMessage({ id: request.id, error: error.message });
+            }
+            break;
+        case 'assemble':
+            try {
+                self.postMessage({ id: request.id, blob: await assembleFile(request) });
+            } catch (error) {
+                self.postMessage({ id: request.id, error: error.message });
+            }
+            break;
+        case 'discard':
+            delete incoming[request.fileId];
+            break;
+        case 'store-open':
+            replyWith(request, openStore);
+            break;
+        case 'store-persist':
+            if (!storeDb) {
+                self.postMessage({ id: request.id, error: "Chunk store is not open" });
+                break;
+            }
+            // Marked before any await, so chunks that follow this message are written through
+            if (!request.meta.complete) {
+                incomingFile(request.fileId, request.meta.totalChunks).persisted = true;
+            }
+            replyWith(request, persistFile);
+            break;
+        case 'store-resume':
+            replyWith(request, resumeStored);
+            break;
+        case 'store-load':
+            replyWith(request, loadStored);
+            break;
+        case 'store-rename':
+            replyWith(request, renameStored);
+            break;
+        case 'store-file':
+            replyWith(request, storeWholeFile);
+            break;
+        case 'store-touch':
+            replyWith(request, touchStored);
+            break;
+        default:
+            console.warn("Transfer worker got unknown op:", request.op);
+    }
+};
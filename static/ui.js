@@ -1,294 +1,518 @@
 import { requestFileFromPeer } from "./file_transfer.js";
 import { getPeerIdFromFileId } from "./utility.js";
+import { canSaveToDirectory, saveToDirectory } from "./batch.js";
+import { isPlanned, getTopologyStats } from "./topology.js";
+
+// The file catalog keeps one row state per file ID and renders it as a
+// virtualized list: only rows in or near view exist in the DOM, and status
+// updates patch the row they belong to instead of rebuilding the list.
+const ROW_HEIGHT_ESTIMATE = 64;     // px, until a row has been measured
+const OVERSCAN_PX = 400;            // rendered beyond the visible part, both ways
+
+let fileRows = new Map();           // fileId -> row state, in display order
+const mountedRows = new Map();      // fileId -> <li> currently in the DOM
+const rowHeights = new Map();       // fileId -> measured height in px
+const rowParts = new WeakMap();     // <li> -> its elements that get patched
+let fileListView = null;
+let fileListScheduled = false;
+
+function newFileRow(fileId, fileName, size, ownedByMe, url = null, peerId = null, downloaders = {}) {
+    return {
+        fileId: fileId,
+        fileName: fileName,
+        size: size,
+        ownedByMe: ownedByMe,
+        peerId: peerId || getPeerIdFromFileId(fileId),
+        url: url,
+        status: ownedByMe ? 'Your file' : 'Available from peer',
+        progress: null,
+        // A row offers either a link to url or a button requesting the file
+        link: ownedByMe && url ? { text: 'Download' } : null,
+        button: ownedByMe ? null : { text: 'Download', disabled: false },
+        downloaders: downloaders
+    };
+}
 
-export function addFileToUI(fileId, fileName, url, fileSize, ownedByMe = true, downloaders = {}) {
-    const fileList = document.getElementById('fileList');
-    const existingItem = document.querySelector(`#fileList li[data-file-id="${fileId}"]`);
-    if (existingItem) {
-        const downloadBtn = existingItem.querySelector('.download-btn');
-        if (downloadBtn && url) {
-            // Convert button to download link if we have a URL
-            const downloadLink = document.createElement('a');
-            downloadLink.href = url;
-            downloadLink.download = fileName;
-            downloadLink.className = 'download-btn';
-            downloadLink.textContent = 'Download';
-            downloadBtn.parentNode.replaceChild(downloadLink, downloadBtn);
+// Rows for batch downloads are replaced by the files once they arrive
+function newBatchRow(batchId, label, size) {
+    const row = newFileRow(batchId, label, size, false);
+    row.status = 'Requesting files...';
+    row.button = null;
+    return row;
+}
+
+function setText(element, text) {
+    if (element.textContent !== text) {
+        element.textContent = text;
+    }
+}
+
+// Put exactly these nodes into parent in this order, moving only the ones out of place
+function reconcileChildren(parent, nodes) {
+    const keep = new Set(nodes);
+    Array.from(parent.children).forEach(child => {
+        if (!keep.has(child)) child.remove();
+    });
+    let cursor = parent.firstElementChild;
+    nodes.forEach(node => {
+        if (node === cursor) {
+            cursor = cursor.nextElementSibling;
+        } else {
+            parent.insertBefore(node, cursor);
         }
+    });
+}
+
+function createFileRow(row) {
+    const listItem = document.createElement('li');
+    listItem.className = 'file-item';
+    listItem.setAttribute('data-file-id', row.fileId);
+    const parts = {
+        info: document.createElement('div'),
+        name: document.createElement('span'),
+        meta: document.createElement('span'),
+        status: document.createElement('span'),
+        actions: document.createElement('div'),
+        progress: null,
+        downloaders: null,
+        downloaderItems: new Map(),
+        actionKey: null
+    };
+    parts.info.className = 'file-info';
+    parts.name.className = 'file-name';
+    parts.meta.className = 'file-meta';
+    parts.status.className = 'file-status';
+    parts.status.id = `status-${row.fileId}`;
+    parts.actions.className = 'file-actions';
+    parts.info.append(parts.name, parts.meta, parts.status);
+    listItem.append(parts.info, parts.actions);
+    rowParts.set(listItem, parts);
+    paintFileRow(listItem, row);
+    return listItem;
+}
 
-        // Update the status if it exists
-        const statusElement = existingItem.querySelector('.file-status');
-        if (statusElement) {
-            statusElement.id = `status-${fileId}`; 
-            statusElement.textContent = 'Ready to download';
+function paintFileRow(listItem, row) {
+    const parts = rowParts.get(listItem);
+    setText(parts.name, row.fileName);
+    setText(parts.meta, row.size ? `Size: ${(parseInt(row.size) / 1024).toFixed(2)} KB` : 'Unknown size');
+    setText(parts.status, row.status);
+    if (row.progress !== null) {
+        paintProgress(parts, row.progress);
+    }
+    paintDownloaders(parts, row.downloaders);
+    paintActions(parts, row);
+}
+
+function paintMountedRow(fileId) {
+    const listItem = mountedRows.get(fileId);
+    if (listItem) {
+        paintFileRow(listItem, fileRows.get(fileId));
+    }
+}
+
+function paintProgress(parts, percentage) {
+    if (!parts.progress) {
+        parts.progress = document.createElement('div');
+        parts.progress.className = 'progress-bar';
+        parts.progress.innerHTML = `
+                <div class="progress-fill-bg"></div>
+                <div class="progress-fill"></div>
+                <div class="progress-text">0%</div>
+            `;
+        parts.info.appendChild(parts.progress);
+    }
+    const [progressFillBg, progressFill, progressText] = parts.progress.children;
+    progressFillBg.style.width = `${percentage}%`;
+    progressFill.style.left = `calc(${percentage}% - 20px)`;
+    setText(progressText, `${percentage}%`);
+}
+
+function paintActions(parts, row) {
+    const file = files[row.fileId];
+    const folder = Boolean(row.link && row.link.text === 'Save' && file && file.entries && canSaveToDirectory());
+    // Rebuilt only when the kind of action changes; button text is patched in place
+    const actionKey = JSON.stringify([row.url, row.link, Boolean(row.button), folder]);
+    if (parts.actionKey === actionKey) {
+        if (row.button) {
+            setText(parts.actions.firstElementChild, row.button.text);
+            parts.actions.firstElementChild.disabled = row.button.disabled;
         }
-        if (ownedByMe && Object.keys(downloaders).length > 0) {
-            updateSenderFileStatus(fileId, downloaders);
+        return;
+    }
+    parts.actionKey = actionKey;
+
+    const actions = [];
+    if (row.link && row.url) {
+        const downloadLink = document.createElement('a');
+        downloadLink.href = row.url;
+        downloadLink.download = row.fileName;
+        downloadLink.className = 'download-btn';
+        downloadLink.textContent = row.link.text;
+        if (row.link.text === 'Save') {
+            downloadLink.addEventListener('click', function () {
+                this.textContent = 'Saved';
+                setTimeout(() => {
+                    this.textContent = 'Save';
+                }, 3000);
+            });
         }
+        actions.push(downloadLink);
+    } else if (row.button) {
+        const downloadBtn = document.createElement('button');
+        downloadBtn.className = 'download-btn';
+        downloadBtn.setAttribute('data-file-id', row.fileId);
+        downloadBtn.setAttribute('data-peer-id', row.peerId);
+        downloadBtn.textContent = row.button.text;
+        downloadBtn.disabled = row.button.disabled;
+        downloadBtn.addEventListener('click', () => {
+            requestFileFromPeer(row.peerId, row.fileId);
+            setDownloadButton(row.fileId, "Downloading...", true);
+        });
+        actions.push(downloadBtn);
+    }
+
+    // Folders can also be written out file by file
+    if (folder) {
+        const folderBtn = document.createElement('button');
+        folderBtn.className = 'download-btn';
+        folderBtn.textContent = 'Save to folder';
+        folderBtn.addEventListener('click', () => {
+            saveToDirectory(files[row.fileId].entries)
+                .then(() => showToast(`Saved ${files[row.fileId].entries.length} files`))
+                .catch(error => {
+                    if (error.name !== 'AbortError') {
+                        showToast(`Could not save folder: ${error.message}`);
+                    }
+                });
+        });
+        actions.push(folderBtn);
+    }
+    parts.actions.replaceChildren(...actions);
+}
 
+function scheduleFileListRender() {
+    if (fileListScheduled) return;
+    fileListScheduled = true;
+    requestAnimationFrame(() => {
+        fileListScheduled = false;
+        renderFileListView();
+    });
+}
+
+function createSpacer() {
+    const spacer = document.createElement('li');
+    spacer.className = 'file-spacer';
+    return spacer;
+}
+
+// Mount the rows overlapping the visible part of the list; spacers stand in for the rest
+function renderFileListView() {
+    const fileList = document.getElementById('fileList');
+    if (!fileListView) {
+        const placeholder = document.createElement('li');
+        placeholder.className = 'file-item file-placeholder';
+        placeholder.textContent = 'No files shared yet';
+        fileListView = { top: createSpacer(), bottom: createSpacer(), placeholder: placeholder };
+        fileList.addEventListener('scroll', scheduleFileListRender, { passive: true });
+        window.addEventListener('resize', scheduleFileListRender);
+    }
+
+    if (fileRows.size === 0) {
+        mountedRows.clear();
+        reconcileChildren(fileList, [fileListView.placeholder]);
         return;
     }
 
-    // Format file size consistently
-    const displaySize = fileSize ?
-        (parseInt(fileSize) / 1024).toFixed(2) + ' KB' :
-        (files[fileId] && files[fileId].size ?
-            (parseInt(files[fileId].size) / 1024).toFixed(2) + ' KB' : 'Unknown size');
+    // The list scrolls within at most the window's height
+    const from = fileList.scrollTop - OVERSCAN_PX;
+    const to = fileList.scrollTop + Math.max(fileList.clientHeight, window.innerHeight) + OVERSCAN_PX;
+    const visible = [];
+    let offset = 0;
+    let above = 0;
+    let shown = 0;
+    for (const [fileId, row] of fileRows) {
+        const height = rowHeights.get(fileId) || ROW_HEIGHT_ESTIMATE;
+        if (offset + height < from) {
+            above += height;
+        } else if (offset < to) {
+            visible.push(row);
+            shown += height;
+        }
+        offset += height;
+    }
 
-    const listItem = document.createElement('li');
-    listItem.className = 'file-item';
-    listItem.setAttribute('data-file-id', fileId);
-
-    if (ownedByMe) {
-        // For files I own
-        listItem.innerHTML = `
-                    <div class="file-info">
-                        <span class="file-name">${fileName}</span>
-                        <span class="file-meta">Size: ${displaySize}</span>
-                        <span class="file-status">Your file</span>
-                        <div class="downloaders-status" id="downloaders-${fileId}"></div>
-                    </div>
-                    <a href="${url}" download="${fileName}" class="download-btn">Download</a>
-                `;
-        if (Object.keys(downloaders).length > 0) {
-            updateSenderFileStatus(fileId, downloaders);
+    const keep = new Set(visible.map(row => row.fileId));
+    for (const fileId of mountedRows.keys()) {
+        if (!keep.has(fileId)) mountedRows.delete(fileId);
+    }
+    const listItems = visible.map(row => {
+        let listItem = mountedRows.get(row.fileId);
+        if (!listItem) {
+            listItem = createFileRow(row);
+            mountedRows.set(row.fileId, listItem);
         }
-    } else {
-        // For files from peers
-        listItem.innerHTML = `
-                    <div class="file-info">
-                        <span class="file-name">${fileName}</span>
-                        <span class="file-meta">Size: ${displaySize}</span>
-                        <span class="file-status" id="status-${fileId}">Available from peer</span>
-                    </div>
-                    <button class="download-btn" data-file-id="${fileId}" data-peer-id="${getPeerIdFromFileId(fileId)}">Download</button>
-                `;
+        return listItem;
+    });
+    fileListView.top.style.height = `${above}px`;
+    fileListView.bottom.style.height = `${offset - above - shown}px`;
+    reconcileChildren(fileList, [fileListView.top, ...listItems, fileListView.bottom]);
+
+    // Measured heights replace the estimate; render again if the window moved
+    let remeasured = false;
+    listItems.forEach((listItem, i) => {
+        const height = listItem.offsetHeight;
+        if (height && height !== rowHeights.get(visible[i].fileId)) {
+            rowHeights.set(visible[i].fileId, height);
+            remeasured = true;
+        }
+    });
+    if (remeasured) {
+        scheduleFileListRender();
+    }
+}
 
-        // Add click handler to request file
-        const downloadBtn = listItem.querySelector('.download-btn');
-        downloadBtn.addEventListener('click', () => {
-            const fileId = downloadBtn.getAttribute('data-file-id');
-            const peerId = downloadBtn.getAttribute('data-peer-id');
-            requestFileFromPeer(peerId, fileId);
-            downloadBtn.textContent = "Downloading...";
-            downloadBtn.disabled = true;
-        });
+// Replace the catalog with these entries, keeping the state of rows that stay
+export function renderFileList(entries) {
+    const rows = new Map();
+    entries.forEach(entry => {
+        let row = fileRows.get(entry.fileId);
+        if (!row) {
+            row = entry.batch ?
+                newBatchRow(entry.fileId, entry.fileName, entry.size) :
+                newFileRow(entry.fileId, entry.fileName, entry.size, entry.ownedByMe, entry.url, entry.peerId, entry.downloaders);
+        } else {
+            row.fileName = entry.fileName;
+            row.size = entry.size;
+            if (entry.downloaders) {
+                row.downloaders = entry.downloaders;
+            }
+            if (row.ownedByMe && entry.url && !row.url) {
+                row.url = entry.url;
+                row.link = { text: 'Download' };
+            }
+        }
+        rows.set(entry.fileId, row);
+    });
+    for (const fileId of fileRows.keys()) {
+        if (!rows.has(fileId)) rowHeights.delete(fileId);
+    }
+    fileRows = rows;
+    for (const fileId of mountedRows.keys()) {
+        if (fileRows.has(fileId)) paintMountedRow(fileId);
     }
+    scheduleFileListRender();
+}
 
-    fileList.appendChild(listItem);
+export function addFileToUI(fileId, fileName, url, fileSize, ownedByMe = true, downloaders = {}) {
+    const row = fileRows.get(fileId);
+    if (row) {
+        if (url) {
+            // Offer the file as a link now that we have a URL
+            row.url = url;
+            row.link = { text: 'Download' };
+            row.button = null;
+        }
+        row.status = 'Ready to download';
+        if (ownedByMe && Object.keys(downloaders).length > 0) {
+            row.downloaders = downloaders;
+        }
+        paintMountedRow(fileId);
+        return;
+    }
+
+    const size = fileSize || (files[fileId] && files[fileId].size) || 0;
+    fileRows.set(fileId, newFileRow(fileId, fileName, size, ownedByMe, url, null, downloaders));
+    scheduleFileListRender();
+}
+
+export function addBatchToUI(batchId, label, size) {
+    if (fileRows.has(batchId)) return;
+    fileRows.set(batchId, newBatchRow(batchId, label, size));
+    scheduleFileListRender();
+}
 
-    // Remove placeholder if present
-    const placeholder = document.querySelector('#fileList li:first-child');
-    if (placeholder && placeholder.textContent.includes('No files shared yet')) {
-        placeholder.remove();
+export function removeFileFromUI(fileId) {
+    if (fileRows.delete(fileId)) {
+        rowHeights.delete(fileId);
+        scheduleFileListRender();
     }
 }
 
+// Text and state of the button requesting a file from its peer
+export function setDownloadButton(fileId, text, disabled) {
+    const row = fileRows.get(fileId);
+    if (!row || !row.button) return;
+    row.button = { text: text, disabled: disabled };
+    paintMountedRow(fileId);
+}
+
 export function updateSenderFileStatus(fileId, downloaders) {
-    let downloadersContainer = document.getElementById(`downloaders-${fileId}`);
-    
-    // If not found, add it
-    if (!downloadersContainer) {
-        const fileItem = document.querySelector(`li[data-file-id="${fileId}"]`);
-        if (!fileItem) return;
-        
-        // Find or create the file-info section
-        let fileInfo = fileItem.querySelector('.file-info');
-        if (!fileInfo) {
-            fileInfo = document.createElement('div');
-            fileInfo.className = 'file-info';
-            fileItem.appendChild(fileInfo);
-        }
-        
-        // Create downloaders container
-        downloadersContainer = document.createElement('div');
-        downloadersContainer.className = 'downloaders-status';
-        downloadersContainer.id = `downloaders-${fileId}`;
-        fileInfo.appendChild(downloadersContainer);
+    const row = fileRows.get(fileId);
+    if (!row) return;
+    row.downloaders = downloaders;
+    const listItem = mountedRows.get(fileId);
+    if (listItem) {
+        paintDownloaders(rowParts.get(listItem), downloaders);
     }
-    
-    // Clear and rebuild the list
-    downloadersContainer.innerHTML = '';
-    
-    // Get active downloaders
-    const activeDownloaders = Object.keys(downloaders).filter(id => 
-        downloaders[id].status === 'downloading' || 
+}
+
+// One item per downloading peer, keyed by peer ID and updated in place
+function paintDownloaders(parts, downloaders) {
+    const activeDownloaders = Object.keys(downloaders).filter(id =>
+        downloaders[id].status === 'downloading' ||
         downloaders[id].status === 'starting' ||
-        (downloaders[id].status === 'completed' && 
+        (downloaders[id].status === 'completed' &&
          Date.now() - downloaders[id].completedTime < 10000) // Show completed for 10 seconds
     );
-    
-    if (activeDownloaders.length === 0) {
-        downloadersContainer.style.display = 'none';
-        return;
-    }
-    
-    downloadersContainer.style.display = 'block';
-    
-    // Create header if there are downloaders
-    if (activeDownloaders.length > 0) {
+
+    if (!parts.downloaders) {
+        if (activeDownloaders.length === 0) return;
+        parts.downloaders = document.createElement('div');
+        parts.downloaders.className = 'downloaders-status';
+        parts.downloaders.id = `downloaders-${parts.status.id.slice('status-'.length)}`;
         const header = document.createElement('div');
         header.className = 'downloaders-header';
         header.textContent = 'Current Downloads:';
-        downloadersContainer.appendChild(header);
+        parts.downloaders.appendChild(header);
+        parts.info.appendChild(parts.downloaders);
     }
-    
-    // Add each downloader
-    activeDownloaders.forEach(peerId => {
-        const downloader = downloaders[peerId];
-        const downloaderEl = document.createElement('div');
-        downloaderEl.className = 'downloader-item';
-        
-        // Create status text based on state
-        let statusText = '';
-        let statusClass = '';
-        
-        switch (downloader.status) {
-            case 'starting':
-                statusText = `Peer ${peerId}: Preparing transfer...`;
-                statusClass = 'status-pending';
-                break;
-            case 'downloading':
-                statusText = `Peer ${peerId}: ${downloader.progress || 0}% Complete`;
-                statusClass = 'status-downloading';
-                break;
-            case 'completed':
-                statusText = `Peer ${peerId}: Download Complete`;
-                statusClass = 'status-completed';
-                break;
-            case 'error':
-                statusText = `Peer ${peerId}: Error - ${downloader.error || 'Unknown error'}`;
-                statusClass = 'status-error';
-                break;
-            default:
-                statusText = `Peer ${peerId}: ${downloader.status}`;
-        }
-        
-        downloaderEl.innerHTML = `
-            <span class="downloader-status ${statusClass}">${statusText}</span>
-        `;
-        
-        // Add progress bar for downloading status
-        if (downloader.status === 'downloading' && typeof downloader.progress === 'number') {
-            const progressBar = document.createElement('div');
-            progressBar.className = 'downloader-progress';
-            progressBar.innerHTML = `
-                <div class="downloader-progress-bar" style="width: ${downloader.progress}%;"></div>
-            `;
-            downloaderEl.appendChild(progressBar);
-        }
-        
-        downloadersContainer.appendChild(downloaderEl);
-    });
-}
-
 
-export function updateFileDownloadStatus(fileId, statusText) {
-
-    const fileItem = document.querySelector(`li[data-file-id="${fileId}"]`);
-    if (!fileItem) {
-        console.error(`File item for ${fileId} not found`);
+    const container = parts.downloaders;
+    if (activeDownloaders.length === 0) {
+        container.style.display = 'none';
         return;
     }
+    container.style.display = 'block';
 
-    let statusElement = fileItem.querySelector(`#status-${fileId}`) || fileItem.querySelector('.file-status');
-    if (!statusElement) {
-        const fileInfo = fileItem.querySelector('.file-info');
-        if (!fileInfo) {
-            console.error(`Could not find .file-info for ${fileId}`);
-            return;
+    const active = new Set(activeDownloaders);
+    for (const [peerId, downloaderEl] of parts.downloaderItems) {
+        if (!active.has(peerId)) {
+            downloaderEl.remove();
+            parts.downloaderItems.delete(peerId);
         }
-        statusElement = document.createElement('span');
-        statusElement.className = 'file-status';
-        statusElement.id = `status-${fileId}`;
-        fileInfo.appendChild(statusElement);
-    } else if (!statusElement.id) {
-        statusElement.id = `status-${fileId}`;
     }
+    activeDownloaders.forEach(peerId => {
+        let downloaderEl = parts.downloaderItems.get(peerId);
+        if (!downloaderEl) {
+            downloaderEl = document.createElement('div');
+            downloaderEl.className = 'downloader-item';
+            downloaderEl.appendChild(document.createElement('span'));
+            container.appendChild(downloaderEl);
+            parts.downloaderItems.set(peerId, downloaderEl);
+        }
+        paintDownloader(downloaderEl, peerId, downloaders[peerId]);
+    });
+}
 
-    // Update the status text
-    statusElement.textContent = statusText;
-
+function paintDownloader(downloaderEl, peerId, downloader) {
+    // Create status text based on state
+    let statusText = '';
+    let statusClass = '';
+
+    switch (downloader.status) {
+        case 'starting':
+            statusText = `Peer ${peerId}: Preparing transfer...`;
+            statusClass = 'status-pending';
+            break;
+        case 'downloading':
+            statusText = `Peer ${peerId}: ${downloader.progress || 0}% Complete`;
+            statusClass = 'status-downloading';
+            break;
+        case 'completed':
+            statusText = `Peer ${peerId}: Download Complete`;
+            statusClass = 'status-completed';
+            break;
+        case 'error':
+            statusText = `Peer ${peerId}: Error - ${downloader.error || 'Unknown error'}`;
+            statusClass = 'status-error';
+            break;
+        default:
+            statusText = `Peer ${peerId}: ${downloader.status}`;
+    }
 
-    if (statusText.includes('Downloading:')) {
-        // Extract progress percentage
-        const receivedChunks = files[fileId].receivedChunks;
-        const totalChunks = files[fileId].totalChunks;
-        const percentage = Math.round((receivedChunks / totalChunks) * 100);
+    const statusEl = downloaderEl.firstElementChild;
+    statusEl.className = `downloader-status ${statusClass}`;
+    setText(statusEl, statusText);
 
-        // Add or update progress bar
-        let progressBar = fileItem.querySelector(`.progress-bar`);
+    // Progress bar while downloading
+    let progressBar = downloaderEl.children[1];
+    if (downloader.status === 'downloading' && typeof downloader.progress === 'number') {
         if (!progressBar) {
-            const fileInfo = fileItem.querySelector('.file-info');
             progressBar = document.createElement('div');
-            progressBar.className = 'progress-bar';
-            progressBar.innerHTML = `
-                <div class="progress-fill-bg"></div>
-                <div class="progress-fill"></div>
-                <div class="progress-text">0%</div>
-            `;
-
-
-
-            fileInfo.appendChild(progressBar);
+            progressBar.className = 'downloader-progress';
+            progressBar.innerHTML = `<div class="downloader-progress-bar"></div>`;
+            downloaderEl.appendChild(progressBar);
         }
+        progressBar.firstElementChild.style.width = `${downloader.progress}%`;
+    } else if (progressBar) {
+        progressBar.remove();
+    }
+}
 
-        const progressFillBg = progressBar.querySelector('.progress-fill-bg');
-        const progressFill = progressBar.querySelector('.progress-fill');
-        const progressText = progressBar.querySelector('.progress-text');
+// Status updates coming from the transfer hot path, applied once per animation frame
+const pendingDownloadStatus = {};
+const pendingSenderStatus = {};
+let renderScheduled = false;
+
+function scheduleRender() {
+    if (renderScheduled) return;
+    renderScheduled = true;
+    requestAnimationFrame(() => {
+        renderScheduled = false;
+        Object.keys(pendingDownloadStatus).forEach(fileId => {
+            const statusText = pendingDownloadStatus[fileId];
+            delete pendingDownloadStatus[fileId];
+            updateFileDownloadStatus(fileId, statusText());
+        });
+        Object.keys(pendingSenderStatus).forEach(fileId => {
+            const downloaders = pendingSenderStatus[fileId];
+            delete pendingSenderStatus[fileId];
+            updateSenderFileStatus(fileId, downloaders);
+        });
+    });
+}
 
-        if (progressFillBg) {
-            progressFillBg.style.width = `${percentage}%`;
-        }
-        if (progressFill) {
-            progressFill.style.left = `calc(${percentage}% - 20px)`; 
-        }
-        if (progressText) {
-            progressText.textContent = `${percentage}%`;
-        }
+// statusText is a function so the text reflects the latest state when it renders
+export function scheduleFileDownloadStatus(fileId, statusText) {
+    pendingDownloadStatus[fileId] = statusText;
+    scheduleRender();
+}
 
+export function scheduleSenderFileStatus(fileId, downloaders) {
+    pendingSenderStatus[fileId] = downloaders;
+    scheduleRender();
+}
 
+export function updateFileDownloadStatus(fileId, statusText) {
+    // A direct update supersedes any queued one
+    delete pendingDownloadStatus[fileId];
 
-        // Update status text to include percentage
-        statusElement.textContent = `${statusText} (${percentage}%)`;
+    const row = fileRows.get(fileId);
+    if (!row) {
+        console.error(`File item for ${fileId} not found`);
+        return;
     }
+    row.status = statusText;
 
-    // Update button state if download is complete
-    if (statusText.startsWith('Complete:')) {
-        const downloadBtn = fileItem.querySelector(`.download-btn`);
-        if (downloadBtn) {
-            downloadBtn.textContent = 'Save';
-            downloadBtn.disabled = false;
+    const file = files[fileId];
+    if (statusText.includes('Downloading:') && file && file.totalChunks) {
+        const percentage = Math.round((file.receivedChunks / file.totalChunks) * 100);
+        row.progress = percentage;
+        row.status = `${statusText} (${percentage}%)`;
+    }
 
-            // If we have a URL, replace button with link
-            if (files[fileId] && files[fileId].chunks) {
-                try {
-                    const fileBlob = new Blob(files[fileId].chunks, { type: 'application/octet-stream' });
-                    const fileUrl = URL.createObjectURL(fileBlob);
-
-                    const downloadLink = document.createElement('a');
-                    downloadLink.href = fileUrl;
-                    downloadLink.download = files[fileId].name;
-                    downloadLink.className = 'download-btn';
-                    downloadLink.textContent = 'Save';
-
-                    downloadLink.addEventListener('click', function () {
-                        this.textContent = 'Saved';
-                        setTimeout(() => {
-                            this.textContent = 'Save';
-                        }, 3000);
-                    });
-
-                    // Replace the button with the link
-                    downloadBtn.parentNode.replaceChild(downloadLink, downloadBtn);
-                } catch (error) {
-                    console.error(`Error creating download link: ${error.message}`);
-                    // Don't attempt to replace if there's an error
-                    downloadBtn.textContent = 'Download Ready';
-                }
-            }
+    // Offer the completed download for saving
+    if (statusText.startsWith('Complete:') && (row.link || row.button)) {
+        if (file && file.completeUrl) {
+            row.url = file.completeUrl;
+            row.link = { text: 'Save' };
+            row.button = null;
+        } else if (row.button) {
+            row.button = { text: 'Save', disabled: false };
         }
     }
+
+    paintMountedRow(fileId);
 }
 
 export function showToast(message, duration = 3000) {
@@ -301,24 +525,103 @@ export function showToast(message, duration = 3000) {
     }, duration);
 }
 
-export function updatePeersList(peersList = Object.keys(peers)) {
+// Peer rows keyed by peer ID; calls made within a frame render once, with the last list
+const peerRows = new Map();
+let peersListView = null;
+let pendingPeersList = null;
+let peersListScheduled = false;
+
+export function updatePeersList(peersList = null) {
+    pendingPeersList = peersList;
+    if (peersListScheduled) return;
+    peersListScheduled = true;
+    requestAnimationFrame(() => {
+        peersListScheduled = false;
+        renderPeersList(pendingPeersList || Object.keys(peers));
+    });
+}
+
+function renderPeersList(peersList) {
     const peersListElement = document.getElementById('peersList');
-    peersListElement.innerHTML = '';
+    if (!peersListView) {
+        const empty = document.createElement('li');
+        empty.className = 'peer-item';
+        empty.textContent = 'No peers connected';
+        const more = document.createElement('li');
+        more.className = 'peer-item';
+        peersListView = { empty: empty, more: more };
+    }
+
+    const listed = new Set(peersList);
+    for (const peerId of peerRows.keys()) {
+        if (!listed.has(peerId)) peerRows.delete(peerId);
+    }
     if (peersList.length === 0) {
-        peersListElement.innerHTML = '<li class="peer-item">No peers connected</li>';
+        reconcileChildren(peersListElement, [peersListView.empty]);
         return;
     }
-    peersList.forEach(peerId => {
-        const listItem = document.createElement('li');
-        listItem.className = 'peer-item';
-        listItem.innerHTML = `
+
+    const listItems = peersList.map(peerId => {
+        let listItem = peerRows.get(peerId);
+        if (!listItem) {
+            listItem = document.createElement('li');
+            listItem.className = 'peer-item';
+            listItem.innerHTML = `
                     <div class="peer-status"></div>
-                    <div>${peerId === myPeerId ? 'You' : `Peer ${peerId}`}</div>
+                    <div></div>
                 `;
-        peersListElement.appendChild(listItem);
+            peerRows.set(peerId, listItem);
+        }
+        setText(listItem.lastElementChild, peerId === myPeerId ? 'You' : `Peer ${peerId}`);
+        return listItem;
     });
+    // Planned rooms only list our neighbours
+    const others = getTopologyStats().roomSize - peersList.length;
+    if (isPlanned() && others > 0) {
+        setText(peersListView.more, `+ ${others} more peer${others === 1 ? '' : 's'} in this room`);
+        listItems.push(peersListView.more);
+    }
+    reconcileChildren(peersListElement, listItems);
 }
 
+// One label/value row of the upload stats; text only, peer IDs come from other clients
+function uploadStatsRow(label, value, strong = false) {
+    const row = document.createElement('div');
+    row.className = 'upload-stats-row';
+    [label, value].forEach(text => {
+        const cell = document.createElement(strong ? 'strong' : 'span');
+        cell.textContent = text;
+        row.appendChild(cell);
+    });
+    return row;
+}
+
+export function updateUploadStats(stats) {
+    const container = document.getElementById('uploadStats');
+    if (!container) return;
+
+    const peerIds = Object.keys(stats.peers).filter(peerId => stats.peers[peerId].uploads > 0);
+    if (peerIds.length === 0) {
+        container.textContent = 'No active uploads';
+        return;
+    }
+
+    const formatRate = (rate) => `${(rate / 1024 / 1024).toFixed(2)} MB/s`;
+    const rows = peerIds.map(peerId => {
+        const peer = stats.peers[peerId];
+        return uploadStatsRow(
+            `Peer ${peerId} (${peer.uploads} file${peer.uploads === 1 ? '' : 's'}, ${peer.queuedChunks} chunks queued)`,
+            formatRate(peer.rate));
+    });
+    const saved = stats.bytesSent - stats.wireBytesSent;
+    if (saved > 0) {
+        rows.push(uploadStatsRow('Compression saved',
+            `${(saved / 1024 / 1024).toFixed(2)} MB (${Math.round(saved / stats.bytesSent * 100)}%)`));
+    }
+    const cap = stats.bandwidthCap ? ` of ${formatRate(stats.bandwidthCap)} cap` : '';
+    rows.push(uploadStatsRow('Total', `${formatRate(stats.totalRate)}${cap}`, true));
+    container.replaceChildren(...rows);
+}
 
 export function initDebugConsole() {
     // Create debug console container
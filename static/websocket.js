@@ -1,7 +1,26 @@
 import { updateStatus } from "./core.js";
 import { updatePeersList } from "./ui.js";
-import { initializePeerConnection, handleSignal } from "./peer.js";
-import { handleFileList, updateFileList } from "./file_transfer.js";
+import { connectToPeer, handleSignal } from "./peer.js";
+import { handleFileList, updateFileList, getAdvertisedFiles, FILE_LIST_PAGE } from "./file_transfer.js";
+import { handleSwarmPeerLost } from "./swarm.js";
+import { cancelPeerUploads } from "./scheduler.js";
+import { updateTopology, isNeighbour } from "./topology.js";
+import { joinRelay } from "./relay.js";
+
+let heartbeatTimer = null;
+
+// Liveness rides on Engine.IO's ping/pong; the server may still ask for app heartbeats
+function startHeartbeat(seconds) {
+    clearInterval(heartbeatTimer);
+    heartbeatTimer = null;
+    if (!seconds) return;
+    heartbeatTimer = setInterval(() => {
+        socket.emit('heartbeat', {
+            room_id: roomId,
+            peer_id: myPeerId
+        });
+    }, seconds * 1000);
+}
 
 export function initWebSocket() {
     socket = io();
@@ -20,7 +39,17 @@ export function initWebSocket() {
         sessionStorage.setItem('peerId', myPeerId);
         console.log("Registered with peer ID:", myPeerId);
         updateStatus(`Your peer ID: ${myPeerId}`);
+        updateTopology(data);
         updatePeersList(data.peers);
+        startHeartbeat(data.heartbeat_interval);
+        // Files restored from the chunk store before we had an ID
+        if (getAdvertisedFiles().length > 0) {
+            broadcastFileList();
+        }
+        // Ready to be relayed to by peers we can't reach directly
+        joinRelay(data.relay_token);
+        // room_peers can arrive before we know our own ID; connect now that we do
+        data.peers.forEach(peerId => connectToPeer(peerId));
     });
 
     socket.on('room_peers', (data) => {
@@ -28,27 +57,17 @@ export function initWebSocket() {
         if (!myPeerId && data.peers.length==1){
             myPeerId = data.peers[0];
         }
+        // In large rooms this is our neighbour set rather than everyone
+        updateTopology(data);
         updatePeersList(data.peers);
-        // Initiate connections to other peers
-        setTimeout(() => {
-            // Initiate connections to other peers - but only if we're not already connected
-            data.peers.forEach(peerId => {
-                if (peerId !== myPeerId) {
-                    if (!peers[peerId] || peers[peerId].state!== CONNECTION_STATES.CONNECTED) {
-                        console.log(`Initiating connection to peer ${peerId} from room_peers event`);
-                        initializePeerConnection(peerId);
-                    } else {
-                        console.log(`Already connected to peer ${peerId}`);
-                    }
-                }
-            });
-        }, 0);
+        // Connect to peers we aren't connected to; the lower ID of each pair makes the offer
+        data.peers.forEach(peerId => connectToPeer(peerId));
     });
 
     socket.on('peer_joined', (data) => {
         console.log("Peer joined:", data.peer_id);
-        if (data.peer_id !== myPeerId && !peers[data.peer_id]) {
-            initializePeerConnection(data.peer_id);
+        if (isNeighbour(data.peer_id)) {
+            connectToPeer(data.peer_id);
         }
         // Send file list to new peer
         broadcastFileList();
@@ -56,8 +75,12 @@ export function initWebSocket() {
 
     socket.on('peer_disconnected', (data) => {
         console.log("Peer disconnected:", data.peer_id);
+        handleSwarmPeerLost(data.peer_id);
+        cancelPeerUploads(data.peer_id);
         if (peers[data.peer_id]) {
-            peers[data.peer_id].connection.destroy();
+            if (peers[data.peer_id].connection) {
+                peers[data.peer_id].connection.destroy();
+            }
             delete peers[data.peer_id];
         }
         updatePeersList();
@@ -82,14 +105,6 @@ export function initWebSocket() {
         console.error("Socket error:", data.message);
         updateStatus(`Error: ${data.message}`);
     });
-
-    // Send heartbeat every 5 seconds
-    setInterval(() => {
-        socket.emit('heartbeat', {
-            room_id: roomId,
-            peer_id: myPeerId
-        });
-    }, 5000);
 }
 
 export function sendSignal(peerId, signalData) {
@@ -103,32 +118,30 @@ export function sendSignal(peerId, signalData) {
 }
 
 export function broadcastFileList() {
-    const fileList = Object.keys(files).map(fileId => {
-        const file = files[fileId];
-        // Calculate size for different file types
-        let size = 0;
-        if (file.size !== undefined) {
-            // Regular File object
-            size = file.size;
-        } else if (file.chunks) {
-            // Reconstructed file from chunks
-            size = file.chunks.reduce((total, chunk) => total + (chunk ? chunk.byteLength : 0), 0);
-        }
+    const fileList = getAdvertisedFiles();
 
-        return {
-            fileId: fileId,
-            fileName: file.name,
-            size: size
-        };
-    });
-
-    // Send to server/all peers
-    socket.emit('file_list', {
-        room_id: roomId,
-        from: myPeerId,
-        files: fileList
-    });
+    // Send to server/all peers, in pages so large shares stay under the message size limit
+    let offset = 0;
+    do {
+        socket.emit('file_list', {
+            room_id: roomId,
+            from: myPeerId,
+            files: fileList.slice(offset, offset + FILE_LIST_PAGE)
+        });
+        offset += FILE_LIST_PAGE;
+    } while (offset < fileList.length);
 
     // Also update our own file list UI
     updateFileList();
 }
+
+let broadcastTimer = null;
+
+// Coalesce bursts of changes (e.g. many files finishing hashing) into one broadcast
+export function scheduleFileListBroadcast() {
+    if (broadcastTimer) return;
+    broadcastTimer = setTimeout(() => {
+        broadcastTimer = null;
+        broadcastFileList();
+    }, 500);
+}